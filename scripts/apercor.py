@@ -2,21 +2,29 @@
 from __future__ import print_function
 import os,sys
 
-
-import pyfits
-from pyraf import iraf
-from iraf import noao,digiphot,daophot
+#pyraf and matplotlib are imported when they are first needed, the numpy
+#backend never starts IRAF, see aperphot.load_iraf()
 
 import numpy as np
-import matplotlib.pyplot as plt
 from tempfile import mkstemp
+from scipy.spatial import cKDTree
+from scipy import ndimage
 import aperphot
+import photconfig
+import daophotio
+import nativephot
+import fitsimage
 
 __version__ = "1.0 (2012 Jan 30)"
 __author__ = "Megan Sosey"
 
+#within this radius the pixels the aperture cuts are split into SUBSAMPLE x SUBSAMPLE
+#subpixels, where the light of a star changes too much across a pixel to take it as flat
+SUBRADIUS = 6.
+SUBSAMPLE = 8
+
 
-def apercor(image,plotname='aperture_correction.pdf',save=False):
+def apercor(image,plotname='aperture_correction.pdf',save=False,backend="iraf",step=0.5):
 
     """
 	    Megan Sosey, January 2013
@@ -32,10 +40,14 @@ def apercor(image,plotname='aperture_correction.pdf',save=False):
             image [string]: the input image you want to use
             plotname [string]: the name of the output plot file
             save [bool]: save the output photometry file?
+            backend [string]: "iraf" runs phot on a list of apertures, "numpy" computes
+                the whole curve of growth in memory with curve_of_growth()
+            step [float]: the radius step for the numpy backend, in pixels
 
         OUTPUT:
             output plots in PDF form with information printed in the plots
             optional: the output photometry results file
+            for the numpy backend the radii, fluxes and FWHM are returned
 
         FUNCTION:
 
@@ -50,10 +62,16 @@ def apercor(image,plotname='aperture_correction.pdf',save=False):
         raise IOError("Unable to access input image: %s"%(image))
         
     
-    aperphot.set_daopars(1.) #nasic pars we want, set gain to 1
-    data=pyfits.getdata(image)
+    data=fitsimage.getdata(image)
     xsize,ysize=data.shape
     
+    if backend == "numpy":
+        #the flux at every radius from the pixels in memory, no phot file needed
+        radii,flux,fwhm=curve_of_growth(data,radii=np.arange(step,xsize/2,step))
+        print("FWHM: %f pixels"%(fwhm))
+        plot_growth(radii,flux,image,plotname,fwhm=fwhm)
+        return radii,flux,fwhm
+    
     starfile,cooname=mkstemp(suffix='coo',dir='./') #temp location file in current directory
     magfile=image + ".phot"
 
@@ -67,11 +85,13 @@ def apercor(image,plotname='aperture_correction.pdf',save=False):
     
     alist= ",".join(aperlist)   
         
-    #pick a sky annulus towards the edge of the image
-    aperphot.do_phot(image,cooname, aper=alist, sky_annulus=xsize-20, width_sky=3.,zeropoint=25.)
+    #pick a sky annulus towards the edge of the image, basic pars we want with the gain set to 1
+    config=photconfig.nicmos_config(1., aper=alist, sky_annulus=xsize-20, width_sky=3., zeropoint=25.)
+    aperphot.do_phot(image,cooname,config=config)
     
     
     #read in the output file, but in this case I'm going to use daophot.pdump to directly pull the info I want
+    iraf=aperphot.load_iraf()
     iraf.daophot.pdump(magfile,fields="xcen,ycen,flux",expr="yes",header="no",parameters="no")
     
     #make a plot of the measure flux as a function of radius (distance from the center)
@@ -86,29 +106,250 @@ def readaper(filename):
         raise IOError("Unable to access input file: %s"%(filename))
    
     
-    #read in the file
-    infile=open(filename,'r')
-    lines=infile.readlines()
-    infile.close()
-    
-    #I know there are 78 header lines
-    data=lines[79:]
+    #the reader knows the header layout and returns one entry per aperture
+    phot=daophotio.read_daophot(filename)
     
     #now grab the data I want and reformat for plotting
-    rapert=list()
-    flux=list()
-    for line in data:
-        rapert.append(float(line.split()[0]))
-        flux.append(float(line.split()[1]))
-        
+    rapert=phot["RAPERT"][0].tolist()
+    flux=phot["SUM"][0].tolist()
     
     return (rapert,flux)
     
 
+def curve_of_growth(data,x=None,y=None,radii=None,sky=0.,recenter=True):
+    """
+    the flux inside any set of radii around a star, from the image in memory
+    
+    the pixels are sorted by the distance of their farthest corner from the star,
+    the cumulative sum of the pixel values in that order is the flux of the pixels
+    which lie wholly inside each radius. Then for each radius in turn the pixels
+    the circle cuts, the ones up to a pixel diagonal further out, are added with
+    the exact fraction of their area inside it like the apertures of phot, so the
+    cost of a radius is only the pixels on its edge. Within SUBRADIUS of the star
+    that fraction is taken over subpixels with the values of a spline through the
+    pixels, scaled to keep the pixel sums, since there the star is far from flat
+    across one pixel
+    
+        data: 2d array, the image
+        x,y: the position of the star (IRAF, 1-based), default the image center
+        radii: the radii to return the flux at, default every half pixel
+        sky: sky level per pixel to subtract, a TinyTim model has none
+        recenter: centroid on the star first
+        
+    the FWHM comes from a second sort, of the pixels by the distance of their
+    centers: the mean profile in half pixel rings is found from differences of the
+    cumulative sum and the radius where it drops to half the central value is
+    interpolated
+    
+    returns the radii, the flux at those radii and the FWHM
+    """
+    data=np.asarray(data,dtype=np.float64)
+    ny,nx=data.shape
+    if x is None:
+        x=nx/2.
+    if y is None:
+        y=ny/2.
+    if recenter:
+        xc,yc,cier=nativephot.centroid(data,[x],[y])
+        x,y=xc[0],yc[0]
+        
+    #pixel centers are at integer positions starting at 1
+    yy,xx=np.indices(data.shape)
+    r=np.hypot(xx+1-x,yy+1-y).ravel()
+    order=np.argsort(r,kind="mergesort")
+    r=r[order]
+    values=data.ravel()[order]-sky
+    total=np.cumsum(values)
+    
+    if radii is None:
+        radii=np.arange(0.5,r[-1],0.5)
+    radii=np.asarray(radii,dtype=np.float64)
+    flux=_enclosed_flux(data-sky,x,y,radii)
+    
+    #mean profile in rings of half a pixel from the same cumulative sum
+    edges=np.arange(0.,r[-1]+0.5,0.5)
+    index=np.searchsorted(r,edges)
+    counts=np.diff(index)
+    sums=np.diff(np.append(0.,total)[index])
+    ring=counts > 0
+    rmid=(edges[:-1]+0.25)[ring]
+    profile=sums[ring]/counts[ring]
+    
+    half=values[0]/2.
+    below=np.nonzero(profile < half)[0]
+    if len(below) == 0 or below[0] == 0:
+        fwhm=np.nan
+    else:
+        k=below[0]
+        rhalf=np.interp(half,[profile[k],profile[k-1]],[rmid[k],rmid[k-1]])
+        fwhm=2.*rhalf
+        
+    return radii,flux,fwhm
+    
+
+def _enclosed_flux(data,x,y,radii):
+    """the flux inside each radius around x,y (IRAF, 1-based) for curve_of_growth"""
+    #the lower left corners of the pixels from the star
+    yy,xx=np.indices(data.shape)
+    x0=xx.ravel()+0.5-x
+    y0=yy.ravel()+0.5-y
+    values=data.ravel()
+    
+    #farthest corner from the star, the pixel is wholly inside any larger radius
+    rfar=np.hypot(np.maximum(np.abs(x0),np.abs(x0+1.)),np.maximum(np.abs(y0),np.abs(y0+1.)))
+    order=np.argsort(rfar,kind="mergesort")
+    rfar=rfar[order]
+    x0=x0[order]
+    y0=y0[order]
+    values=values[order]
+    total=np.append(0.,np.cumsum(values))
+    
+    #the circle can only cut pixels whose farthest corner is within a diagonal of it
+    inside=np.searchsorted(rfar,radii,side="right")
+    cut=np.searchsorted(rfar,radii+np.sqrt(2.),side="right")
+    flux=total[inside]
+    spline=None
+    for k,r in enumerate(radii):
+        part=slice(inside[k],cut[k])
+        if r > SUBRADIUS:
+            weight=nativephot.circle_overlap(x0[part],y0[part],x0[part]+1.,y0[part]+1.,r)
+            flux[k] += (weight*values[part]).sum()
+            continue
+        if spline is None:
+            spline=ndimage.spline_filter(data)
+        #subpixel corners from the star and their share of each pixel value
+        step=1./SUBSAMPLE
+        offsets=np.arange(SUBSAMPLE)*step
+        sx=x0[part,np.newaxis,np.newaxis]+offsets[np.newaxis,np.newaxis,:]
+        sy=y0[part,np.newaxis,np.newaxis]+offsets[np.newaxis,:,np.newaxis]
+        sx,sy=np.broadcast_arrays(sx,sy)
+        sub=ndimage.map_coordinates(spline,[(sy+y+0.5*step-1.).ravel(),(sx+x+0.5*step-1.).ravel()],
+                                    prefilter=False,mode="nearest").reshape(sx.shape)
+        sub += (values[part]-sub.mean(axis=(1,2)))[:,np.newaxis,np.newaxis]
+        weight=nativephot.circle_overlap(sx,sy,sx+step,sy+step,r)
+        flux[k] += (weight*sub).sum()
+    return flux
+    
+
+def field_apercor(image,stars=None,config=None,small=4.,large=10.,nstars=50,isolation=None,
+                  nsigma=3.,plotname=None):
+    """
+    aperture correction for a science frame from many bright isolated stars at once
+    
+        image: string, the image to measure, the [SCI,1] extension is used
+        stars: the detections from aperphot.find_objects, either the structured array
+               of the numpy backend or a .stars file, found with the numpy backend if None
+        config: photconfig.PhotConfig, used for finding and for the sky annulus
+        small, large: the measurement aperture and the aperture taken as the total flux
+        nstars: use at most this many of the brightest isolated stars
+        isolation: no other detection within this distance, default 2*large
+        nsigma: clipping level for the outlier rejection
+        plotname: save a plot of the normalised curves of growth here
+        
+    returns the correction to add to the small aperture magnitudes, its scatter,
+    the number of stars used and the median curve of growth (radii, flux/total flux)
+    """
+    if not os.access(image,os.F_OK):
+        raise IOError("Unable to access input image: %s"%(image))
+    if config is None:
+        config=photconfig.nicmos_config()
+        
+    if stars is None:
+        stars=aperphot.find_objects(image,backend="numpy",config=config)
+    elif isinstance(stars,str):
+        stars=daophotio.read_daophot(stars)
+        
+    data=fitsimage.getdata(image,("SCI",1))
+    corr,scatter,used,radii,curve=aperture_correction(data,stars["XCENTER"],stars["YCENTER"],
+        stars["MAG"],small=small,large=large,annulus=config.fitskypars.annulus,
+        dannulus=config.fitskypars.dannulus,nstars=nstars,isolation=isolation,nsigma=nsigma)
+    print("Aperture correction %.2f -> %.2f pixels: %.4f +/- %.4f mag from %i stars"%(
+          small,large,corr,scatter,used))
+    
+    if plotname:
+        plot_growth(radii,curve,image,plotname)
+    return corr,scatter,used,radii,curve
+    
+
+def aperture_correction(data,x,y,mag,small=4.,large=10.,annulus=None,dannulus=3.,nstars=50,
+                        isolation=None,nsigma=3.,step=0.5):
+    """
+    robust aperture correction from the isolated bright stars in a list of detections
+    
+    the stars with no neighbour within isolation and far enough from the edge are ranked by
+    magnitude and the brightest nstars kept. Their curves of growth are measured together with
+    nativephot.aperture_photometry on a grid of radii, the per star corrections
+    -2.5*log10(flux(large)/flux(small)) are clipped at nsigma around the median and the
+    median of the survivors is the correction, 1.4826*MAD the scatter
+    
+    returns the correction, its scatter, the number of stars used and the median
+    normalised curve of growth as (radii, curve)
+    """
+    x=np.asarray(x,dtype=np.float64)
+    y=np.asarray(y,dtype=np.float64)
+    mag=np.asarray(mag,dtype=np.float64)
+    if isolation is None:
+        isolation=2.*large
+    if annulus is None:
+        annulus=large+2.
+    ny,nx=data.shape
+    
+    #isolated stars, the nearest other detection is the second neighbour in the tree
+    if len(x) > 1:
+        dist,index=cKDTree(np.column_stack((x,y))).query(np.column_stack((x,y)),k=2)
+        isolated=dist[:,1] > isolation
+    else:
+        isolated=np.ones(len(x),dtype=bool)
+    edge=annulus+dannulus+1
+    inside=(x > edge) & (x < nx+1-edge) & (y > edge) & (y < ny+1-edge)
+    candidates=np.nonzero(isolated & inside & np.isfinite(mag))[0]
+    candidates=candidates[np.argsort(mag[candidates],kind="mergesort")][:nstars]
+    if len(candidates) == 0:
+        raise ValueError("No isolated stars to measure the aperture correction with")
+        
+    #the curves of growth of all the stars in one call
+    radii=np.union1d(np.arange(step,large+step/2.,step),[small,large])
+    phot=nativephot.aperture_photometry(data,x[candidates],y[candidates],radii,
+                                        annulus=annulus,dannulus=dannulus)
+    flux=phot["FLUX"]
+    ok=(phot["PIER"] == 0).all(axis=1) & (flux[:,radii == small][:,0] > 0) & (flux[:,radii == large][:,0] > 0)
+    flux=flux[ok]
+    if len(flux) == 0:
+        raise ValueError("No usable curves of growth for the aperture correction")
+        
+    fsmall=flux[:,np.nonzero(radii == small)[0][0]]
+    flarge=flux[:,np.nonzero(radii == large)[0][0]]
+    corr=-2.5*np.log10(flarge/fsmall)
+    
+    #iterative clipping around the median
+    keep=np.ones(len(corr),dtype=bool)
+    for iteration in range(10):
+        median=np.median(corr[keep])
+        scatter=1.4826*np.median(np.abs(corr[keep]-median))
+        newkeep=np.abs(corr-median) <= nsigma*scatter if scatter > 0 else keep
+        if (newkeep == keep).all():
+            break
+        keep=newkeep
+    else:
+        print("Warning: the clipping did not converge in %i iterations"%(iteration+1))
+        
+    #the correction and scatter of the stars finally kept
+    median=np.median(corr[keep])
+    scatter=1.4826*np.median(np.abs(corr[keep]-median))
+    curve=np.median(flux[keep]/flarge[keep][:,np.newaxis],axis=0)
+    return median,scatter,keep.sum(),radii,curve
+    
+
 def plot(magfile):
 
     rapert,flux = readaper(magfile)
+    plot_growth(rapert,flux,magfile,magfile+".pdf")
+    
+
+def plot_growth(rapert,flux,title,outfile,fwhm=None):
+    """plot the flux collected against radius and save it to outfile"""
     
+    import matplotlib.pyplot as plt
     plt.ioff() #turn off interactive so plots dont pop up 
     plt.figure(figsize=(8,10)) #this is in inches
     
@@ -116,10 +357,11 @@ def plot(magfile):
     plt.xlabel('radius')
     plt.ylabel('total flux')
     plt.plot(rapert,flux,'bx')
-    plt.title(magfile,{'fontsize':10})
+    plt.title(title,{'fontsize':10})
 
     plt.title("Total flux collected per aperture")
+    if fwhm is not None:
+        plt.text(0.6,0.1,"FWHM: %.2f pixels"%(fwhm),transform=plt.gca().transAxes)
         
-    outfile=magfile+".pdf"
     plt.savefig(outfile)
     print(("saved output figure to %s")%(outfile))
@@ -1,28 +1,26 @@
 #!/usr/bin/env python
 import os,sys
 
-#watch out for older versions of astropy without the format read fix
-from astropy.io import ascii
-from astropy import table
-
-import pyfits
-from pyraf import iraf
-from iraf import noao,digiphot,daophot,ptools
-
-
-#needed for daophot if no login.cl in current directory
-#you should probably run from a directory with login.cl
-#anyways if you are going to import iraf tasks
-
-from stsci import tools
-tools.irafglobals.userid='yoda'
+#pyraf, matplotlib and astropy.io.ascii are slow to start, they are imported
+#when they are first needed, see load_iraf(), plotphot() and plotfind()
  
 import numpy as np
 from glob import glob
+import time
+import traceback
+import threading
+import multiprocessing
 
-import matplotlib.pyplot as plt
 from optparse import OptionParser
 
+import nativephot
+import photconfig
+import daophotio
+import mosaic
+import fitsimage
+import runcache
+import stagetimer
+
 """
 	Megan Sosey, December 2012
 	Written as an example script to run aperture photometry on any given image
@@ -60,6 +58,24 @@ from optparse import OptionParser
 __version__ = "1.0 (2012 Jan 30)"
 __author__ = "Megan Sosey"
 
+#the photometry engines do_phot can use
+BACKENDS = ("iraf", "numpy")
+
+#the iraf parameter sets are global to the process, hold this lock while
+#setting them from a config and running the task that reads them
+IRAF_LOCK = threading.RLock()
+
+#the pyraf iraf module once load_iraf() has started it, None before
+iraf = None
+
+#runcache.StageCache for the find and phot outputs, stages whose pixels, parameters
+#and code did not change are read back from it instead of computed. None to always compute
+RUN_CACHE = None
+
+#stagetimer.StageTimer to record the time, memory and I/O of every stage of every image,
+#None to run the stages without timing them
+INSTRUMENT = None
+
 
 def message(something):
 	"""This is just for displayin simple, short messages that stickout """
@@ -71,7 +87,36 @@ def message(something):
 	print
 
 
-def run(image,aper="4.",sky=8., width=3., plots=False):
+def load_iraf():
+    """
+    start pyraf and load the daophot packages, the first time the iraf backend is used
+    
+    importing pyraf takes seconds, the numpy backend and the helpers never pay it.
+    returns the iraf module, which is also kept in the module global iraf
+    """
+    global iraf
+    with IRAF_LOCK:
+        if iraf is None:
+            from pyraf import iraf as pyraf_iraf
+            from iraf import noao,digiphot,daophot,ptools
+            
+            #needed for daophot if no login.cl in current directory
+            #you should probably run from a directory with login.cl
+            #anyways if you are going to import iraf tasks
+            from stsci import tools
+            tools.irafglobals.userid='yoda'
+            iraf=pyraf_iraf
+    return iraf
+
+
+def _stage(name, image=None, **info):
+    """the context timing one stage with INSTRUMENT, one that does nothing when it is None"""
+    if INSTRUMENT is None:
+        return stagetimer.NOT_TIMED
+    return INSTRUMENT.stage(name, image, **info)
+
+
+def run(image,aper="4.",sky=8., width=3., plots=False, backend="iraf", config=None, tilesize=None, workers=None):
     """
     Call this to perform all the following fucntions
     
@@ -81,236 +126,707 @@ def run(image,aper="4.",sky=8., width=3., plots=False):
         sky:    float, where to start the sky aperture
         width:  float, how wide should the sky annulus be
         plots:  bool, save plots of the results for quicklook
+        backend: string, "iraf" to run daophot.phot or "numpy" to measure
+                 the stars in process with the nativephot module
+        config: photconfig.PhotConfig, the parameters to use instead of the
+                NICMOS defaults, aper, sky and width are then ignored. The
+                gain and zeropoint are always taken from the image header
+        tilesize: int, with the numpy backend process large images in tiles of
+                  this size, using workers processes
         
+    returns the name of the phot file for the iraf backend, or the
+    photometry structured array for the numpy backend
+    
+    when INSTRUMENT is set every stage is timed, see stagetimer
         
     example:
     
     aperphot.run('myimage.fits',aper="2.")
+    aperphot.run('myimage.fits',aper="2.,4.",backend="numpy")
     
     """
     
     message("Setting up photometry for %s"%(image))
     
+    with _stage("run", image, backend=backend):
+        with _stage("calibration", image):
+            abzpt,epadu=calibration(image)
+
+
+        with _stage("config", image):
+            if config is None:
+                config=photconfig.nicmos_config(epadu, aper=aper, sky_annulus=sky, width_sky=width,
+                                                zeropoint=abzpt)
+            else:
+                config=photconfig.replace(config,"datapars",epadu=epadu)
+                config=photconfig.replace(config,"photpars",zmag=abzpt)
+        print "\t Using fwhmpsf: %f"%(config.datapars.fwhmpsf)
+        
+        with _stage("find_objects", image, backend=backend):
+            coord_list=find_objects(image, backend=backend, config=config, tilesize=tilesize, workers=workers)
+        
+        with _stage("do_phot", image, backend=backend):
+            photometry = do_phot(image, coord_list, backend=backend, config=config, tilesize=tilesize,
+                                 workers=workers)
+        
+        if plots:
+            with _stage("plotphot", image):
+                plotphot(photometry, image=image)
+    
+    return photometry
+    
+
+def _keyword(image, keyword, ext=0):
+    """a keyword calibration needs, KeyError naming the keyword and the file if it is missing"""
+    value=fitsimage.lookup(image,keyword,ext)
+    if value is None:
+        raise KeyError("%s not found in the header of %s[%s] or its primary header"%(keyword,image,ext))
+    return value
+
+
+def calibration(image, ext=0):
+    """
+    the AB zeropoint and effective gain of an image extension from its header
+    
+    each keyword is taken from the extension header when it has it, so chips with
+    their own PHOTFNU or ADCGAIN get their own values, otherwise from the primary
+    header. The headers are read once and shared by all the stages. A KeyError
+    names the keyword and the file when PHOTFNU, EXPTIME or ADCGAIN is missing
+    
+    returns zeropoint, epadu
+    """
     #make sure that we are using data we are prepared for, you can write other functions
     #to deal with this or help set alternate parameters. An ideal setup might involve a class structure
     #but we'll keep it more simple here
-    instrument=pyfits.getval(image,"INSTRUME")
+    instrument=fitsimage.lookup(image,"INSTRUME",ext,"")
     if "NICMOS" not in instrument:
         raise IOError("Program only valid for NICMOS images, check inputs") 
      
         
     #calculate the zeropoint from the header, these are set for NICMOS
     #you could make functions for different instruments here
-    photfnu=pyfits.getval(image,"PHOTFNU")
+    photfnu=_keyword(image,"PHOTFNU",ext)
     abzpt=-2.5* np.log10(photfnu*1.0*1e-23) -48.6
     
     print "zeropoint: %f"%(abzpt)
 
-	#calculate the effective gain for the image in NICMOS
-    exp=float(pyfits.getval(image,'EXPTIME'))
-    hgain=float(pyfits.getval(image,'ADCGAIN'))
+    #calculate the effective gain for the image in NICMOS
+    exp=float(_keyword(image,'EXPTIME',ext))
+    hgain=float(_keyword(image,'ADCGAIN',ext))
     epadu=hgain*exp # to get the errors better, nicmos is actually dn/s
 
     print "Setting effective gain = %f "%(epadu) #to make sure errors and chi are computed as best as possible
-
-
-    set_daopars(epadu)
+    return abzpt,epadu
+
+
+def _run_extension(args):
+    """find and measure the stars of one SCI extension for run_extensions, in a worker process"""
+    image,extver,backend,config,tilesize = args
+    print "Measuring %s[SCI,%i]"%(image,extver)
+    label="%s[SCI,%i]"%(image,extver)
+    mark=INSTRUMENT.mark() if INSTRUMENT is not None else 0
+    with _stage("calibration", label):
+        abzpt,epadu=calibration(image,("SCI",extver))
+    config=photconfig.replace(config,"datapars",epadu=epadu)
+    config=photconfig.replace(config,"photpars",zmag=abzpt)
+    if config.datapars.sigma <= 0 and fitsimage.open_image(image).has_extension(("ERR",extver)):
+        #the typical error of the pixels is the background noise for the finder
+        err=fitsimage.getdata(image,("ERR",extver))
+        err=err[np.isfinite(err) & (err > 0)]
+        if len(err):
+            config=photconfig.replace(config,"datapars",sigma=float(np.median(err)))
+    
+    with _stage("find_objects", label, backend=backend):
+        coord_list=find_objects(image, backend=backend, config=config, tilesize=tilesize, workers=1,
+                                extver=extver)
+    with _stage("do_phot", label, backend=backend):
+        photometry=do_phot(image, coord_list, backend=backend, config=config, tilesize=tilesize,
+                           workers=1, extver=extver)
+    if isinstance(photometry,str):
+        photometry=daophotio.read_daophot(photometry)
+    return extver,photometry,_events(mark)
+
+
+def _events(mark):
+    """the INSTRUMENT events recorded since mark, to send back from a worker process"""
+    if INSTRUMENT is None:
+        return []
+    return INSTRUMENT.events[mark:]
+
+
+def run_extensions(image,aper="4.",sky=8., width=3., backend="numpy", workers=None, config=None,
+                   tilesize=None):
+    """
+    find and measure the stars of every SCI extension of a multi-extension file at once
     
-    coord_list=find_objects(image)
+    each [SCI,n] is measured in its own worker process with the zeropoint and gain
+    from its own header when it has them, see calibration(). With the numpy backend
+    the matching [DQ,n] flags the bad pixels and the median of [ERR,n] is used as
+    the background noise for finding when the config does not set sigma
     
-    photometry = do_phot(image, coord_list, aper=aper, sky_annulus=sky, width_sky=width, zeropoint=abzpt)
+    Parameters
+        image:   string, name of the image
+        workers: int, number of worker processes, default is the number of cpus
+                 use 1 to run everything in this process
+        aper, sky, width, backend, config, tilesize as for run()
+        
+    returns one structured array with the photometry of all the extensions, the
+    first column EXTVER is the extension the star was measured on
+    
+    example:
+    
+    catalog=aperphot.run_extensions('mychips_flt.fits',aper="2.,4.",workers=4)
+    """
+    versions=fitsimage.extensions(image,"SCI")
+    if not versions:
+        raise IOError("No SCI extensions found in %s"%(image))
+    message("Photometry for %i SCI extensions of %s"%(len(versions),image))
+    
+    if config is None:
+        config=photconfig.nicmos_config(aper=aper, sky_annulus=sky, width_sky=width)
+    jobs=[(image,extver,backend,config,tilesize) for extver in versions]
+    results=dict()
+    if workers == 1 or len(jobs) == 1:
+        try:
+            for job in jobs:
+                extver,photometry,events=_run_extension(job)
+                results[extver]=photometry
+        finally:
+            fitsimage.close(image)
+    else:
+        pool=multiprocessing.Pool(processes=min(workers or multiprocessing.cpu_count(),len(jobs)),
+                                  initializer=fitsimage.reset)
+        try:
+            for extver,photometry,events in pool.imap_unordered(_run_extension,jobs):
+                print "Finished [SCI,%i]: %i stars"%(extver,len(photometry))
+                results[extver]=photometry
+                if INSTRUMENT is not None:
+                    INSTRUMENT.merge(events)
+        finally:
+            pool.close()
+            pool.join()
+    
+    return merge_extensions([(extver,results[extver]) for extver in versions])
+
+
+def merge_extensions(results):
+    """
+    stack the photometry arrays of several extensions into one catalog
+    
+    results is a list of (extver, photometry) pairs, the catalog has an EXTVER column
+    in front of the photometry columns. Columns which differ in type between the
+    extensions, like a float column which is integer in one of them, get the widest type
+    """
+    names=results[0][1].dtype.names
+    dtype=[("EXTVER",np.int32)]
+    for name in names:
+        base=np.result_type(*[photometry.dtype[name].base for extver,photometry in results])
+        shape=results[0][1].dtype[name].shape
+        dtype.append((name,base,shape) if shape else (name,base))
+        
+    catalog=np.zeros(sum(len(photometry) for extver,photometry in results),dtype=dtype)
+    start=0
+    for extver,photometry in results:
+        part=catalog[start:start+len(photometry)]
+        part["EXTVER"]=extver
+        for name in names:
+            part[name]=photometry[name]
+        start += len(photometry)
+    return catalog
+    
+
+def expand_images(images):
+    """
+    turn the batch input into a list of image names
     
-    if plots: plotphot(photometry)
+    images can be a glob pattern like "data/*_cal.fits", an IRAF style "@filelist"
+    with one name per line, or a list of names (which may be patterns themselves)
     
+    an input which matches no file is kept as it is with a warning, so the batch
+    reports it as failed in the summary instead of leaving it out
+    """
+    if isinstance(images,str):
+        if images.startswith("@"):
+            listfile=open(images[1:],'r')
+            images=[line.strip() for line in listfile if line.strip() and not line.startswith("#")]
+            listfile.close()
+        else:
+            images=[images]
+            
+    names=list()
+    for pattern in images:
+        found=sorted(glob(pattern))
+        if found:
+            names.extend(found)
+        else:
+            if not os.access(pattern,os.F_OK):
+                print "Warning: no input image found for %s"%(pattern)
+            names.append(pattern)
+    return names
+    
+
+def _run_one(args):
+    """
+    run the photometry on one image for run_batch, in a worker process
     
-def set_daopars(epadu):
+    errors are caught and reported in the result so one bad image does not stop the batch
+    """
+    image,aper,sky,width,plots,backend,config = args
+    start=time.time()
+    mark=INSTRUMENT.mark() if INSTRUMENT is not None else 0
+    if not os.access(image,os.R_OK):
+        print "Photometry failed for %s"%(image)
+        return (image,"failed",0,"",0.,"IOError: Unable to access input image"),_events(mark)
+    try:
+        photometry=run(image,aper=aper,sky=sky,width=width,plots=plots,backend=backend,config=config)
+        if isinstance(photometry,str):
+            output=photometry
+            nstars=_count_stars(photometry)
+        else:
+            #keep the numpy results next to their image like the .phot files
+            output=image + ".phot.npy"
+            np.save(output,photometry)
+            nstars=len(photometry)
+        return (image,"ok",nstars,output,time.time()-start,""),_events(mark)
+    except Exception as e:
+        print "Photometry failed for %s"%(image)
+        traceback.print_exc()
+        return (image,"failed",0,"",time.time()-start,"%s: %s"%(e.__class__.__name__,e)),_events(mark)
+    finally:
+        #a batch goes through many images, do not keep them all open
+        fitsimage.close(image)
+    
+
+def _count_stars(photfile):
+    """count the stars in a phot file, each one ends on a line without a continuation"""
+    nstars=0
+    infile=open(photfile,'r')
+    for line in infile:
+        if not line.startswith("#") and line.strip() and not line.rstrip().endswith("\\"):
+            nstars += 1
+    infile.close()
+    return nstars
+    
+
+def run_batch(images,aper="4.",sky=8., width=3., plots=False, backend="iraf", workers=None, summary=None,
+              config=None):
+    """
+    run the photometry on many images at once with a pool of worker processes
+    
+    Parameters
+        images:  string or list, a glob pattern, "@filelist" or list of image names
+        workers: int, number of worker processes, default is the number of cpus
+                 use 1 to run everything in this process
+        summary: string, name of a text file to save the summary table in
+        
+        aper, sky, width, plots, backend and config are passed to run() for each image
+        
+    every image goes through the find, phot and plot steps in its own worker,
+    the output files are named after each image so they do not collide.
+    An image that fails is reported in the summary and the rest carry on.
+    When INSTRUMENT is set the stage events of the workers are collected in it
+    and the time spent in each stage over the batch is printed at the end
+    
+    returns the summary as a structured array with the columns
+    IMAGE, STATUS, NSTARS, OUTPUT, TIME and ERROR, in the order of the input
+    
+    example:
+    
+    aperphot.run_batch('data/*_cal.fits',aper="2.,4.",backend="numpy",workers=4)
+    """
+    names=expand_images(images)
+    if not names:
+        raise IOError("No input images found for %s"%(images))
+        
+    message("Batch photometry for %i images"%(len(names)))
+    
+    jobs=[(name,aper,sky,width,plots,backend,config) for name in names]
+    results=dict()
+    if workers == 1:
+        for job in jobs:
+            results[job[0]]=_run_one(job)[0]
+    else:
+        pool=multiprocessing.Pool(processes=workers,initializer=fitsimage.reset)
+        try:
+            for result,events in pool.imap_unordered(_run_one,jobs):
+                print "Finished %s: %s"%(result[0],result[1])
+                results[result[0]]=result
+                if INSTRUMENT is not None:
+                    INSTRUMENT.merge(events)
+        finally:
+            pool.close()
+            pool.join()
+            
+    table=np.array([results[name] for name in names],
+                   dtype=[("IMAGE","S256"),("STATUS","S8"),("NSTARS",np.int32),
+                          ("OUTPUT","S256"),("TIME",np.float64),("ERROR","S256")])
+    
+    nfailed=(table["STATUS"] != "ok").sum()
+    print "%i images measured, %i failed"%(len(table)-nfailed,nfailed)
+    if INSTRUMENT is not None:
+        stagetimer.print_summary(stagetimer.summarize(INSTRUMENT.events))
+    
+    if summary:
+        write_summary(table,summary)
+    return table
+    
+
+def write_summary(table,filename):
+    """save the run_batch summary table as a text file"""
+    outfile=open(filename,'w')
+    outfile.write("#IMAGE STATUS NSTARS TIME OUTPUT ERROR\n")
+    for row in table:
+        outfile.write("%s %s %i %.2f %s \"%s\"\n"%(row["IMAGE"],row["STATUS"],row["NSTARS"],
+                      row["TIME"],row["OUTPUT"] or "-",row["ERROR"]))
+    outfile.close()
+    print "Saved batch summary to %s"%(filename)
+    
+    
+def set_daopars(epadu, config=None):
     """
     Set all the iraf parameter files for daophot
     
+    The values come from photconfig.nicmos_config(epadu) unless a config is given,
+    the config is returned. The stages below take the config explicitly and set the
+    parameters they need themselves, this is for using the daophot tasks by hand
     """
     instrument="NICMOS"
     #change this as necessary or setup a functional input for the important factors
-    fwhm = 3.5 
-    readnoise = 26.
+    if config is None:
+        config=photconfig.nicmos_config(epadu)
     
     print  "Setting DAOpars to %s defaults..."%(instrument)
-    print "\t Using fwhmpsf: %f"%(fwhm)
+    print "\t Using fwhmpsf: %f"%(config.datapars.fwhmpsf)
         
     #set up the data and phot parameters we want to use
     #I'm setting them all explicitly here, you could also
     #unlearn the parameter tasks to get the defaults and then 
     #hard set just a few
+    with _stage("set_daopars"):
+        with IRAF_LOCK:
+            set_iraf_pars(config)
+    return config
+
+
+def set_iraf_pars(config, sections=photconfig.PhotConfig._fields):
+    """
+    copy the config into the global iraf parameter sets
+    
+    hold IRAF_LOCK around this and the task which uses the parameters,
+    another thread could change them in between otherwise
+    """
+    load_iraf()
+    psets={"datapars":iraf.datapars,
+           "centerpars":iraf.centerpars,
+           "fitskypars":iraf.fitskypars,
+           "findpars":iraf.daophot.findpars,
+           "photpars":iraf.photpars,
+           "daopars":iraf.daophot.daopars}
+           
     iraf.daophot.phot.verbose="no"
     iraf.daophot.phot.interactive="no"
     iraf.daophot.phot.verify="no"
     
-    iraf.datapars.scale=1.
-    iraf.datapars.fwhmpsf=fwhm
-    iraf.datapars.emiss="yes"
-    iraf.datapars.sigma=0.
-    iraf.datapars.datamin=-0.001
-    iraf.datapars.datamax="INDEF"
-    iraf.datapars.noise="poisson"
-    iraf.datapars.ccdread=""
-    iraf.datapars.gain=""
-    iraf.datapars.readnoi=readnoise
-    iraf.datapars.epadu=epadu
-    iraf.datapars.airmass=""
-    iraf.datapars.filter="filter"
-    iraf.datapars.itime=1.
-
-    iraf.centerpars.calgo="centroid"
-    iraf.centerpars.cbox=7.
-    iraf.centerpars.cthres=0
-    iraf.centerpars.minsn=1.
-    iraf.centerpars.cmaxiter=10
-    iraf.centerpars.maxshift=1.
-    iraf.centerpars.clean="no"
-    iraf.centerpars.rclean=1.
-    iraf.centerpars.rclip=2.
-    iraf.centerpars.kclean=3.
-    iraf.centerpars.mkcenter="no"
-
-    iraf.daophot.daopars.function="auto"
-    iraf.daophot.daopars.varorder=1
-    iraf.daophot.daopars.nclean=0
-    iraf.daophot.daopars.sat="no"
-    iraf.daophot.daopars.matchrad=3.
-    iraf.daophot.daopars.psfrad=15
-    iraf.daophot.daopars.fitrad=3.4
-    iraf.daophot.daopars.recenter="yes"
-    iraf.daophot.daopars.fitsky="yes"
-    iraf.daophot.daopars.groups="yes"
-    iraf.daophot.daopars.sannu=8
-    iraf.daophot.daopars.wsann=15.
-    iraf.daophot.daopars.flaterr=0.75
-    iraf.daophot.daopars.proferr=2.5
-    iraf.daophot.daopars.maxiter=50
-    iraf.daophot.daopars.clipexp=4
-    iraf.daophot.daopars.clipra=2.5
-    iraf.daophot.daopars.mergerad="INDEF"
-    iraf.daophot.daopars.critsn=1.
-    iraf.daophot.daopars.maxgroup=30
-    iraf.daophot.daopars.text="yes"
-
-
-def find_objects(inputImage):
+    for section in sections:
+        pars=getattr(config,section)
+        for name,value in zip(pars._fields,pars):
+            if value is None:
+                value="INDEF"
+            setattr(psets[section],name,value)
+
+
+def find_objects(inputImage, backend="iraf", save=False, config=None, tilesize=None, workers=None,
+                 extver=1):
     """
     Find the objects in the field
     use DAOfind 
+    
+    backend="numpy" finds the stars in memory with nativephot.find_stars and
+    returns the structured array of detections, the .stars file is only written
+    if save is True. The iraf backend always writes the file and returns its name
+
+    with the numpy backend and a tilesize, large images are cut into tiles of that
+    size which are searched by workers processes, see mosaic.find_stars_tiled
+    
+    extver is the SCI extension to search, the output of the others is named
+    inputImage.sci<extver>.stars
+    
+    the datapars and findpars are taken from config, the NICMOS defaults
+    from photconfig.nicmos_config are used if it is not given
     """
+    if config is None:
+        config=photconfig.nicmos_config()
+    if backend not in BACKENDS:
+        raise ValueError("Unknown photometry backend %s, use one of %s"%(backend,BACKENDS))
 
-    output_locations= inputImage  + ".stars" #best to set this if you're scripting
+    output_locations= inputImage + _extension_suffix(extver) + ".stars" #best to set this if you're scripting
     
-    #check if a file already exists and remove it
-    if os.access(output_locations,os.F_OK):
+    #check if a file already exists and remove it, unless the numpy backend is not going to write it
+    if (backend == "iraf" or save) and os.access(output_locations,os.F_OK):
         print "Removing previous star location file"
         os.remove(output_locations)
         
-    
-    #set up some finding parameters, you can make this more explicit
-    iraf.daophot.findpars.threshold=3.0 #3sigma detections only
-    iraf.daophot.findpars.nsigma=1.5 #width of convolution kernal in sigma
-    iraf.daophot.findpars.ratio=1.0 #ratio of gaussian axes
-    iraf.daophot.findpars.theta=0.
-    iraf.daophot.findpars.sharplo=0.2 #lower bound on feature
-    iraf.daophot.findpars.sharphi=1.0 #upper bound on feature
-    iraf.daophot.findpars.roundlo=-1.0 #lower bound on roundness
-    iraf.daophot.findpars.roundhi=1.0 #upper bound on roundness
-    iraf.daophot.findpars.mkdetections="no"
-    
-    #assume the science extension
-    sci="[SCI,1]"
+    sci="[SCI,%i]"%(extver)
     message(inputImage + sci)
-    iraf.daofind(image=inputImage+sci,output=output_locations,interactive="no",verify="no",verbose="no")
+    
+    key=None
+    if RUN_CACHE is not None:
+        key=_stage_key("find",inputImage,extver,backend,config,("datapars","findpars"))
+    
+    if backend == "numpy":
+        stars=RUN_CACHE.load_array(key) if key else None
+        if stars is not None:
+            print "Using the cached detections"
+        elif tilesize:
+            stars=mosaic.find_stars_tiled(inputImage,tilesize=tilesize,workers=workers,ext=("SCI",extver),
+                                          **photconfig.find_kwargs(config))
+        else:
+            data=fitsimage.getdata(inputImage,("SCI",extver))
+            stars=nativephot.find_stars(data, **photconfig.find_kwargs(config))
+        if key:
+            RUN_CACHE.save_array(key,stars)
+        print "Found %i objects"%(len(stars))
+        if save:
+            nativephot.write_stars(stars,output_locations)
+            print "Saved output locations to %s"%(output_locations)
+        return stars
+    
+    if key and RUN_CACHE.load_file(key,output_locations):
+        print "Using the cached detections"
+        return output_locations
+        
+    #set up the finding parameters from the config and run daofind while nobody else can change them
+    load_iraf()
+    with IRAF_LOCK:
+        set_iraf_pars(config,("datapars","findpars"))
+        iraf.daofind(image=inputImage+sci,output=output_locations,interactive="no",verify="no",verbose="no")
+    if key:
+        RUN_CACHE.save_file(key,output_locations)
 
     print "Saved output locations to %s"%(output_locations)
     
     return output_locations #return the name of the saved file
     
-def do_phot(inputImage, coord_list, aper="4.", sky_annulus=8., width_sky=3.,zeropoint=25.):
+def do_phot(inputImage, coord_list, aper=None, sky_annulus=None, width_sky=None,zeropoint=None,
+            backend="iraf", config=None, tilesize=None, workers=None, extver=1):
     """
     perform aperture photmoetry on the input image at the specified locations
     
     **aper is a string so that you can call phot with multiple apertures**
+    
+    the parameters are taken from config, the NICMOS defaults from
+    photconfig.nicmos_config are used if it is not given. aper, sky_annulus,
+    width_sky and zeropoint override the config values when they are set
+    
+    backend="iraf" runs daophot.phot and returns the name of the .phot file,
+    backend="numpy" measures the stars in process and returns the results as a
+    structured array with the phot columns, see nativephot.aperture_photometry
+    with a tilesize the stars are shared out to workers processes by the tile
+    they are in, see mosaic.photometry_tiled
+    
+    extver is the SCI extension to measure, the numpy backend leaves out the
+    pixels flagged in the matching DQ extension when there is one
     """
-    print "\t Phot aperture: %s pixels"%(aper)
+    if backend not in BACKENDS:
+        raise ValueError("Unknown photometry backend %s, use one of %s"%(backend,BACKENDS))
+        
+    if config is None:
+        config=photconfig.nicmos_config()
+    if aper is not None:
+        config=photconfig.replace(config,"photpars",apertures=str(aper))
+    if zeropoint is not None:
+        config=photconfig.replace(config,"photpars",zmag=zeropoint)
+    if sky_annulus is not None:
+        config=photconfig.replace(config,"fitskypars",annulus=sky_annulus)
+    if width_sky is not None:
+        config=photconfig.replace(config,"fitskypars",dannulus=width_sky)
+    sky_annulus=config.fitskypars.annulus
+    width_sky=config.fitskypars.dannulus
+        
+    print "\t Phot aperture: %s pixels"%(config.photpars.apertures)
     print "\t Sky Annulus: %i -> %i pixels"%(sky_annulus,sky_annulus+width_sky)
 
-    output = inputImage+ ".phot" #can be anything you like
+    if backend == "numpy":
+        if isinstance(coord_list,str):
+            x,y=nativephot.read_coords(coord_list)
+        else:
+            x,y=coord_list["XCENTER"],coord_list["YCENTER"]
+        dq=("DQ",extver)
+        if not fitsimage.open_image(inputImage).has_extension(dq):
+            dq=None
+        key=None
+        if RUN_CACHE is not None:
+            key=_stage_key("phot",inputImage,extver,backend,config,
+                           ("datapars","centerpars","fitskypars","photpars"),
+                           runcache.array_digest(x,y),
+                           runcache.pixel_digest(inputImage,dq) if dq else "nodq")
+        photometry=RUN_CACHE.load_array(key) if key else None
+        if photometry is not None:
+            print "\t Using the cached photometry"
+        elif tilesize:
+            photometry=mosaic.photometry_tiled(inputImage, x, y, tilesize=tilesize, workers=workers,
+                                               ext=("SCI",extver), mask=dq, **photconfig.phot_kwargs(config))
+        else:
+            #the same science extension the iraf task uses
+            data=fitsimage.getdata(inputImage,("SCI",extver))
+            mask=fitsimage.getdata(inputImage,dq) if dq else None
+            photometry=nativephot.aperture_photometry(data, x, y, mask=mask,
+                                                      **photconfig.phot_kwargs(config))
+        if key:
+            RUN_CACHE.save_array(key,photometry)
+        print "\t Measured %i stars"%(len(photometry))
+        return photometry
+
+    output = inputImage + _extension_suffix(extver) + ".phot" #can be anything you like
     if os.access(output,os.F_OK):
         print  "Removing previous photometry file" 
         os.remove(output)
     print "\t Saving output files as %s"%(output)
 
-    iraf.photpars.weighting="constant"
-    iraf.photpars.aperture=aper
-    iraf.photpars.zmag=zeropoint
-    iraf.photpars.mkapert="no"
+    key=None
+    if RUN_CACHE is not None:
+        key=_stage_key("phot",inputImage,extver,backend,config,
+                       ("datapars","centerpars","fitskypars","photpars"),
+                       runcache.file_digest(coord_list),os.path.abspath(coord_list))
+        if RUN_CACHE.load_file(key,output):
+            print "\t Using the cached photometry"
+            return output
+            
+    inputImage =inputImage + "[SCI,%i]"%(extver)
+    
+    #everything phot reads is set from the config while we hold the lock
+    load_iraf()
+    with IRAF_LOCK:
+        set_iraf_pars(config,("datapars","centerpars","fitskypars","photpars"))
+        iraf.phot.coords=coord_list
+        iraf.phot.output=output
+        iraf.daophot.phot.radplots="no"
+        
+        iraf.daophot.phot(inputImage,coords=coord_list,verbose="no",verify="no",interactive="no") 
+    if key:
+        RUN_CACHE.save_file(key,output)
+    return output
 
-    iraf.daophot.phot.interactive="no"
-    iraf.daophot.phot.verify="no"
-    iraf.daophot.phot.verbose="no"
-    
-    iraf.fitskypars.salgo="centroid"
-    iraf.fitskypars.annu=sky_annulus
-    iraf.fitskypars.dannu=width_sky
-    iraf.fitskypars.skyval=0
-    iraf.fitskypars.smaxi=10
-    iraf.fitskypars.sloc=0
-    iraf.fitskypars.shic=0
-    iraf.fitskypars.snrej=50
-    iraf.fitskypars.slorej=3.
-    iraf.fitskypars.shirej=3.
-    iraf.fitskypars.khist=3
-    iraf.fitskypars.binsi=0.1
-
-    inputImage =inputImage + "[SCI,1]" #assumed, might be risky
-    iraf.phot.coords=coord_list
-    iraf.phot.output=output
-    iraf.daophot.phot.verify="no"
-    iraf.daophot.phot.interactive="no"
-    iraf.daophot.phot.radplots="no"
+
+def do_psfphot(inputImage, photometry, psfImage, config=None, workers=None, extver=1, subtract=True):
+    """
+    fit the PSF to the stars measured by do_phot, in process with psfphot
+
+    photometry is the do_phot output, the structured array of the numpy backend
+    or the name of the .phot file, the stars are fitted from its centers and sky.
+    psfImage is the PSF image, like ../data/psf.fits
+
+    the daopars of the config set the fit (psfrad, fitrad, recenter, fitsky,
+    maxiter, maxgroup), the NICMOS defaults from photconfig.nicmos_config are
+    used if it is not given. The overlapping stars are fitted together in groups,
+    which are shared out to workers processes
+
+    with subtract the fitted stars are taken out of the image and the result is
+    saved as inputImage + "1.sub.1.fits" for the first SCI extension, the name the
+    daophot substar task gives it
+
+    returns the fit results as a structured array, see psfphot.psf_photometry
+    """
+    import psfphot
     
-    iraf.daophot.phot(inputImage,coords=coord_list,verbose="no",verify="no",interactive="no") 
-    return output
+    if config is None:
+        config=photconfig.nicmos_config()
+    if isinstance(photometry,str):
+        photometry=daophotio.read_daophot(photometry)
+    sky=photometry["MSKY"]
+
+    print "\t PSF: %s, fitting radius %s pixels"%(psfImage,config.daopars.fitrad)
+
+    dq=("DQ",extver)
+    if not fitsimage.open_image(inputImage).has_extension(dq):
+        dq=None
+    fit=psfphot.psf_photometry(inputImage, photometry["XCENTER"], photometry["YCENTER"], psfImage,
+                               sky=np.where(np.isfinite(sky),sky,0.), workers=workers,
+                               ext=("SCI",extver), mask=dq, **photconfig.psf_kwargs(config))
+    print "\t Fitted %i stars in %i groups"%(len(fit),len(np.unique(fit["GROUP"])))
 
+    if subtract:
+        output=inputImage + "%i.sub.1.fits"%(extver)
+        residual=psfphot.subtract_stars(inputImage, fit, psfImage, config.daopars.psfrad,
+                                        ext=("SCI",extver))
+        psfphot.write_residual(output, residual, fitsimage.getheader(inputImage,("SCI",extver)))
+        print "\t Saved the subtracted image as %s"%(output)
+    return fit
 
-def plotphot(photdata,ftype="pdf"):
+
+#the function each RUN_CACHE stage runs, its code is part of the stage key
+STAGE_FUNCTIONS={"find":find_objects,"phot":do_phot}
+
+
+def _stage_key(stage, image, extver, backend, config, sections, *inputs):
     """
-    neato phot plots from the output files
-    use the astropy library to read the input files
-    make sure you have astropy0.2 or later installed or it might fail to read correctly
+    the RUN_CACHE key of a stage: the SCI pixels, the parameter sets the stage reads,
+    its other inputs and the code version. The code version is the source of the
+    stage function and of the functions of this module and photconfig it calls, and
+    for the numpy backend of the nativephot and mosaic functions which measure, see
+    runcache.function_digest. The IRAF tasks write the image and coordinate file
+    names into their output, so those are part of the iraf keys
     """
-    print photdata
-    outfile=photdata + "." + ftype
+    modules=[sys.modules[__name__],photconfig]
+    if backend == "numpy":
+        modules += [nativephot,mosaic]
+    parts=[runcache.pixel_digest(image,("SCI",extver)),runcache.config_digest(config,sections),
+           backend,runcache.function_digest([STAGE_FUNCTIONS[stage]],modules)]
+    if backend != "numpy":
+        parts.append(os.path.abspath(image))
+    return RUN_CACHE.key(stage,*(parts+list(inputs)))
 
-    #read the ascii table into an astropy.table
-    reader=ascii.Daophot()
-    photfile = reader.read(photdata)
-    
 
-    #remove the points that had issues
-    noerror=np.where(photfile[:]['PERROR'] == 'NoError')
-    goodphot=photfile[noerror[0][:]]
-    indef=np.where(goodphot["MAG"] != "INDEF")
-    phot=goodphot[indef[0][:]]
+def _extension_suffix(extver):
+    """the extra part of the output names for the SCI extensions after the first"""
+    if extver == 1:
+        return ""
+    return ".sci%i"%(extver)
 
 
+def plotphot(photdata,ftype="pdf",image=None):
+    """
+    neato phot plots from the output files
+    the files are read with daophotio.read_daophot into the same arrays the
+    numpy backend returns, the first aperture is plotted
+    
+    photdata can also be the structured array returned by the numpy backend,
+    then image is the name of the image that was measured
+    """
+    if isinstance(photdata,str):
+        name=photdata
+        photfile=daophotio.read_daophot(photdata)
+        if image is None:
+            image=photfile["IMAGE"][0].split("[")[0]#assume all from 1 image, and remove extension (careful here)
+    else:
+        if image is None:
+            raise ValueError("The image name is needed to plot photometry arrays")
+        name=image + ".phot"
+        photfile=photdata
+        
+    #remove the points that had issues, INDEF magnitudes are NaN in the arrays
+    good=(photfile["PERROR"][:,0] == "NoError") & np.isfinite(photfile["MAG"][:,0])
+    phot=photfile[good]
+    
+    mag=phot["MAG"][:,0]
+    merr=phot["MERR"][:,0]
+    imname=image
+        
+    print name
+    outfile=name + "." + ftype
 
+
+    import matplotlib.pyplot as plt
     plt.ioff() #turn off interactive so plots dont pop up 
     plt.figure(figsize=(8,10)) #this is in inches
     
-    
-    mag=phot["MAG"].astype(np.float)
-    merr=phot["MERR"].astype(np.float)
 
     #mag vs merr
     plt.subplot(221)
     plt.xlabel('MAG')
     plt.ylabel('MERR')
     plt.plot(mag,merr,'bx')
-    plt.title(photdata,{'fontsize':10})
+    plt.title(name,{'fontsize':10})
 
     #magnitude histogram
     plt.subplot(222)
@@ -335,15 +851,19 @@ def plotphot(photdata,ftype="pdf"):
     #a quick reference plot of the image and starlocations
     x=phot["XCENTER"].astype(np.float)
     y=phot["YCENTER"].astype(np.float)
-    imname=phot["IMAGE"][0].split("[")[0]#assume all from 1 image, and remove extension (careful here)
-    image=pyfits.getdata(imname)    
+    #only read every step pixel of the memory mapped image, enough for the plot
+    #and it keeps large mosaics out of memory
+    image=fitsimage.getdata(imname)
+    ny,nx=image.shape
+    step=max(1,max(ny,nx)//2048)
+    image=np.array(image[::step,::step],dtype=np.float)
     plt.subplot(224)
     plt.xlabel('X')
     plt.ylabel('Y')
     plt.plot(x,y,'ko',mfc="None")
     zero=np.where(image <= 0)
     image[zero]=0.999
-    plt.imshow(np.log10(image),cmap=plt.cm.gray)
+    plt.imshow(np.log10(image),cmap=plt.cm.gray,extent=(-0.5,nx-0.5,ny-0.5,-0.5))
     plt.title('Total Non-error Stars: %i'%(len(phot)),{'fontsize':10})
     
     plt.tight_layout()
@@ -359,6 +879,10 @@ def plotfind(findata,ftype="pdf"):
 
     outfile=findata+"."+ftype
 
+    #watch out for older versions of astropy without the format read fix
+    from astropy.io import ascii
+    import matplotlib.pyplot as plt
+    
     #read the ascii table into an astropy.table
     reader=ascii.Daophot()
     photfile = reader.read(findata)
@@ -420,7 +944,7 @@ if __name__ == "__main__":  #this tells the os what to do if you called the scri
     parser = OptionParser(usage=usage)
 
     parser.add_option("-i","--input",dest="inputImage",default="none",type="string",
-	    help="The input image to do phot on",metavar="INPUTLIST")
+	    help="The input image to do phot on, a glob pattern or @filelist runs a batch",metavar="INPUTLIST")
 
     parser.add_option("-a", "--aper",dest="aper",default="4.",type="string",
         help="What aperture to do the photometry at (or string sep comma list of apers)")
@@ -434,16 +958,58 @@ if __name__ == "__main__":  #this tells the os what to do if you called the scri
     parser.add_option("-p","--plots",dest="plots",default=False,action="store_true",
 	    help="Save plots describing the resulting photometry")
 
+    parser.add_option("-b","--backend",dest="backend",default="iraf",type="choice",
+        choices=list(BACKENDS),help="Photometry engine to use, iraf or numpy")
+
+    parser.add_option("-n","--workers",dest="workers",default=None,type="int",
+        help="Number of worker processes for a batch or the tiles, default is the number of cpus")
+
+    parser.add_option("-t","--tilesize",dest="tilesize",default=None,type="int",
+        help="Process a large image in tiles of this many pixels, numpy backend only")
+
+    parser.add_option("-c","--cache",dest="cache",default=None,type="string",
+        help="Directory to cache the stage outputs in, unchanged stages are not run again")
+
+    parser.add_option("-e","--extensions",dest="extensions",default=False,action="store_true",
+        help="Measure every SCI extension of the image and save the merged catalog")
+
+    parser.add_option("-o","--summary",dest="summary",default="aperphot_summary.txt",type="string",
+        help="Name of the summary table file for a batch")
+
+    parser.add_option("--timing",dest="timing",default=None,type="string",
+        help="Time every stage and append the events as JSON lines to this file")
+
+    parser.add_option("--profile",dest="profile",default=None,type="string",
+        help="Run this stage under cProfile, e.g. do_phot, with --timing")
 
 
     (options, args)  = parser.parse_args()
 
+    if options.cache:
+        RUN_CACHE=runcache.StageCache(options.cache)
+    if options.timing or options.profile:
+        INSTRUMENT=stagetimer.StageTimer(options.timing,profile=options.profile)
+
 
-    if(not(os.access(options.inputImage,os.F_OK))):
-	    print "Unable to access input Image: ",options.inImage
+    images=expand_images(options.inputImage)
+    batch=len(images) > 1 or options.inputImage.startswith("@")
+    if not images or not (batch or os.access(images[0],os.R_OK)):
+	    print "Unable to access input Image: ",options.inputImage
 	    sys.exit(0)
 
-    run(options.inputImage,options.aper,options.skyannulus,options.skywidth,options.plots)
+    if batch:
+        run_batch(images,options.aper,options.skyannulus,options.skywidth,options.plots,options.backend,
+                  workers=options.workers,summary=options.summary)
+    elif options.extensions:
+        catalog=run_extensions(images[0],options.aper,options.skyannulus,options.skywidth,options.backend,
+                               workers=options.workers,tilesize=options.tilesize)
+        np.save(images[0] + ".phot.npy",catalog)
+        print "Saved the merged catalog of %i stars to %s"%(len(catalog),images[0] + ".phot.npy")
+    else:
+        run(images[0],options.aper,options.skyannulus,options.skywidth,options.plots,options.backend,
+            tilesize=options.tilesize,workers=options.workers)
+    if INSTRUMENT is not None and not batch:
+        stagetimer.print_summary(stagetimer.summarize(INSTRUMENT.events))
     print "\nPhotometry is awesome.\n\n"
 	
 		
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+"""
+    Timing benchmarks of the photometry, matching and parsing paths
+
+    Every run builds the same synthetic inputs from a fixed random seed:
+    NICMOS-like images (SCI extension, INSTRUME, PHOTFNU, EXPTIME and ADCGAIN
+    in the header) with gaussian stars or stars made from a PSF image like
+    data/psf.fits on a noisy sky, star lists shifted from each other, and
+    daophot .phot and VOTable files. Each stage is then timed on a sweep of
+    sizes, image stages over the image sizes with the star density kept the
+    same, list and parsing stages over the numbers of sources.
+
+    The timings are saved as JSON, one entry per stage and size with the best
+    and median of the repeats, and can be compared with a saved baseline: the
+    stages slower than the baseline by more than the tolerance are listed and
+    the script exits with status 1, so it can guard a change.
+
+    The stages whose modules cannot be imported here (pyraf for apercor, the
+    astropy version for conesearch...) are recorded as skipped with the reason.
+
+    example:
+
+    python benchmark.py -o before.json
+    #change something
+    python benchmark.py -o after.json -b before.json
+    python benchmark.py --full -s match,read_daophot -o sweep.json
+
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from optparse import OptionParser
+
+import numpy as np
+
+import pyfits
+
+import nativephot
+import daophotio
+import fitsimage
+import match
+
+#the default sweep is quick, --full runs the whole range
+SOURCES = (100, 1000, 10000, 100000)
+SIZES = (256, 1024, 2048)
+FULL_SOURCES = (100, 1000, 10000, 100000, 1000000)
+FULL_SIZES = (256, 1024, 2048, 4096, 8192)
+
+DENSITY = 0.002 #stars per pixel in the images
+SEED = 1234
+SKY = 20. #counts per pixel
+GAIN = 5.4
+READNOISE = 26.
+FWHM = 3.5
+
+
+def _optional(name):
+    """import a module for the stages that need it, the reason it failed otherwise"""
+    try:
+        return __import__(name), None
+    except Exception as error:
+        return None, "%s: %s" % (name, error)
+
+
+def synthetic_image(size, nstars, psf=None, fwhm=FWHM, sky=SKY, seed=SEED):
+    """
+    a square image with stars on a sky with poisson and read noise
+
+    Parameters
+        size:   int, image side in pixels
+        nstars: int, the number of stars
+        psf:    the PSF image, a FITS file name or an array, gaussian stars of
+                the given fwhm if None
+        sky:    float, the sky level in counts
+
+    returns the image and the x, y (IRAF, 1-based) and flux of the stars
+    """
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(0.5, size + 0.5, nstars)
+    y = rng.uniform(0.5, size + 0.5, nstars)
+    #a power law of fluxes, many faint stars and a few bright ones
+    flux = 200. * (1. - rng.uniform(0., 0.999, nstars))**-1.5
+
+    if psf is None:
+        sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+        half = int(np.ceil(4 * sigma))
+        profile = lambda dx, dy: np.exp(-(dx**2 + dy**2) / (2 * sigma**2)) / (2 * np.pi * sigma**2)
+    else:
+        import psfphot
+        spline = psfphot.psf_spline(psfphot.read_psf(psf))
+        half = (min(spline.shape) - 1) // 2
+        profile = lambda dx, dy: psfphot.psf_value(spline, dx, dy, half)
+
+    data = np.zeros((size, size))
+    box = np.arange(-half, half + 1)
+    dy, dx = np.meshgrid(box, box, indexing="ij")
+    for start in range(0, nstars, nativephot.CHUNKSIZE):
+        chunk = slice(start, start + nativephot.CHUNKSIZE)
+        cols = np.floor(x[chunk] + 0.5).astype(np.intp)[:, np.newaxis] + dx.ravel()
+        rows = np.floor(y[chunk] + 0.5).astype(np.intp)[:, np.newaxis] + dy.ravel()
+        values = flux[chunk, np.newaxis] * profile(cols - x[chunk, np.newaxis],
+                                                   rows - y[chunk, np.newaxis])
+        inside = (cols >= 1) & (cols <= size) & (rows >= 1) & (rows <= size)
+        np.add.at(data, (rows[inside] - 1, cols[inside] - 1), values[inside])
+
+    data += sky
+    data += rng.normal(0., 1., data.shape) * np.sqrt(np.maximum(data, 0.) / GAIN +
+                                                     (READNOISE / GAIN)**2)
+    return data.astype(np.float32), x, y, flux
+
+
+def write_image(filename, data):
+    """save an image with the NICMOS keywords aperphot reads, the pixels in [SCI,1]"""
+    primary = pyfits.PrimaryHDU()
+    primary.header["INSTRUME"] = "NICMOS"
+    primary.header["PHOTFNU"] = 1.49585e-06
+    primary.header["EXPTIME"] = 1.
+    primary.header["ADCGAIN"] = GAIN
+    sci = pyfits.ImageHDU(data)
+    sci.header["EXTNAME"] = "SCI"
+    sci.header["EXTVER"] = 1
+    pyfits.HDUList([primary, sci]).writeto(filename, clobber=True)
+
+
+def synthetic_lists(nsources, seed=SEED):
+    """two star lists of the same field, the second shifted and with 10% of the stars missing"""
+    rng = np.random.RandomState(seed)
+    side = np.sqrt(nsources / DENSITY)
+    x1 = rng.uniform(0., side, nsources)
+    y1 = rng.uniform(0., side, nsources)
+    keep = rng.uniform(size=nsources) < 0.9
+    x2 = x1[keep] + 0.3 + rng.normal(0., 0.05, keep.sum())
+    y2 = y1[keep] - 0.2 + rng.normal(0., 0.05, keep.sum())
+    return x1, y1, x2, y2
+
+
+#the columns of a phot record, one line each, the last one repeated for every aperture
+PHOT_GROUPS = (
+    (("IMAGE", "imagename", "%-23s"), ("XINIT", "pixels", "%-10.3f"),
+     ("YINIT", "pixels", "%-10.3f"), ("ID", "##", "%-6d"),
+     ("COORDS", "filename", "%-23s"), ("LID", "##", "%-6d")),
+    (("XCENTER", "pixels", "%-14.3f"), ("YCENTER", "pixels", "%-11.3f"),
+     ("XSHIFT", "pixels", "%-8.3f"), ("YSHIFT", "pixels", "%-8.3f"),
+     ("XERR", "pixels", "%-8.3f"), ("YERR", "pixels", "%-15.3f"),
+     ("CIER", "##", "%-5d"), ("CERROR", "cerrors", "%-9s")),
+    (("MSKY", "counts", "%-18.7g"), ("STDEV", "counts", "%-15.7g"),
+     ("SSKEW", "counts", "%-15.7g"), ("NSKY", "npix", "%-7d"),
+     ("NSREJ", "npix", "%-9d"), ("SIER", "##", "%-5d"), ("SERROR", "serrors", "%-9s")),
+    (("ITIME", "timeunit", "%-18.7g"), ("XAIRMASS", "number", "%-15.7g"),
+     ("IFILTER", "name", "%-23s"), ("OTIME", "timeunit", "%-23s")),
+    (("RAPERT", "scale", "%-12.2f"), ("SUM", "counts", "%-14.7g"),
+     ("AREA", "pixels", "%-11.7g"), ("FLUX", "counts", "%-14.7g"),
+     ("MAG", "mag", "%-7.3f"), ("MERR", "mag", "%-6.3f"),
+     ("PIER", "##", "%-5d"), ("PERROR", "perrors", "%-9s")))
+
+
+def _format(fmt, value):
+    """one value in a printf format, None is INDEF"""
+    if value is None:
+        return "%-9s" % ("INDEF")
+    return fmt % (value)
+
+
+def write_phot(filename, nstars, apertures=(4.,), seed=SEED):
+    """a daophot .phot file with random values in the layout phot writes"""
+    rng = np.random.RandomState(seed)
+    outfile = open(filename, "w")
+    keywords = (("IRAF", "NOAO/IRAFV2.16", "version", "%-23s"),
+                ("TASK", "phot", "name", "%-23s"),
+                ("APERTURES", ",".join("%g" % radius for radius in apertures), "scaleunit", "%-23s"))
+    #NAME = value units format, the last column is the printf format iraf
+    #gives for the value and is written as text
+    for name, value, units, fmt in keywords:
+        outfile.write("#K %-10s = %-23s %-10s %-23s\n" % (name, value, units, fmt))
+    for group in PHOT_GROUPS:
+        outfile.write("#\n")
+        for kind, column, end in (("#N ", 0, " \\\n"), ("#U ", 1, " \\\n"), ("#F ", 2, "\n")):
+            outfile.write(kind + "".join("%-12s" % (col[column]) for col in group) + end)
+
+    x = rng.uniform(1., 1024., nstars)
+    y = rng.uniform(1., 1024., nstars)
+    sky = rng.normal(SKY, 1., nstars)
+    for i in range(nstars):
+        records = [("bench.fits[1]", x[i], y[i], i + 1, "bench.coo", i + 1),
+                   (x[i], y[i], 0., 0., 0.01, 0.01, 0, "NoError"),
+                   (sky[i], 1., 0., 100, 2, 0, "NoError"),
+                   (1., None, "F160W", None)]
+        for radius in apertures:
+            flux = 1000. * (1. - np.exp(-radius / 2.))
+            area = np.pi * radius**2
+            records.append((radius, flux + area * sky[i], area, flux,
+                            25. - 2.5 * np.log10(flux), 0.01, 0, "NoError"))
+        lines = ["  ".join(_format(fmt, value) for (name, units, fmt), value
+                           in zip(PHOT_GROUPS[min(k, len(PHOT_GROUPS) - 1)], record))
+                 for k, record in enumerate(records)]
+        #with several apertures every aperture line ends with a *
+        ends = [" \\"] * (len(PHOT_GROUPS) - 1) + ["*\\"] * (len(apertures) - 1)
+        ends.append("*" if len(apertures) > 1 else " ")
+        outfile.write("\n".join(line + end for line, end in zip(lines, ends)) + "\n")
+    outfile.close()
+
+
+def write_votable(filename, nsources, seed=SEED):
+    """a cone search style VOTable with id, ra, dec and mag columns"""
+    from astropy.io.votable.tree import VOTableFile, Resource, Table, Field
+    rng = np.random.RandomState(seed)
+    votable = VOTableFile()
+    resource = Resource()
+    votable.resources.append(resource)
+    table = Table(votable)
+    resource.tables.append(table)
+    table.fields.extend([
+        Field(votable, name="id", datatype="int", ucd="meta.id;meta.main"),
+        Field(votable, name="ra", datatype="double", unit="deg", ucd="pos.eq.ra;meta.main"),
+        Field(votable, name="dec", datatype="double", unit="deg", ucd="pos.eq.dec;meta.main"),
+        Field(votable, name="mag", datatype="float", unit="mag")])
+    table.create_arrays(nsources)
+    table.array["id"] = np.arange(nsources)
+    table.array["ra"] = rng.uniform(10., 11., nsources)
+    table.array["dec"] = rng.uniform(-1., 0., nsources)
+    table.array["mag"] = rng.uniform(15., 25., nsources)
+    votable.to_xml(filename)
+
+
+def _image_fixture(workdir, size, psf):
+    """the image of a size, written once per run"""
+    filename = os.path.join(workdir, "bench%i.fits" % (size))
+    if not os.access(filename, os.F_OK):
+        data, x, y, flux = synthetic_image(size, int(DENSITY * size * size), psf)
+        write_image(filename, data)
+        np.save(filename + ".xy.npy", np.column_stack((x, y)))
+    return filename, np.load(filename + ".xy.npy")
+
+
+def stage_find(workdir, size, psf):
+    filename = _image_fixture(workdir, size, psf)[0]
+    data = np.asarray(fitsimage.getdata(filename, ("SCI", 1)), dtype=np.float64)
+    return lambda: nativephot.find_stars(data, fwhm=FWHM)
+
+
+def stage_do_phot(workdir, size, psf):
+    aperphot, reason = _optional("aperphot")
+    if aperphot is None:
+        raise ImportError(reason)
+    import photconfig
+    filename, xy = _image_fixture(workdir, size, psf)
+    stars = np.zeros(len(xy), dtype=[("XCENTER", np.float64), ("YCENTER", np.float64)])
+    stars["XCENTER"] = xy[:, 0]
+    stars["YCENTER"] = xy[:, 1]
+    config = photconfig.nicmos_config(GAIN, aper="3,4,6")
+    return lambda: aperphot.do_phot(filename, stars, backend="numpy", config=config)
+
+
+def stage_match(workdir, nsources, psf):
+    x1, y1, x2, y2 = synthetic_lists(nsources)
+    return lambda: match.match(x1, y1, x2, y2, 1., asarray=True)
+
+
+def stage_read_daophot(workdir, nsources, psf):
+    filename = os.path.join(workdir, "bench%i.phot" % (nsources))
+    if not os.access(filename, os.F_OK):
+        write_phot(filename, nsources)
+    return lambda: daophotio.read_daophot(filename, cache=False)
+
+
+def stage_readaper(workdir, nsources, psf):
+    apercor, reason = _optional("apercor")
+    if apercor is None:
+        raise ImportError(reason)
+    #one star measured in many apertures, as apercor writes it
+    filename = os.path.join(workdir, "aper%i.phot" % (nsources))
+    if not os.access(filename, os.F_OK):
+        write_phot(filename, 1, apertures=np.linspace(0.5, 0.5 * nsources, nsources))
+
+    def run():
+        #time the parse, not the binary cache of an earlier repeat
+        if os.access(daophotio.cache_name(filename), os.F_OK):
+            os.remove(daophotio.cache_name(filename))
+        apercor.readaper(filename)
+    return run
+
+
+def stage_vo_tab_parse(workdir, nsources, psf):
+    conesearch, reason = _optional("conesearch")
+    if conesearch is None:
+        raise ImportError(reason)
+    from astropy.io.votable import parse
+    filename = os.path.join(workdir, "bench%i.xml" % (nsources))
+    if not os.access(filename, os.F_OK):
+        write_votable(filename, nsources)
+    return lambda: conesearch.vo_tab_parse(parse(filename), "file://" + filename, {})
+
+
+#stage name: (what it is swept over, the setup returning the function to time)
+STAGES = OrderedDict([("find", ("size", stage_find)),
+                      ("do_phot", ("size", stage_do_phot)),
+                      ("match", ("sources", stage_match)),
+                      ("read_daophot", ("sources", stage_read_daophot)),
+                      ("readaper", ("sources", stage_readaper)),
+                      ("vo_tab_parse", ("sources", stage_vo_tab_parse))])
+
+#readaper sweeps the number of apertures of one star, keep it sensible
+MAXAPERTURES = 10000
+
+
+def time_stage(function, repeat=3):
+    """the wall clock times of repeat calls of function"""
+    times = list()
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return times
+
+
+def run_benchmarks(stages=None, sources=SOURCES, sizes=SIZES, repeat=3, psf=None,
+                   workdir=None):
+    """
+    time the stages over the sweep
+
+    Parameters
+        stages:  list of stage names, all of STAGES if None
+        sources: the numbers of sources for the list and parsing stages
+        sizes:   the image sides in pixels for the image stages
+        repeat:  int, how many times each case is timed
+        psf:     the PSF image for the stars of the images, gaussian if None
+        workdir: string, where the inputs are written, a temporary directory
+                 removed at the end if None
+
+    returns the report dictionary saved by save_report
+    """
+    stages = list(stages or STAGES)
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix="benchmark")
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    results = list()
+    try:
+        for name in stages:
+            sweep, setup = STAGES[name]
+            for n in (sizes if sweep == "size" else sources):
+                if name == "readaper" and n > MAXAPERTURES:
+                    continue
+                entry = OrderedDict([("stage", name), (sweep, n)])
+                try:
+                    function = setup(workdir, n, psf)
+                    times = time_stage(function, repeat)
+                except ImportError as error:
+                    entry["skipped"] = str(error)
+                    print("%-14s %8i  skipped, %s" % (name, n, error))
+                    results.append(entry)
+                    break
+                except Exception as error:
+                    traceback.print_exc()
+                    entry["error"] = str(error)
+                    results.append(entry)
+                    continue
+                entry["best"] = min(times)
+                entry["median"] = float(np.median(times))
+                entry["repeat"] = repeat
+                print("%-14s %8i  best %9.4f s  median %9.4f s" % (name, n, entry["best"],
+                                                                   entry["median"]))
+                results.append(entry)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return OrderedDict([("date", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                        ("machine", platform.node()),
+                        ("platform", platform.platform()),
+                        ("python", platform.python_version()),
+                        ("numpy", np.__version__),
+                        ("cpus", multiprocessing.cpu_count()),
+                        ("seed", SEED),
+                        ("results", results)])
+
+
+def save_report(report, filename):
+    """save the timings as JSON"""
+    outfile = open(filename, "w")
+    json.dump(report, outfile, indent=1)
+    outfile.write("\n")
+    outfile.close()
+    print("Saved the timings to %s" % (filename))
+
+
+def load_report(filename):
+    """read back a report saved by save_report"""
+    infile = open(filename, "r")
+    report = json.load(infile)
+    infile.close()
+    return report
+
+
+def _case(entry):
+    """the stage and size of a result entry"""
+    return (entry["stage"], entry.get("size", entry.get("sources")))
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    compare the best times of two reports
+
+    prints the ratio of every case timed in both, and returns the list of
+    (stage, size, ratio) of the cases slower than the baseline by more than
+    tolerance (0.2 is 20%)
+    """
+    before = dict((_case(entry), entry) for entry in baseline["results"] if "best" in entry)
+    slower = list()
+    print("%-14s %8s %10s %10s %7s" % ("stage", "size", "baseline", "now", "ratio"))
+    for entry in report["results"]:
+        old = before.get(_case(entry))
+        if old is None or "best" not in entry:
+            continue
+        ratio = entry["best"] / max(old["best"], 1e-9)
+        flag = ""
+        if ratio > 1. + tolerance:
+            flag = "  SLOWER"
+            slower.append(_case(entry) + (ratio,))
+        print("%-14s %8i %10.4f %10.4f %7.2f%s" % (_case(entry) + (old["best"], entry["best"],
+                                                                    ratio, flag)))
+    if baseline.get("machine") != report.get("machine"):
+        print("The baseline was timed on %s, the ratios compare different machines"
+              % (baseline.get("machine")))
+    return slower
+
+
+def _ints(text):
+    return tuple(int(float(value)) for value in text.split(","))
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("-s", "--stages", dest="stages", default=None, type="string",
+        help="Comma separated stages to time, from %s" % (",".join(STAGES)))
+
+    parser.add_option("--sources", dest="sources", default=None, type="string",
+        help="Comma separated numbers of sources for the list and parsing stages")
+
+    parser.add_option("--sizes", dest="sizes", default=None, type="string",
+        help="Comma separated image sizes in pixels for the image stages")
+
+    parser.add_option("--full", dest="full", default=False, action="store_true",
+        help="Sweep 1e2 to 1e6 sources and 256 to 8192 pixel images")
+
+    parser.add_option("-r", "--repeat", dest="repeat", default=3, type="int",
+        help="Number of times each case is timed")
+
+    parser.add_option("-p", "--psf", dest="psf", default=None, type="string",
+        help="PSF image for the stars of the images, like ../data/psf.fits, default gaussian")
+
+    parser.add_option("-w", "--workdir", dest="workdir", default=None, type="string",
+        help="Directory to keep the generated inputs in, default a temporary one")
+
+    parser.add_option("-o", "--output", dest="output", default="benchmark.json", type="string",
+        help="File to save the timings in")
+
+    parser.add_option("-b", "--baseline", dest="baseline", default=None, type="string",
+        help="Timings saved earlier to compare with")
+
+    parser.add_option("-t", "--tolerance", dest="tolerance", default=0.2, type="float",
+        help="Allowed slow down from the baseline, 0.2 is 20%")
+
+    (options, args) = parser.parse_args()
+
+    sources = FULL_SOURCES if options.full else SOURCES
+    sizes = FULL_SIZES if options.full else SIZES
+    if options.sources:
+        sources = _ints(options.sources)
+    if options.sizes:
+        sizes = _ints(options.sizes)
+    stages = options.stages.split(",") if options.stages else None
+    for name in stages or []:
+        if name not in STAGES:
+            parser.error("Unknown stage %s, use some of %s" % (name, ",".join(STAGES)))
+
+    report = run_benchmarks(stages, sources, sizes, options.repeat, options.psf, options.workdir)
+    save_report(report, options.output)
+
+    if options.baseline:
+        slower = compare(report, load_report(options.baseline), options.tolerance)
+        if slower:
+            print("%i cases are slower than the baseline" % (len(slower)))
+            sys.exit(1)
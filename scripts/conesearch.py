@@ -6,8 +6,24 @@ Common utilities for accessing VO simple services.
 from __future__ import print_function, division
 
 # STDLIB
+import io
+import os
 import json
+import hashlib
+import tempfile
+import time
+import socket
 import urllib
+import urllib2
+import httplib
+import urlparse
+import threading
+import Queue
+from collections import namedtuple
+from xml.etree import cElementTree
+
+# THIRD-PARTY
+import numpy as np
 
 # ASTROPY
 
@@ -18,26 +34,180 @@ from astropy.utils.data import get_readable_fileobj
 
 VO_PEDANTIC = table.PEDANTIC()
 
+# `ResponseCache` used by `vo_service_request` and `vo_service_requests`,
+# no caching if `None`.
+VO_CACHE = None
+
 
 class VOSError(Exception):  # pragma: no cover
     pass
 
-def vo_service_request(url,  **kwargs):
+
+class VOSEmptyResult(VOSError):
+    """Server returned no rows for a query with a non-zero SR."""
+    pass
+
+
+class _TransientError(Exception):
+    """Server reply worth retrying, e.g. HTTP 503."""
+    pass
+
+
+def _query_url(url, kwargs):
+    """
+    Full query URL, with the parameters in sorted order so the
+    same query always gives the same URL.
+
+    """
     if len(kwargs) and not (url.endswith('?') or url.endswith('&')):
         raise VOSError("url should already end with '?' or '&'")
 
     query = []
-    for key, value in kwargs.iteritems():
+    for key, value in sorted(kwargs.iteritems()):
         query.append('{}={}'.format(
             urllib.quote(key), urllib.quote_plus(str(value))))
 
-    parsed_url = url + '&'.join(query)
+    return url + '&'.join(query)
+
+
+def _normalize_url(parsed_url):
+    """Lower case scheme and host, which do not change the query."""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(parsed_url)
+    return urlparse.urlunsplit((scheme.lower(), netloc.lower(), path, query, ''))
+
+
+class ResponseCache(object):
+    """
+    Persistent on-disk cache of VO service responses.
+
+    Each successfully parsed response is stored as a VOTable file in
+    the compact BINARY serialization, named by a hash of the normalised
+    query URL (which already has the parameters in sorted order).
+    Entries older than `ttl` are ignored and removed, and when the
+    total size goes over `maxsize` the least recently used entries are
+    removed first. Only responses that passed `vo_tab_parse` are
+    stored, so server error stubs are never cached.
+
+    Parameters
+    ----------
+    directory : string
+        Where to keep the cached responses, made if needed.
+
+    ttl : float
+        Lifetime of an entry in seconds.
+
+    maxsize : int
+        Largest total size of the cache in bytes.
+
+    Examples
+    --------
+    >>> conesearch.VO_CACHE = conesearch.ResponseCache('vo_cache')
+    >>> tab = conesearch.vo_service_request(url, RA=ra, DEC=dec, SR=0.1)
+    >>> conesearch.VO_CACHE.stats()
+
+    """
+    def __init__(self, directory, ttl=7 * 86400., maxsize=500 * 1024 ** 2):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, parsed_url):
+        key = hashlib.sha1(_normalize_url(parsed_url).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.vot')
+
+    def get(self, parsed_url):
+        """
+        Cached `astropy.io.votable.tree.VOTableFile` for the query URL,
+        or `None` if there is no fresh entry.
+
+        """
+        path = self._path(parsed_url)
+        try:
+            written = os.path.getmtime(path)
+            if time.time() - written > self.ttl:
+                os.remove(path)
+                raise OSError('expired')
+            # the access time records the last use for the LRU eviction,
+            # the modification time stays the time it was written
+            os.utime(path, (time.time(), written))
+            tab = table.parse(path, pedantic=False)
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return tab
+
+    def put(self, parsed_url, tab):
+        """Store the parsed response `tab` for the query URL."""
+        path = self._path(parsed_url)
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                tab.to_xml(fileobj, tabledata_format='binary')
+            os.rename(tmpname, path)
+        except:
+            os.remove(tmpname)
+            raise
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries over `maxsize`."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.vot'):
+                    continue
+                try:
+                    info = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((info.st_atime, info.st_size, name))
+            total = sum(entry[1] for entry in entries)
+            for atime, size, name in sorted(entries):
+                if total <= self.maxsize:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        """Remove all entries."""
+        for name in os.listdir(self.directory):
+            if name.endswith('.vot'):
+                os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        """Dictionary with the hit and miss counts."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def vo_service_request(url,  **kwargs):
+    parsed_url = _query_url(url, kwargs)
+    cache = VO_CACHE
+    if cache is not None:
+        tab = cache.get(parsed_url)
+        if tab is not None:
+            return vo_tab_parse(tab, url, kwargs)
+
     with get_readable_fileobj(parsed_url) as req:
         tab = table.parse(req, filename=parsed_url, pedantic=False)
         #outfile = open('test.dat','wb')
         #outfile.write(req.read())
         #outfile.close()
-    return vo_tab_parse(tab, url, kwargs)
+    out_tab = vo_tab_parse(tab, url, kwargs)
+    if cache is not None:
+        cache.put(parsed_url, tab)
+    return out_tab
 
 def vo_tab_parse(tab, url, kwargs):
     """
@@ -96,8 +266,661 @@ def vo_tab_parse(tab, url, kwargs):
         sr = kwargs.get(kw_sr[0])
 
     if sr != 0 and out_tab.array.size <= 0:
-        raise VOSError("Catalog server '{0}' returned {1} result".format(
+        raise VOSEmptyResult("Catalog server '{0}' returned {1} result".format(
             url, out_tab.array.size))
 
     out_tab.url = url  # Track the URL
-    return out_tab
\ No newline at end of file
+    return out_tab
+
+
+# numpy types of the VOTable datatypes, the others are kept as text
+_VO_DTYPES = {'boolean': np.bool_, 'unsignedByte': np.uint8,
+              'short': np.int16, 'int': np.int32, 'long': np.int64,
+              'float': np.float32, 'double': np.float64,
+              'char': np.str_, 'unicodeChar': np.unicode_}
+
+
+def vo_service_stream(url, columns=None, chunksize=10000, timeout=60.,
+                      **kwargs):
+    """
+    Like `vo_service_request`, but decode the first table of the
+    response straight into a numpy structured array while it is
+    being read from the socket, without building the VOTable tree.
+
+    Parameters
+    ----------
+    url : string
+        Service URL ending in '?' or '&'.
+
+    columns : list of string or `None`
+        Names (or IDs) of the FIELDs to decode, all if `None`.
+
+    chunksize : int
+        Number of rows converted at a time.
+
+    timeout : float
+        Socket timeout in seconds.
+
+    kwargs : dict
+        Query parameters, e.g. RA, DEC and SR.
+
+    Returns
+    -------
+    array : `numpy.ndarray`
+        Structured array with one field per requested column.
+
+    Raises
+    ------
+    VOSError
+        Server returns an error or the response cannot be streamed.
+
+    """
+    parsed_url = _query_url(url, kwargs)
+    response = urllib2.urlopen(parsed_url, timeout=timeout)
+    try:
+        return vo_stream_parse(response, url, kwargs, columns=columns,
+                               chunksize=chunksize)
+    finally:
+        response.close()
+
+
+def vo_stream_parse(fileobj, url, kwargs, columns=None, chunksize=10000):
+    """
+    Decode the first TABLEDATA table of the VOTable in `fileobj`
+    into a numpy structured array, reading it incrementally.
+
+    The checks of `vo_tab_parse` are done as the elements arrive, so
+    an error PARAM or a QUERY_STATUS INFO that is not 'OK' raises
+    before any data is read. Finished rows are converted `chunksize`
+    at a time and dropped from the XML tree, the reading stops at the
+    end of the first table.
+
+    Parameters
+    ----------
+    fileobj : file-like object
+        Open VOTable file or HTTP response.
+
+    url : string
+        URL used to obtain `fileobj`.
+
+    kwargs : dict
+        Keywords used to obtain `fileobj`, if any.
+
+    columns : list of string or `None`
+        Names (or IDs) of the FIELDs to decode, all if `None`.
+
+    chunksize : int
+        Number of rows converted at a time.
+
+    Returns
+    -------
+    array : `numpy.ndarray`
+
+    Raises
+    ------
+    IndexError
+        There is no table.
+
+    VOSError
+        Server returns error message, or the table is not TABLEDATA.
+
+    """
+    fields = []
+    selected = None
+    rows = []
+    chunks = []
+    parents = []
+    seen_resource = False
+    tabledata = None
+
+    for event, elem in cElementTree.iterparse(fileobj, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            parents.append(tag)
+            if tag == 'RESOURCE':
+                seen_resource = True
+            elif tag == 'TABLEDATA':
+                tabledata = elem
+                selected = _stream_columns(fields, columns)
+            elif tag in ('BINARY', 'BINARY2', 'FITS'):
+                raise VOSError("Catalog server '{0}' returned a {1} table, "
+                               "only TABLEDATA can be streamed, use "
+                               "vo_service_request".format(url, tag))
+            continue
+
+        parents.pop()
+        parent = parents[-1] if parents else None
+        if tag == 'PARAM' and elem.get('ID', '').lower() == 'error':
+            raise VOSError("Catalog server '{0}' returned error '{1}'".format(
+                url, elem.get('value')))
+        elif (tag == 'INFO' and parent in ('RESOURCE', 'VOTABLE') and
+              elem.get('name') == 'QUERY_STATUS' and
+              elem.get('value') != 'OK'):
+            if elem.text is not None and elem.text.strip():
+                long_descr = ':\n{0}'.format(elem.text)
+            else:
+                long_descr = ''
+            raise VOSError("Catalog server '{0}' returned status "
+                           "'{1}'{2}".format(url, elem.get('value'), long_descr))
+        elif tag == 'FIELD' and parent == 'TABLE':
+            fields.append(elem.attrib.copy())
+        elif tag == 'TR' and tabledata is not None:
+            cells = [td.text or '' for td in elem]
+            rows.append([cells[i] if i < len(cells) else ''
+                         for i, name, dtype, shape in selected])
+            if len(rows) >= chunksize:
+                chunks.append(_stream_chunk(rows, selected))
+                rows = []
+                # the finished rows are not needed any more
+                tabledata.clear()
+        elif tag == 'TABLE':
+            break
+
+    if not seen_resource:
+        vo_raise(E19)
+    if selected is None:
+        if not fields:
+            raise IndexError("No table found")
+        selected = _stream_columns(fields, columns)
+    if rows or not chunks:
+        chunks.append(_stream_chunk(rows, selected))
+
+    # an integer column is promoted to float by empty cells in some chunks
+    # only, use the widest type for the whole table
+    dtype = []
+    for name in chunks[0].dtype.names:
+        base = np.result_type(*[chunk.dtype[name].base for chunk in chunks])
+        shape = chunks[0].dtype[name].shape
+        dtype.append((name, base, shape) if shape else (name, base))
+    array = np.concatenate([chunk.astype(dtype) for chunk in chunks])
+
+    kw_sr = [k for k in kwargs if 'sr' == k.lower()]
+    if len(kw_sr) == 0:
+        sr = 0
+    else:
+        sr = kwargs.get(kw_sr[0])
+
+    if sr != 0 and array.size <= 0:
+        raise VOSEmptyResult("Catalog server '{0}' returned {1} result".format(
+            url, array.size))
+
+    return array
+
+
+def _stream_columns(fields, columns):
+    """(index, name, dtype, shape) of the FIELDs to decode."""
+    selected = []
+    for i, field in enumerate(fields):
+        name = field.get('name') or field.get('ID')
+        if columns is not None and not (name in columns or
+                                        field.get('ID') in columns):
+            continue
+        datatype = field.get('datatype')
+        arraysize = field.get('arraysize', '1')
+        dtype = _VO_DTYPES.get(datatype, np.str_)
+        shape = ()
+        if dtype not in (np.str_, np.unicode_) and arraysize != '1':
+            if arraysize.isdigit():
+                shape = (int(arraysize),)
+            else:
+                # variable length arrays stay text
+                dtype = np.str_
+        selected.append((i, name, dtype, shape))
+
+    if columns is not None:
+        found = set()
+        for i, name, dtype, shape in selected:
+            found.update((name, fields[i].get('ID')))
+        missing = [c for c in columns if c not in found]
+        if missing:
+            raise ValueError("No such column(s): {0}".format(', '.join(missing)))
+    return selected
+
+
+def _stream_chunk(rows, selected):
+    """turn a list of rows of TD strings into a structured array"""
+    values = list(zip(*rows)) if rows else [()] * len(selected)
+    arrays = [_stream_column(list(column), dtype, shape)
+              for column, (i, name, dtype, shape) in zip(values, selected)]
+    out = np.zeros(len(rows), dtype=[(name, array.dtype, shape)
+                                     for array, (i, name, dtype, shape)
+                                     in zip(arrays, selected)])
+    for array, (i, name, dtype, shape) in zip(arrays, selected):
+        out[name] = array
+    return out
+
+
+def _stream_column(values, dtype, shape):
+    """convert the TD strings of a column, empty numbers become NaN"""
+    if dtype is np.str_:
+        try:
+            return np.array(values, dtype='S')
+        except UnicodeEncodeError:
+            return np.array(values, dtype='U')
+    if dtype is np.unicode_:
+        return np.array(values, dtype='U')
+    if dtype is np.bool_:
+        return np.array([value.strip()[:1] in ('T', 't', '1')
+                         for value in values], dtype=np.bool_)
+
+    # numpy parses a whole column from one string much faster than value by value
+    text = ' '.join(value.strip() or 'nan' for value in values)
+    if np.dtype(dtype).kind in 'iu' and 'nan' in text.lower():
+        dtype = np.float64
+    array = np.fromstring(text, dtype=dtype, sep=' ')
+    size = len(values) * (shape[0] if shape else 1)
+    if array.size != size:
+        raise VOSError("Unable to convert the column values to {0}".format(
+            np.dtype(dtype).name))
+    return array.reshape((len(values),) + shape)
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP connections shared between requests.
+
+    Idle connections are kept per (scheme, host) and handed out again,
+    so a batch of queries to the same server does not open a new
+    connection (and TCP/TLS handshake) for each one. Safe to use from
+    several threads.
+
+    Parameters
+    ----------
+    maxsize : int
+        Idle connections kept per host.
+
+    timeout : float
+        Socket timeout in seconds.
+
+    """
+    def __init__(self, maxsize=8, timeout=60.):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _put(self, scheme, netloc, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url):
+        """
+        GET `url` and read the whole reply.
+
+        Returns
+        -------
+        status, reason, body : int, string, bytes
+
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path = '{0}?{1}'.format(path or '/', query)
+        conn = self._get(scheme, netloc)
+        try:
+            conn.request('GET', path or '/')
+            response = conn.getresponse()
+            body = response.read()
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(scheme, netloc, conn)
+        return response.status, response.reason, body
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+
+def _fetch_table(pool, url, kwargs, retries=2, backoff=0.5, cache=None):
+    """
+    Query one service through `pool` and parse the reply like
+    `vo_service_request`, retrying on connection errors and 5xx
+    replies with exponential backoff.
+
+    """
+    parsed_url = _query_url(url, kwargs)
+    if cache is not None:
+        tab = cache.get(parsed_url)
+        if tab is not None:
+            return vo_tab_parse(tab, url, kwargs)
+
+    for attempt in range(retries + 1):
+        try:
+            status, reason, body = pool.request(parsed_url)
+            if status >= 500 or status == 429:
+                raise _TransientError('HTTP {0} {1}'.format(status, reason))
+            if status != 200:
+                raise VOSError("Catalog server '{0}' returned HTTP {1} "
+                               "{2}".format(url, status, reason))
+            break
+        except (socket.error, httplib.HTTPException, _TransientError) as e:
+            if attempt == retries:
+                raise VOSError("Catalog server '{0}' failed after {1} "
+                               "attempts: {2}".format(url, attempt + 1, e))
+            time.sleep(backoff * 2 ** attempt)
+
+    tab = table.parse(io.BytesIO(body), filename=parsed_url, pedantic=False)
+    out_tab = vo_tab_parse(tab, url, kwargs)
+    if cache is not None:
+        cache.put(parsed_url, tab)
+    return out_tab
+
+
+def vo_service_requests(queries, workers=4, retries=2, backoff=0.5,
+                        timeout=60., pool=None, cache=None):
+    """
+    Run many VO service queries concurrently.
+
+    The queries are shared out to `workers` threads which reuse
+    keep-alive connections from a `ConnectionPool`, and the results
+    are yielded as each query finishes, not in input order. Closing
+    the generator early drops the queries not started and waits for
+    the running ones, so the pool can be closed right after.
+
+    Parameters
+    ----------
+    queries : list of (url, kwargs) tuples
+        Same meaning as the arguments of `vo_service_request`.
+
+    workers : int
+        Number of queries running at the same time.
+
+    retries : int
+        Extra attempts for connection errors and HTTP 5xx replies.
+
+    backoff : float
+        Seconds to wait before the first retry, doubled each time.
+
+    timeout : float
+        Socket timeout in seconds, if a new pool is made.
+
+    pool : `ConnectionPool` or `None`
+        Connections to reuse, a new pool is made and closed if `None`.
+
+    cache : `ResponseCache` or `None`
+        Response cache to use, `VO_CACHE` if `None`.
+
+    Yields
+    ------
+    index, result
+        Position of the query in `queries` and either its
+        `astropy.io.votable.tree.Table` or the exception it raised
+        (usually `VOSError`), so one failed query does not stop the rest.
+
+    Examples
+    --------
+    >>> queries = [(url, dict(RA=ra, DEC=dec, SR=0.1)) for ra, dec in centers]
+    >>> for i, tab in vo_service_requests(queries, workers=8):
+    ...     if isinstance(tab, Exception):
+    ...         print(i, tab)
+
+    """
+    queries = list(queries)
+    if cache is None:
+        cache = VO_CACHE
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool(maxsize=workers, timeout=timeout)
+
+    jobs = Queue.Queue()
+    for job in enumerate(queries):
+        jobs.put(job)
+    results = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                index, (url, kwargs) = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = _fetch_table(pool, url, kwargs, retries=retries,
+                                      backoff=backoff, cache=cache)
+            except Exception as e:
+                result = e
+            results.put((index, result))
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(workers, len(queries)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for i in range(len(queries)):
+            yield results.get()
+    finally:
+        # stop handing out queries if the caller stopped early, and
+        # wait for the ones running, the pool may be closed next
+        try:
+            while True:
+                jobs.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in threads:
+            thread.join()
+        if own_pool:
+            pool.close()
+
+
+# `SkyTile` is a cone covering one RA/Dec cell of a region, the cell is
+# `ra0` <= RA < `ra0` + `rawidth`, `dec0` <= Dec < `dec1`
+SkyTile = namedtuple('SkyTile', ['ra', 'dec', 'sr', 'ra0', 'rawidth', 'dec0', 'dec1'])
+
+
+def _angdist(ra1, dec1, ra2, dec2):
+    """Angular distance in degrees, all angles in degrees."""
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    h = (np.sin((dec2 - dec1) / 2) ** 2 +
+         np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.minimum(h, 1.))))
+
+
+def _cell_tile(ra0, rawidth, dec0, dec1):
+    """Smallest cone centred on the cell that covers all of it."""
+    ra = (ra0 + rawidth / 2.) % 360.
+    dec = (dec0 + dec1) / 2.
+    # the farthest points of the cell are its corners
+    sr = max(_angdist(ra, dec, ra0, dec0), _angdist(ra, dec, ra0, dec1),
+             _angdist(ra, dec, ra0 + rawidth, dec0),
+             _angdist(ra, dec, ra0 + rawidth, dec1))
+    return SkyTile(ra, dec, float(sr), ra0, rawidth, dec0, dec1)
+
+
+def sky_tiles(ra_min, ra_max, dec_min, dec_max, max_sr):
+    """
+    Cover an RA/Dec box with cones no larger than `max_sr`.
+
+    The box is cut into Dec bands and each band into RA cells of about
+    the same size on the sky, the cells share no area and each cone
+    is the smallest one around its cell. All angles are in degrees,
+    the box goes through RA=0 when `ra_min` > `ra_max`, and (0, 360)
+    is the whole circle.
+
+    Returns
+    -------
+    tiles : list of `SkyTile`
+
+    """
+    if not -90 <= dec_min < dec_max <= 90:
+        raise ValueError('Need -90 <= dec_min < dec_max <= 90')
+    rawidth = (ra_max - ra_min) % 360. or 360.
+    # a square cell of side h has a radius of h/sqrt(2)
+    nband = int(np.ceil((dec_max - dec_min) / (max_sr * np.sqrt(2))))
+    height = (dec_max - dec_min) / nband
+
+    tiles = []
+    for band in range(nband):
+        dec0 = dec_min + band * height
+        dec1 = dec_max if band == nband - 1 else dec0 + height
+        # the widest parallel of the band sets the number of cells
+        widest = 0. if dec0 < 0 < dec1 else min(abs(dec0), abs(dec1))
+        ncell = max(1, int(np.ceil(rawidth * np.cos(np.radians(widest)) / height)))
+        while True:
+            width = rawidth / ncell
+            band_tiles = [_cell_tile(ra_min + i * width, width, dec0, dec1)
+                          for i in range(ncell)]
+            if max(tile.sr for tile in band_tiles) <= max_sr or width < 1e-6:
+                break
+            ncell += 1
+        tiles.extend(band_tiles)
+    return tiles
+
+
+def _split_tile(tile):
+    """The four cones covering the quarters of the cell of `tile`."""
+    width = tile.rawidth / 2.
+    decmid = (tile.dec0 + tile.dec1) / 2.
+    return [_cell_tile(tile.ra0 + i * width, width, dec0, dec1)
+            for i in range(2)
+            for dec0, dec1 in ((tile.dec0, decmid), (decmid, tile.dec1))]
+
+
+def _in_cell(tile, ra, dec, region):
+    """Which of the positions `tile` owns, cells on the far edges of the
+    region are closed so that the edges are not lost."""
+    ra_min, rawidth, dec_max = region
+    offset = (ra - tile.ra0) % 360.
+    cell_end = (tile.ra0 - ra_min) % 360. + tile.rawidth
+    if rawidth < 360. and abs(cell_end - rawidth) < 1e-9:
+        in_ra = offset <= tile.rawidth
+    else:
+        in_ra = offset < tile.rawidth
+    if tile.dec1 == dec_max:
+        in_dec = (dec >= tile.dec0) & (dec <= tile.dec1)
+    else:
+        in_dec = (dec >= tile.dec0) & (dec < tile.dec1)
+    return in_ra & in_dec
+
+
+def _radec_columns(tab, ra_col, dec_col):
+    """Names of the main RA and Dec fields of a table."""
+    if ra_col is None or dec_col is None:
+        for field in tab.fields:
+            ucd = (field.ucd or '').lower()
+            if ra_col is None and ucd in ('pos.eq.ra;meta.main', 'pos_eq_ra_main'):
+                ra_col = field.ID or field.name
+            elif dec_col is None and ucd in ('pos.eq.dec;meta.main',
+                                             'pos_eq_dec_main'):
+                dec_col = field.ID or field.name
+    if ra_col is None or dec_col is None:
+        raise VOSError("Unable to find the RA/Dec columns of the table from "
+                       "'{0}', give ra_col and dec_col".format(tab.url))
+    return ra_col, dec_col
+
+
+def vo_region_search(url, ra_min, ra_max, dec_min, dec_max, max_sr=0.5,
+                     maxrec=None, min_sr=1. / 3600, ra_col=None, dec_col=None,
+                     workers=4, retries=2, backoff=0.5, timeout=60.,
+                     pool=None, cache=None, **kwargs):
+    """
+    Cone search an RA/Dec box too large for a single request.
+
+    The box is tiled with `sky_tiles` and the cones are queried in
+    parallel with `vo_service_requests`. Every source is kept only by
+    the tile whose cell contains its position, so sources in the
+    overlaps of the cones come out exactly once without remembering
+    the sources already seen, and the rows of each tile are yielded as
+    soon as it finishes, so memory does not grow with the area.
+
+    Parameters
+    ----------
+    url : string
+        Cone search service URL ending in '?' or '&'.
+
+    ra_min, ra_max, dec_min, dec_max : float
+        The box in degrees, through RA=0 when `ra_min` > `ra_max`.
+
+    max_sr : float
+        Largest cone radius to ask the service for, in degrees.
+
+    maxrec : int or `None`
+        Row limit of the service. A tile that returns `maxrec` rows or
+        more was probably cut short and is queried again as four
+        smaller tiles, down to `min_sr`.
+
+    ra_col, dec_col : string or `None`
+        Position columns, found from the UCDs if `None`.
+
+    workers, retries, backoff, timeout, pool, cache
+        As for `vo_service_requests`.
+
+    kwargs : dict
+        Extra query parameters, e.g. VERB.
+
+    Yields
+    ------
+    rows : `numpy.ndarray`
+        The rows of the table of one tile that the tile owns, a
+        masked array like `astropy.io.votable.tree.Table.array`.
+
+    Raises
+    ------
+    VOSError
+        A tile failed, tiles with no sources are skipped.
+
+    Examples
+    --------
+    >>> rows = vo_region_search(url, 10., 12., -1., 1., max_sr=0.25)
+    >>> catalog = np.concatenate(list(rows))
+
+    """
+    region = (ra_min, (ra_max - ra_min) % 360. or 360., dec_max)
+    tiles = sky_tiles(ra_min, ra_max, dec_min, dec_max, max_sr)
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool(maxsize=workers, timeout=timeout)
+
+    try:
+        while tiles:
+            queries = []
+            for tile in tiles:
+                query = dict(kwargs, RA=tile.ra, DEC=tile.dec, SR=tile.sr)
+                queries.append((url, query))
+            split = []
+            results = vo_service_requests(queries, workers=workers,
+                                          retries=retries, backoff=backoff,
+                                          pool=pool, cache=cache)
+            try:
+                for index, tab in results:
+                    tile = tiles[index]
+                    if isinstance(tab, VOSEmptyResult):
+                        continue
+                    if isinstance(tab, Exception):
+                        raise tab
+                    if (maxrec is not None and len(tab.array) >= maxrec and
+                            tile.sr / 2 >= min_sr):
+                        split.extend(_split_tile(tile))
+                        continue
+                    ra_col, dec_col = _radec_columns(tab, ra_col, dec_col)
+                    array = tab.array
+                    owned = _in_cell(tile, np.asarray(array[ra_col], dtype=np.float64),
+                                     np.asarray(array[dec_col], dtype=np.float64),
+                                     region)
+                    if owned.any():
+                        yield array[owned]
+            finally:
+                results.close()
+            tiles = split
+    finally:
+        if own_pool:
+            pool.close()
@@ -0,0 +1,214 @@
+"""
+    Fast reader for the text tables written by the IRAF apphot/daophot tasks
+    (.phot files from phot, .stars files from daofind)
+
+    The #K/#N/#U/#F header is parsed once to get the column names and types,
+    then the data lines are read in chunks, the continuation characters are
+    dropped and each chunk is split in one go and converted column by column
+    into a numpy structured array. INDEF becomes NaN.
+
+    Records with several apertures continue over extra lines ending in '*'.
+    The columns of that last group (RAPERT, SUM, AREA, FLUX, MAG, MERR,
+    PIER, PERROR) get one entry per aperture, the same layout as the arrays
+    returned by nativephot.aperture_photometry, so the results of both
+    backends can be used the same way.
+
+    The parsed array is saved next to the text file as filename.cache.npy and
+    memory mapped on the next read as long as it is newer than the text file
+    and has the columns named in its header. The name is not the filename.npy
+    the numpy backend saves its catalogs as, so neither overwrites the other.
+
+"""
+from __future__ import print_function, division
+
+import os
+import re
+
+import numpy as np
+
+#number of records converted at a time
+CHUNKSIZE = 20000
+
+#suffix of the binary cache saved next to a text file
+CACHESUFFIX = ".cache.npy"
+
+#printf style format in the #F lines
+_FORMAT = re.compile(r"%-?(\d*)(?:\.\d+)?([a-zA-Z])")
+
+
+def read_header(filename):
+    """
+    read the header of a daophot text file
+
+    returns a dictionary of the #K keywords (values as strings) and the list of
+    column groups, one per line of a record, each a list of (name, units, dtype)
+    """
+    keywords = dict()
+    groups = list()
+    names = units = None
+    infile = open(filename, "r")
+    for line in infile:
+        if not line.startswith("#"):
+            break
+        kind = line[:2]
+        fields = line[2:].rstrip().rstrip("\\").split()
+        if kind == "#K":
+            #NAME = value units format
+            text = line[2:].split("=", 1)
+            if len(text) == 2:
+                value = text[1].split()
+                keywords[text[0].strip()] = value[0] if len(value) > 2 else ""
+        elif kind == "#N":
+            names = fields
+        elif kind == "#U":
+            units = fields
+        elif kind == "#F":
+            types = [_dtype(f) for f in fields]
+            groups.append(list(zip(names, units or [""] * len(names), types)))
+            names = units = None
+    infile.close()
+    return keywords, groups
+
+
+def _dtype(fmt):
+    """numpy type for a printf format like %-23s or %-10.3f"""
+    match = _FORMAT.match(fmt)
+    if match is None:
+        return np.float64
+    width, code = match.groups()
+    if code == "s":
+        return "S%i" % (int(width) if width else 23)
+    if code == "d":
+        return np.int32
+    if code == "b":
+        return "S3"
+    return np.float64
+
+
+def read_daophot(filename, cache=True):
+    """
+    read a daophot text file into a structured array
+
+    Parameters
+        filename: string, the .phot/.stars/... file
+        cache:    bool, use and write the binary cache, see cache_name()
+
+    the columns of the per-aperture group are arrays with one entry for each
+    aperture for phot files, the other columns are scalars. INDEF is NaN in
+    float columns, an integer column containing INDEF is read as float
+    """
+    if not os.access(filename, os.F_OK):
+        raise IOError("Unable to access input file: %s" % (filename))
+
+    keywords, groups = read_header(filename)
+    names = tuple(name for group in groups for name, units, dtype in group)
+
+    cachename = cache_name(filename)
+    if cache and os.access(cachename, os.F_OK) and \
+            os.path.getmtime(cachename) >= os.path.getmtime(filename):
+        table = np.load(cachename, mmap_mode="r")
+        #anything else saved under the name is read again from the text
+        if table.dtype.names == names:
+            return table
+
+    table = _read_data(filename, groups)
+
+    if cache:
+        try:
+            np.save(cachename, table)
+        except (IOError, OSError):
+            print("Unable to save the table cache %s" % (cachename))
+    return table
+
+
+def cache_name(filename):
+    """the name of the binary cache of a daophot text file"""
+    return filename + CACHESUFFIX
+
+
+def _read_data(filename, groups):
+    """read the records of a daophot file given its column groups"""
+    infile = open(filename, "r")
+    lines = (line for line in infile if not line.startswith("#") and line.strip())
+
+    #the first record tells how many lines, and so apertures, each record has
+    buffered = list()
+    for line in lines:
+        buffered.append(line)
+        if not line.rstrip().endswith("\\"):
+            break
+    nlines = len(buffered)
+    naper = nlines - len(groups) + 1
+    multiline = nlines > 0 and buffered[-1].rstrip().endswith("*")
+
+    columns = [col for group in groups[:-1] for col in group]
+    apercols = groups[-1] if groups else []
+    if not (multiline or "RAPERT" in [name for name, units, t in apercols]):
+        columns = columns + apercols
+        apercols = []
+        naper = 0
+    ntok = len(columns) + naper * len(apercols)
+
+    #convert a chunk of records at a time to keep the memory down
+    chunks = list()
+    for line in lines:
+        buffered.append(line)
+        if len(buffered) >= CHUNKSIZE * nlines:
+            chunks.append(_convert(buffered, ntok, columns, apercols, naper))
+            buffered = list()
+    infile.close()
+    if buffered:
+        chunks.append(_convert(buffered, ntok, columns, apercols, naper))
+
+    if not chunks:
+        dtype = [(name, t) for name, units, t in columns]
+        dtype += [(name, t, (naper,)) for name, units, t in apercols]
+        return np.zeros(0, dtype=dtype)
+
+    #a column can be promoted to float by INDEF values or get longer strings in
+    #some chunks only, use the widest type for the whole table
+    dtype = list()
+    for name in chunks[0].dtype.names:
+        base = np.result_type(*[chunk.dtype[name].base for chunk in chunks])
+        shape = chunks[0].dtype[name].shape
+        dtype.append((name, base, shape) if shape else (name, base))
+    return np.concatenate([chunk.astype(dtype) for chunk in chunks])
+
+
+def _convert(lines, ntok, columns, apercols, naper):
+    """turn a list of data lines into a structured array"""
+    text = " ".join(line.rstrip().rstrip("\\").rstrip().rstrip("*") for line in lines)
+    tokens = text.split()
+    if len(tokens) % ntok:
+        raise ValueError("Unexpected number of values in the daophot file, "
+                         "check the apertures are the same for all stars")
+    nrows = len(tokens) // ntok
+
+    fields = list()
+    for i, (name, units, t) in enumerate(columns):
+        fields.append((name, _column(tokens[i::ntok], t)))
+    nplain = len(columns)
+    for j, (name, units, t) in enumerate(apercols):
+        #the values of all apertures, row by row
+        values = [tokens[nplain + j + len(apercols) * k::ntok] for k in range(naper)]
+        values = [value for row in zip(*values) for value in row]
+        fields.append((name, _column(values, t).reshape(nrows, naper)))
+
+    out = np.zeros(nrows, dtype=[(name, values.dtype, values.shape[1:])
+                                 for name, values in fields])
+    for name, values in fields:
+        out[name] = values
+    return out
+
+
+def _column(values, dtype):
+    """convert a list with the string values of a column, INDEF becomes NaN"""
+    dtype = np.dtype(dtype)
+    if dtype.kind == "S":
+        #as wide as the longest value, IRAF does not cut long names to the format
+        return np.array(values, dtype="S")
+    #numpy parses a whole column from one string much faster than value by value
+    text = " ".join(values)
+    if "INDEF" in text:
+        return np.fromstring(text.replace("INDEF", "nan"), dtype=np.float64, sep=" ")
+    return np.fromstring(text, dtype=dtype, sep=" ")
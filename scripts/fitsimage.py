@@ -0,0 +1,185 @@
+"""
+    Shared access to the FITS images used by the photometry scripts
+
+    Every pyfits.getval or pyfits.getdata call opens and parses the file
+    again, and getdata reads the whole extension into memory. Here each file
+    is opened once per process with memory mapping and kept open: the headers
+    are parsed once and cached, and the pixels of an extension are only
+    mapped when that extension is first asked for, then handed out as a read
+    only array so no caller can change them for the others. A file is opened
+    again if it changed on disk since it was opened. At most MAXIMAGES files
+    are kept open, the one used longest ago is closed to make room, and the
+    batch drivers close each image when they are done with it.
+
+    example:
+
+    exptime=fitsimage.getval('myimage.fits','EXPTIME')
+    data=fitsimage.getdata('myimage.fits',("SCI",1))
+
+"""
+from __future__ import print_function, division
+
+import os
+import threading
+from collections import OrderedDict
+
+MAXIMAGES = 16 #files kept open per process
+
+#the open images by absolute path, the most recently used last
+_IMAGES = OrderedDict()
+_LOCK = threading.RLock()
+
+
+class FitsImage(object):
+    """
+    one FITS file opened with memory mapping, with cached headers and data
+
+    ext can be an extension number or an (EXTNAME, EXTVER) tuple like ("SCI",1)
+    """
+    def __init__(self, filename):
+        #pyfits is slow to import, only pay for it once an image is opened
+        import pyfits
+
+        self.filename = os.path.abspath(filename)
+        info = os.stat(self.filename)
+        self.stamp = (info.st_mtime, info.st_size)
+        self.hdulist = pyfits.open(self.filename, memmap=True, mode="readonly")
+        self._headers = dict()
+        self._data = dict()
+        self._lock = threading.RLock()
+
+    def header(self, ext=0):
+        """the header of an extension, parsed once"""
+        with self._lock:
+            if ext not in self._headers:
+                self._headers[ext] = self.hdulist[ext].header
+            return self._headers[ext]
+
+    def getval(self, keyword, ext=0):
+        """the value of a header keyword, like pyfits.getval"""
+        return self.header(ext)[keyword]
+
+    def lookup(self, keyword, ext=0, default=None):
+        """
+        a keyword from the header of an extension, or from the primary header
+        if the extension does not have it, default if neither has it
+        """
+        for hdr in (self.header(ext), self.header(0)):
+            if keyword in hdr:
+                return hdr[keyword]
+        return default
+
+    def extensions(self, extname="SCI"):
+        """the EXTVER numbers of the image extensions called extname"""
+        versions = list()
+        with self._lock:
+            for hdu in self.hdulist:
+                hdr = hdu.header
+                if hdr.get("EXTNAME", "").strip().upper() == extname.upper() and \
+                        hdr.get("NAXIS", 0) > 0:
+                    versions.append(hdr.get("EXTVER", 1))
+        return sorted(versions)
+
+    def has_extension(self, ext):
+        """True if the file has the extension"""
+        with self._lock:
+            try:
+                self.hdulist[ext]
+            except (KeyError, IndexError):
+                return False
+            return True
+
+    def data(self, ext=None):
+        """
+        the read only, memory mapped pixels of an extension, with ext None
+        the first extension that has data, like pyfits.getdata
+        """
+        with self._lock:
+            if ext not in self._data:
+                if ext is None:
+                    hdu = [hdu for hdu in self.hdulist if hdu.data is not None][0]
+                else:
+                    hdu = self.hdulist[ext]
+                data = hdu.data
+                if data is not None:
+                    data = data.view()
+                    data.flags.writeable = False
+                self._data[ext] = data
+            return self._data[ext]
+
+    def close(self):
+        """release the file, the arrays handed out stay usable while referenced"""
+        with self._lock:
+            self._headers.clear()
+            self._data.clear()
+            self.hdulist.close()
+
+
+def open_image(filename):
+    """the shared FitsImage for a file, opened on first use"""
+    path = os.path.abspath(filename)
+    info = os.stat(path)
+    with _LOCK:
+        image = _IMAGES.get(path)
+        if image is not None and image.stamp != (info.st_mtime, info.st_size):
+            #the file was rewritten, drop the stale mapping
+            image.close()
+            image = None
+        if image is None:
+            image = FitsImage(path)
+        _IMAGES.pop(path, None)
+        _IMAGES[path] = image
+        while len(_IMAGES) > MAXIMAGES:
+            _IMAGES.popitem(last=False)[1].close()
+        return image
+
+
+def getval(filename, keyword, ext=0):
+    """a header keyword value from the cached header"""
+    return open_image(filename).getval(keyword, ext)
+
+
+def getheader(filename, ext=0):
+    """the cached header of an extension"""
+    return open_image(filename).header(ext)
+
+
+def lookup(filename, keyword, ext=0, default=None):
+    """a keyword from an extension header, falling back to the primary header"""
+    return open_image(filename).lookup(keyword, ext, default)
+
+
+def extensions(filename, extname="SCI"):
+    """the EXTVER numbers of the extensions called extname, e.g. every SCI chip"""
+    return open_image(filename).extensions(extname)
+
+
+def getdata(filename, ext=None):
+    """the read only, memory mapped pixels of an extension"""
+    return open_image(filename).data(ext)
+
+
+def close(filename=None):
+    """close one image, or all of them"""
+    with _LOCK:
+        if filename is None:
+            paths = list(_IMAGES)
+        else:
+            paths = [os.path.abspath(filename)]
+        for path in paths:
+            image = _IMAGES.pop(path, None)
+            if image is not None:
+                image.close()
+
+
+def reset():
+    """
+    start with no open images, for the initializer of a worker process
+
+    a forked worker inherits the images and locks of its parent, which another
+    thread of the parent may have held at the fork, so they are dropped without
+    being touched and the files are opened again in the worker
+    """
+    global _IMAGES, _LOCK
+    _IMAGES = OrderedDict()
+    _LOCK = threading.RLock()
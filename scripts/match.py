@@ -1,19 +1,461 @@
-"""simple module to identify matches between two lists
+"""simple module to identify matches between two lists, or across many catalogs
 
 """
 
+from collections import namedtuple
+
 import numpy as np
+from scipy.spatial import cKDTree
 
 __author__="P. Greenfield"
 
-def match(list1x, list1y, list2x, list2y, dthreshold):
+# x2 = scale * (x1 cos(rotation) - y1 sin(rotation)) + xshift, the same for y2
+# with (x1 sin(rotation) + y1 cos(rotation)), rotation in degrees
+Transform = namedtuple("Transform", ["xshift", "yshift", "rotation", "scale"])
+
+def match(list1x, list1y, list2x, list2y, dthreshold, candidates=False,
+          distances=False, asarray=False):
+    """match positions in two lists using a k-d tree.
+
+    dthreshold is how close to each other items must be to match
+
+    The tree is built once from list2 and every position in list1 is looked
+    up in a single vectorized query, so the time goes roughly as N log N
+    instead of the N**2 of match_brute.
+
+    Returns (matches, nomatch) where matches is a list of (index1, index2)
+    tuples for the closest list2 item within dthreshold and nomatch is a list
+    of the list1 indices that found nothing. Extra outputs are appended to
+    the returned tuple in this order when requested:
+
+        candidates: for each list1 item, the list of all list2 indices
+                    within dthreshold (closest first)
+        distances:  array with the distance of each match, in the same
+                    order as matches
+
+    With asarray=True, matches is returned as an (N,2) integer array and
+    nomatch as an integer array, which is much cheaper for long lists.
+
+    """
+    p1 = np.column_stack((np.asarray(list1x, dtype=np.float64),
+                          np.asarray(list1y, dtype=np.float64)))
+    p2 = np.column_stack((np.asarray(list2x, dtype=np.float64),
+                          np.asarray(list2y, dtype=np.float64)))
+    return _match(p1, p2, dthreshold, candidates, distances, asarray)
+
+def match_sky(ra1, dec1, ra2, dec2, threshold, candidates=False,
+              distances=False, asarray=False):
+    """match sky positions in two lists, all angles in degrees.
+
+    threshold is the largest separation for a match, in degrees like the SR
+    of a cone search. For the tables from conesearch.vo_service_request pass
+    the RA/Dec columns of out_tab.array directly.
+
+    The positions are turned into unit vectors on the sphere and matched
+    with a k-d tree on the chord length 2*sin(theta/2), so there is no
+    special case for RA wrapping through 0/360 or for the poles and no need
+    to reproject the catalogs first.
+
+    Returns the same outputs as match(), with distances being the angular
+    separations in degrees.
+
+    """
+    chord = 2 * np.sin(np.radians(min(threshold, 180.)) / 2)
+    result = _match(radec_to_xyz(ra1, dec1), radec_to_xyz(ra2, dec2), chord,
+                    candidates, distances, asarray)
+    if distances:
+        result = result[:-1] + (np.degrees(2 * np.arcsin(np.minimum(result[-1] / 2, 1.))),)
+    return result
+
+def radec_to_xyz(ra, dec):
+    """convert RA and Dec in degrees to an (N,3) array of unit vectors"""
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cosdec = np.cos(dec)
+    return np.column_stack((cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)))
+
+def _match(p1, p2, dthreshold, candidates, distances, asarray):
+    """nearest neighbour matching of two (N,ndim) point arrays"""
+    index1 = np.arange(len(p1))
+    if len(p2) == 0:
+        d = np.empty(len(p1))
+        d.fill(np.inf)
+        closest = np.zeros(len(p1), dtype=np.intp)
+    else:
+        tree = cKDTree(p2)
+        # querying with an upper bound lets the tree stop early, items with
+        # nothing in range come back with an infinite distance
+        d, closest = tree.query(p1, k=1,
+                                distance_upper_bound=dthreshold * (1 + 1e-12))
+    good = d <= dthreshold
+
+    if asarray:
+        matches = np.column_stack((index1[good], closest[good]))
+        nomatch = index1[~good]
+    else:
+        matches = zip(index1[good].tolist(), closest[good].tolist())
+        nomatch = index1[~good].tolist()
+
+    result = [matches, nomatch]
+    if candidates:
+        if len(p2) == 0:
+            near = [[] for i in index1]
+        else:
+            near = tree.query_ball_point(p1, dthreshold)
+        # order each candidate list by distance so the first one is the match
+        cands = []
+        for i, c in enumerate(near):
+            c = np.asarray(c, dtype=np.intp)
+            dc = ((p2[c] - p1[i])**2).sum(axis=1)
+            cands.append(c[np.argsort(dc, kind='mergesort')].tolist())
+        result.append(cands)
+    if distances:
+        result.append(d[good])
+    return tuple(result)
+
+class UnionFind(object):
+    """disjoint sets of the integers 0..n-1, with vectorized find and union
+
+    Every set is a tree stored in the parent array, its root is the smallest
+    member so the labels come out the same whatever order the links are
+    made in. find() follows all the given items up to their roots together
+    and then points them straight at them, union() hooks the larger root of
+    each pair under the smaller one, repeating for the pairs whose hooks
+    were overwritten by another pair in the same step.
+
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def find(self, items):
+        """the root of each of the items"""
+        parent = self.parent
+        items = np.asarray(items, dtype=np.intp)
+        root = parent[items]
+        while True:
+            up = parent[root]
+            moving = up != root
+            if not moving.any():
+                break
+            root[moving] = up[moving]
+        # compress the paths, the items now point straight at their roots
+        parent[items] = root
+        return root
+
+    def union(self, a, b):
+        """merge the sets of a[i] and b[i] for every i"""
+        a = np.asarray(a, dtype=np.intp)
+        b = np.asarray(b, dtype=np.intp)
+        while len(a):
+            ra = self.find(a)
+            rb = self.find(b)
+            apart = ra != rb
+            a, b, ra, rb = a[apart], b[apart], ra[apart], rb[apart]
+            self.parent[np.maximum(ra, rb)] = np.minimum(ra, rb)
+
+    def labels(self):
+        """the root of every item"""
+        return self.find(np.arange(len(self.parent)))
+
+def match_epochs(listsx, listsy, dthreshold, sky=False):
+    """cross-identify the sources of many catalogs at once, for example
+    the star lists of all the exposures of a field.
+
+    listsx, listsy are sequences holding the positions of each catalog,
+    x and y or with sky=True RA and Dec in degrees (dthreshold is then in
+    degrees too, see match_sky).
+
+    The positions of all the catalogs go into one k-d tree and every
+    detection is linked to its nearest neighbour within dthreshold in a
+    UnionFind. The linked detections are then replaced by their mean
+    position and the groups are linked to their nearest neighbouring group
+    the same way, until no two groups are within dthreshold. Every round
+    at least halves the number of groups that can still be linked, so the
+    time goes as N log N in the total number of detections, without the
+    pairwise matches of every catalog against every other one.
+
+    A source has at most one detection in each catalog: when a group holds
+    several detections from the same catalog the one closest to the group
+    mean is kept and the others become sources of their own.
+
+    Returns the master table, a structured array with one row per source
+    in order of first detection, holding the mean position (X, Y or RA, DEC),
+    NCAT the number of catalogs it was found in and INDEX, the row of the
+    source in each catalog with -1 where it was not detected.
+
+    """
+    ncat = len(listsx)
+    counts = [len(x) for x in listsx]
+    catalog = np.repeat(np.arange(ncat), counts)
+    row = np.concatenate([np.arange(n) for n in counts] + [np.zeros(0, dtype=np.intp)])
+    x = np.concatenate([np.asarray(x, dtype=np.float64) for x in listsx] + [np.zeros(0)])
+    y = np.concatenate([np.asarray(y, dtype=np.float64) for y in listsy] + [np.zeros(0)])
+    if sky:
+        points = radec_to_xyz(x, y)
+        radius = 2 * np.sin(np.radians(min(dthreshold, 180.)) / 2)
+    else:
+        points = np.column_stack((x, y))
+        radius = dthreshold
+
+    groups = UnionFind(len(points))
+    _link_groups(points, radius, groups)
+    labels = _split_catalogs(points, catalog, groups.labels())
+
+    # number the sources in order of their first detection
+    roots, first, source = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='mergesort')
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order))
+    source = rank[source]
+
+    nsource = len(roots)
+    center = _means(points, source, nsource)
+    names = ('RA', 'DEC') if sky else ('X', 'Y')
+    table = np.zeros(nsource, dtype=[(names[0], np.float64), (names[1], np.float64),
+                                     ('NCAT', np.int32), ('INDEX', np.int32, (ncat,))])
+    if sky:
+        table['RA'] = np.degrees(np.arctan2(center[:, 1], center[:, 0])) % 360.
+        table['DEC'] = np.degrees(np.arctan2(center[:, 2], np.hypot(center[:, 0], center[:, 1])))
+    else:
+        table['X'] = center[:, 0]
+        table['Y'] = center[:, 1]
+    table['NCAT'] = np.bincount(source, minlength=nsource)
+    table['INDEX'] = -1
+    table['INDEX'][source, catalog] = row
+    return table
+
+def _means(points, labels, n):
+    """the mean of the points with each label 0..n-1"""
+    count = np.bincount(labels, minlength=n).astype(np.float64)
+    return np.column_stack([np.bincount(labels, weights=points[:, k], minlength=n) / count
+                            for k in range(points.shape[1])])
+
+def _link_groups(points, radius, groups):
+    """link the groups of points to their nearest neighbour group within
+    radius, with the groups at their mean position, until none is left"""
+    labels = groups.labels()
+    while True:
+        roots, inverse = np.unique(labels, return_inverse=True)
+        if len(roots) < 2:
+            return
+        center = _means(points, inverse, len(roots))
+        d, near = cKDTree(center).query(center, k=2,
+                                        distance_upper_bound=radius * (1 + 1e-12))
+        # the closest is the group itself, unless another one is on top of it
+        self_first = near[:, 0] == np.arange(len(roots))
+        other = np.where(self_first, near[:, 1], near[:, 0])
+        d = np.where(self_first, d[:, 1], d[:, 0])
+        linked = d <= radius
+        if not linked.any():
+            return
+        groups.union(roots[linked], roots[other[linked]])
+        labels = groups.find(labels)
+
+def _split_catalogs(points, catalog, labels):
+    """keep one detection per catalog in each group, the closest to the
+    group mean, and give the others labels of their own"""
+    if not len(labels):
+        return labels
+    roots, inverse = np.unique(labels, return_inverse=True)
+    center = _means(points, inverse, len(roots))
+    d = ((points - center[inverse])**2).sum(axis=1)
+    order = np.lexsort((d, catalog, inverse))
+    repeat = np.zeros(len(order), dtype=bool)
+    repeat[1:] = (inverse[order][1:] == inverse[order][:-1]) & \
+                 (catalog[order][1:] == catalog[order][:-1])
+    labels = labels.copy()
+    # past the item numbers, no other group uses these labels
+    labels[order[repeat]] = len(labels) + np.arange(repeat.sum())
+    return labels
+
+def match_transform(list1x, list1y, list2x, list2y, dthreshold, mags1=None,
+                    mags2=None, nbright=40, tolerance=0.01, maxiter=10,
+                    asarray=False):
+    """match positions in two lists which are not in the same frame, solving
+    for the shift, rotation and scale between them first.
+
+    The nbright brightest stars of each list (the first ones when mags1 and
+    mags2 are not given) are joined in triangles with their nearest bright
+    neighbours. The ratios of the sides of a triangle do not change with
+    the shift, rotation and scale, so the triangles of the two lists with
+    ratios within tolerance are looked up in a k-d tree. Each pair of
+    similar triangles gives a transform, and the one that the most star
+    pairs at the corners of all the similar triangles agree with is refined
+    by least squares over the matches found by match() with it, until the
+    matches do not change or maxiter is reached. Only the bright stars
+    go into the triangles, so the cost is that of the final k-d tree
+    matches, N log N.
+
+    dthreshold is how close to each other items must be to match once list1
+    is transformed to the frame of list2
+
+    Returns (transform, matches, nomatch) where transform is a Transform taking
+    list1 positions to list2 (see transform_positions) and matches, nomatch
+    are the outputs of match() for the transformed list1. Raises ValueError
+    when the bright stars do not give a consistent transform.
+
+    """
+    x1 = np.asarray(list1x, dtype=np.float64)
+    y1 = np.asarray(list1y, dtype=np.float64)
+    p2 = np.column_stack((np.asarray(list2x, dtype=np.float64),
+                          np.asarray(list2y, dtype=np.float64)))
+    bright1 = _brightest(len(x1), mags1, nbright)
+    bright2 = _brightest(len(p2), mags2, nbright)
+    triangles1, triangles2 = _similar_triangles(np.column_stack((x1, y1))[bright1],
+                                                p2[bright2], tolerance)
+    transform = _vote_transform(x1 + 1j * y1, p2[:, 0] + 1j * p2[:, 1],
+                                bright1[triangles1], bright2[triangles2], dthreshold)
+
+    previous = None
+    for i in range(maxiter):
+        tx, ty = transform_positions(transform, x1, y1)
+        matches, nomatch = _match(np.column_stack((tx, ty)), p2, dthreshold,
+                                  False, False, True)
+        if len(matches) < 2:
+            raise ValueError("The transform matches less than two stars")
+        if previous is not None and np.array_equal(matches, previous):
+            break
+        previous = matches
+        transform = fit_transform(x1[matches[:, 0]], y1[matches[:, 0]],
+                                  p2[matches[:, 1], 0], p2[matches[:, 1], 1])
+
+    if not asarray:
+        matches = [tuple(pair) for pair in matches.tolist()]
+        nomatch = nomatch.tolist()
+    return transform, matches, nomatch
+
+def transform_positions(transform, x, y):
+    """apply a Transform to positions, returns the new x, y arrays"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    angle = np.radians(transform.rotation)
+    a = transform.scale * np.cos(angle)
+    b = transform.scale * np.sin(angle)
+    return a * x - b * y + transform.xshift, b * x + a * y + transform.yshift
+
+def fit_transform(x1, y1, x2, y2):
+    """least squares Transform taking the positions x1, y1 to x2, y2"""
+    x1 = np.asarray(x1, dtype=np.float64)
+    y1 = np.asarray(y1, dtype=np.float64)
+    n = len(x1)
+    # x2 = a x1 - b y1 + c, y2 = b x1 + a y1 + d is linear in a, b, c, d
+    design = np.zeros((2 * n, 4))
+    design[:n, 0] = x1
+    design[:n, 1] = -y1
+    design[:n, 2] = 1.
+    design[n:, 0] = y1
+    design[n:, 1] = x1
+    design[n:, 3] = 1.
+    a, b, c, d = np.linalg.lstsq(design, np.concatenate((x2, y2)), rcond=None)[0]
+    return Transform(float(c), float(d), float(np.degrees(np.arctan2(b, a))),
+                     float(np.hypot(a, b)))
+
+def _brightest(n, mags, nbright):
+    """the indices of the nbright brightest items, in order"""
+    if mags is None:
+        return np.arange(min(n, nbright))
+    mags = np.asarray(mags, dtype=np.float64)
+    # INDEF magnitudes go last
+    mags = np.where(np.isfinite(mags), mags, np.inf)
+    if n > nbright:
+        index = np.argpartition(mags, nbright)[:nbright]
+    else:
+        index = np.arange(n)
+    return index[np.argsort(mags[index], kind='mergesort')]
+
+def _triangles(points, nneighbours=6):
+    """the triangles of each point with pairs of its nearest neighbours
+
+    Returns the (N,3) corner indices, ordered by decreasing length of the
+    opposite side, and the (N,3) invariants: the two shorter sides over the
+    longest one and the handedness, large so that mirrored triangles never
+    come close to each other
+
+    """
+    k = min(nneighbours + 1, len(points))
+    if k < 3:
+        return np.zeros((0, 3), dtype=np.intp), np.zeros((0, 3))
+    near = cKDTree(points).query(points, k=k)[1]
+    first, second = np.triu_indices(k - 1, 1)
+    corners = np.column_stack((np.repeat(near[:, 0], len(first)),
+                               near[:, 1:][:, first].ravel(),
+                               near[:, 1:][:, second].ravel()))
+    corners = np.unique(np.sort(corners, axis=1), axis=0)
+
+    vertex = points[corners]
+    # the side opposite each corner
+    sides = np.sqrt(((vertex[:, [1, 2, 0]] - vertex[:, [2, 0, 1]])**2).sum(axis=2))
+    order = np.argsort(-sides, axis=1, kind='mergesort')
+    rows = np.arange(len(corners))[:, np.newaxis]
+    corners = corners[rows, order]
+    sides = sides[rows, order]
+    vertex = points[corners]
+    edge1 = vertex[:, 1] - vertex[:, 0]
+    edge2 = vertex[:, 2] - vertex[:, 0]
+    handedness = np.sign(edge1[:, 0] * edge2[:, 1] - edge1[:, 1] * edge2[:, 0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        invariants = np.column_stack((sides[:, 1] / sides[:, 0], sides[:, 2] / sides[:, 0],
+                                      10. * handedness))
+    good = sides[:, 2] > 0
+    return corners[good], invariants[good]
+
+def _similar_triangles(points1, points2, tolerance):
+    """the corners of the pairs of similar triangles of two point sets, two
+    (N,3) arrays of indices, the matching corners in the same columns"""
+    corners1, inv1 = _triangles(points1)
+    corners2, inv2 = _triangles(points2)
+    if not len(corners1) or not len(corners2):
+        raise ValueError("Not enough stars to make triangles from")
+    near = cKDTree(inv2).query_ball_point(inv1, tolerance)
+    t1 = np.repeat(np.arange(len(near)), [len(n) for n in near])
+    t2 = np.array([j for n in near for j in n], dtype=np.intp)
+    if not len(t1):
+        raise ValueError("No similar triangles in the two lists")
+    return corners1[t1], corners2[t2]
+
+def _vote_transform(z1, z2, triangles1, triangles2, dthreshold):
+    """the Transform most of the star pairs voted for by the similar
+    triangles agree with
+
+    Every pair of similar triangles gives a transform and the star pairs at
+    its three corners. Each transform is tried on all the star pairs and the
+    one most of them agree with to within dthreshold wins, the wrong
+    triangle matches do not throw it off as they would a least squares fit
+    to all the pairs. The positions are complex numbers x + iy, a Transform
+    is then z2 = w z1 + c.
+
+    """
+    pairs = np.unique(np.column_stack((triangles1.ravel(), triangles2.ravel())), axis=0)
+    best = None
+    for start in range(0, len(triangles1), 1000):
+        c1 = z1[triangles1[start:start + 1000]]
+        c2 = z2[triangles2[start:start + 1000]]
+        m1 = c1.mean(axis=1)[:, np.newaxis]
+        m2 = c2.mean(axis=1)[:, np.newaxis]
+        w = ((c2 - m2) * np.conj(c1 - m1)).sum(axis=1) / (np.abs(c1 - m1)**2).sum(axis=1)
+        c = m2[:, 0] - w * m1[:, 0]
+        agree = np.abs(w[:, np.newaxis] * z1[pairs[:, 0]] + c[:, np.newaxis] -
+                       z2[pairs[:, 1]]) <= dthreshold
+        votes = agree.sum(axis=1)
+        top = np.argmax(votes)
+        if best is None or votes[top] > best[0]:
+            best = (votes[top], agree[top])
+    # the corners of the winning triangles always agree, look for more
+    if best[0] < 4:
+        raise ValueError("No consistent transform between the two lists")
+    good = pairs[best[1]]
+    return fit_transform(z1[good[:, 0]].real, z1[good[:, 0]].imag,
+                         z2[good[:, 1]].real, z2[good[:, 1]].imag)
+
+def match_brute(list1x, list1y, list2x, list2y, dthreshold):
     """brute force algorithm for matching positions in two lists.
     
     dthreshold is how close to each other items must be to match
     
     This is brute force since each combination of possible positions is checked
     and thus the time goes as the square of the number of positions for a large
-    number. There are more complex algorithms that do not have this problem.
+    number. There are more complex algorithms that do not have this problem,
+    see match() which uses a k-d tree. This is kept as a simple reference.
     
     """
     x1 = np.array(list1x)
@@ -33,18 +475,41 @@ def match(list1x, list1y, list2x, list2y, dthreshold):
             nomatch.append((i))
     return matches, nomatch
 
-def filtermags(matches, mags1, mags2, magthreshold):
-    """reject matches if magnitudes not similar enough"""
-    rejects = []
-    for i, (m1, m2) in enumerate(matches):
-        print i,m1,m2,mags1[m1],mags1[m2]
-        if np.abs(mags1[m1]-mags2[m2]) > magthreshold:
-            rejects.append(i)
-    # now eliminate rejections from matches, note reverse order!
-    print rejects
-    rejects.reverse()
-    for reject in rejects:
-        del matches[reject]
-    # why is a return not necessary?
-    
+def filtermags(matches, mags1, mags2, magthreshold, merr1=None, merr2=None,
+               nsigma=3.):
+    """reject matches if magnitudes not similar enough
+
+    matches is either the list of (index1, index2) tuples or the (N,2) array
+    returned by match(..., asarray=True). All pairs are tested at once, a pair
+    is kept when
+
+        abs(mags1[index1] - mags2[index2]) <= magthreshold + nsigma * merr
+
+    where merr is the two errors added in quadrature when merr1 and/or merr2
+    (per-source magnitude errors, e.g. the MERR column) are given and zero
+    otherwise. Pairs with an undefined (NaN) magnitude are rejected.
+
+    The input is never modified, a list of tuples is no longer filtered in
+    place: use the returned pairs instead.
+
+    Returns (keep, pairs): the boolean keep mask over the input pairs and a
+    new (M,2) array with a copy of the pairs that passed.
+
+    """
+    pairs = np.asarray(matches, dtype=np.intp).reshape(-1, 2)
+    m1 = np.asarray(mags1, dtype=np.float64)
+    m2 = np.asarray(mags2, dtype=np.float64)
+    i1 = pairs[:, 0]
+    i2 = pairs[:, 1]
+
+    tol = magthreshold
+    if merr1 is not None or merr2 is not None:
+        var = np.zeros(len(pairs))
+        if merr1 is not None:
+            var += np.asarray(merr1, dtype=np.float64)[i1]**2
+        if merr2 is not None:
+            var += np.asarray(merr2, dtype=np.float64)[i2]**2
+        tol = magthreshold + nsigma * np.sqrt(var)
 
+    keep = np.abs(m1[i1] - m2[i2]) <= tol
+    return keep, pairs[keep]
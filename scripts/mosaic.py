@@ -0,0 +1,212 @@
+"""
+    Tiled, multi-core source finding and photometry for large images
+
+    The image is cut into square tiles which are handed out to a pool of
+    worker processes. Each worker reads the image through a memory map, so
+    no process holds the whole frame in memory, only the tiles it is working
+    on plus their halos.
+
+    Finding: every tile is read with a halo twice the half width of the
+    detection kernel, enough for the convolved image, the local maximum test
+    and the shape cutouts of every peak in the tile to be the same as on the
+    whole image. Detections are kept by the tile holding their peak pixel,
+    so the sources found again in the halos of the neighbours are dropped,
+    and they are numbered in the same row by row order find_stars uses.
+
+    Photometry: the stars are shared out by the tile holding their initial
+    position and each worker measures its stars on the memory mapped image,
+    which reads the pixels of the tile and a halo as wide as the centering
+    box, sky annulus and largest aperture around it. Every star is measured
+    on its own pixels only, so the results go back in input order unchanged.
+
+    With the same sigma the output is identical to running
+    nativephot.find_stars and nativephot.aperture_photometry on the whole
+    image, sigma is estimated from the whole image when it is not given.
+
+    example:
+
+    stars=mosaic.find_stars_tiled('nic2_drz.fits',workers=4,**photconfig.find_kwargs(config))
+    phot=mosaic.photometry_tiled('nic2_drz.fits',stars["XCENTER"],stars["YCENTER"],
+                                 workers=4,**photconfig.phot_kwargs(config))
+
+"""
+from __future__ import print_function, division
+
+import multiprocessing
+
+import numpy as np
+
+import nativephot
+import fitsimage
+
+TILESIZE = 1024 #tile side in pixels, without the halo
+
+#the image data and bad pixel mask in each worker process, set by _init_worker
+_IMAGE = None
+_MASK = None
+
+
+def open_image(image, ext=("SCI", 1)):
+    """
+    the pixels of an image extension, memory mapped so only the parts used
+    are read; arrays are returned as they are
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    return fitsimage.getdata(image, ext)
+
+
+def tile_grid(shape, tilesize=TILESIZE, halo=0):
+    """
+    cut an image of the given shape into tiles
+
+    returns a list of (core, outer) pairs of (row0, row1, col0, col1) bounds,
+    the cores cover the image without overlapping and outer is the core
+    grown by halo pixels on each side, clipped to the image
+    """
+    ny, nx = shape
+    tiles = list()
+    for row0 in range(0, ny, tilesize):
+        for col0 in range(0, nx, tilesize):
+            row1 = min(row0 + tilesize, ny)
+            col1 = min(col0 + tilesize, nx)
+            outer = (max(row0 - halo, 0), min(row1 + halo, ny),
+                     max(col0 - halo, 0), min(col1 + halo, nx))
+            tiles.append(((row0, row1, col0, col1), outer))
+    return tiles
+
+
+def find_halo(fwhm=3.5, nsigma=1.5, ratio=1., theta=0.):
+    """halo needed for finding, twice the half width of the detection kernel"""
+    kernel = nativephot.find_kernel(fwhm, nsigma, ratio, theta)[0]
+    return max(kernel.shape) - 1
+
+
+def _init_worker(image, ext, mask=None):
+    """open the image, and the mask extension or array if any, in a worker process"""
+    global _IMAGE, _MASK
+    _IMAGE = open_image(image, ext)
+    if mask is None or isinstance(mask, np.ndarray):
+        _MASK = mask
+    else:
+        _MASK = open_image(image, mask)
+
+
+def _start_worker(image, ext, mask=None):
+    """the pool initializer, the images of the parent are not shared with the worker"""
+    fitsimage.reset()
+    _init_worker(image, ext, mask)
+
+
+def _map(function, tasks, image, ext, workers, mask=None):
+    """run function over the tasks in a pool of workers, results in any order"""
+    global _IMAGE, _MASK
+    if workers == 1 or len(tasks) < 2:
+        _init_worker(image, ext, mask)
+        try:
+            return [function(task) for task in tasks]
+        finally:
+            _IMAGE = _MASK = None
+
+    pool = multiprocessing.Pool(processes=min(workers or multiprocessing.cpu_count(), len(tasks)),
+                                initializer=_start_worker, initargs=(image, ext, mask))
+    try:
+        return list(pool.imap_unordered(function, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _find_tile(args):
+    """detections with their peak in the core of one tile"""
+    core, outer, kwargs = args
+    row0, row1, col0, col1 = core
+    section = _IMAGE[outer[0]:outer[1], outer[2]:outer[3]]
+    stars, rows, cols = nativephot.detect(section, origin=(outer[0], outer[2]), **kwargs)
+    keep = (rows >= row0) & (rows < row1) & (cols >= col0) & (cols < col1)
+    return stars[keep], rows[keep], cols[keep]
+
+
+def find_stars_tiled(image, tilesize=TILESIZE, workers=None, ext=("SCI", 1),
+                     fwhm=3.5, threshold=3., sigma=0., nsigma=1.5, ratio=1., theta=0.,
+                     sharplo=0.2, sharphi=1., roundlo=-1., roundhi=1.):
+    """
+    nativephot.find_stars on the tiles of a large image in parallel
+
+    Parameters
+        image:    string, the FITS file, or a 2d array
+        tilesize: int, tile side in pixels
+        workers:  int, number of processes, all the cores if None, 1 runs
+                  in this process
+        ext:      the extension of the FITS file to use
+        the other parameters are the ones of nativephot.find_stars
+
+    returns the same structured array as nativephot.find_stars
+    """
+    data = open_image(image, ext)
+    if sigma <= 0:
+        sigma = nativephot.estimate_sigma(data)
+    kwargs = dict(fwhm=fwhm, threshold=threshold, sigma=sigma, nsigma=nsigma,
+                  ratio=ratio, theta=theta, sharplo=sharplo, sharphi=sharphi,
+                  roundlo=roundlo, roundhi=roundhi)
+    halo = find_halo(fwhm, nsigma, ratio, theta)
+    tasks = [(core, outer, kwargs) for core, outer in tile_grid(data.shape, tilesize, halo)]
+    results = _map(_find_tile, tasks, image, ext, workers)
+
+    stars = np.concatenate([result[0] for result in results])
+    rows = np.concatenate([result[1] for result in results])
+    cols = np.concatenate([result[2] for result in results])
+    #number them in the order of the peaks on the whole image
+    stars = stars[np.lexsort((cols, rows))]
+    stars["ID"] = np.arange(1, len(stars) + 1)
+    return stars
+
+
+def _phot_tile(args):
+    """photometry of the stars of one tile"""
+    index, x, y, kwargs = args
+    return index, nativephot.aperture_photometry(_IMAGE, x, y, mask=_MASK, **kwargs)
+
+
+def photometry_tiled(image, x, y, apertures, tilesize=TILESIZE, workers=None,
+                     ext=("SCI", 1), mask=None, **kwargs):
+    """
+    nativephot.aperture_photometry of the stars of a large image, the stars
+    of each tile measured in parallel
+
+    Parameters
+        image:     string, the FITS file, or a 2d array
+        x, y:      arrays, the initial star positions (IRAF, 1-based)
+        apertures: aperture radii in pixels, list or a phot style string
+        tilesize:  int, tile side in pixels
+        workers:   int, number of processes, all the cores if None, 1 runs
+                   in this process
+        ext:       the extension of the FITS file to use
+        mask:      the bad pixel mask, an extension of the same file like
+                   ("DQ",1) or an array, see nativephot.aperture_photometry
+        kwargs:    the other nativephot.aperture_photometry parameters
+
+    returns the same structured array as nativephot.aperture_photometry, in
+    the order of the input positions
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    naper = len(nativephot.parse_apertures(apertures))
+    kwargs["apertures"] = apertures
+
+    #the tile each star starts in, stars off the image go to the nearest tile
+    data = open_image(image, ext)
+    ny, nx = data.shape
+    trow = np.clip(np.floor(y - 0.5).astype(np.intp), 0, ny - 1) // tilesize
+    tcol = np.clip(np.floor(x - 0.5).astype(np.intp), 0, nx - 1) // tilesize
+    tile = trow * ((nx + tilesize - 1) // tilesize) + tcol
+    order = np.argsort(tile, kind="mergesort")
+    bounds = np.nonzero(np.diff(tile[order]))[0] + 1
+    tasks = [(index, x[index], y[index], kwargs)
+             for index in np.split(order, bounds) if len(index)]
+
+    result = np.zeros(len(x), dtype=nativephot.phot_dtype(naper))
+    for index, photometry in _map(_phot_tile, tasks, image, ext, workers, mask):
+        result[index] = photometry
+    result["ID"] = np.arange(1, len(x) + 1)
+    return result
@@ -0,0 +1,734 @@
+"""
+    Native numpy aperture photometry and source finding, in-process alternatives
+    to running iraf.daophot.phot from aperphot.do_phot and iraf.daofind from
+    aperphot.find_objects
+
+    All the stars are measured together: the pixels around every star are
+    gathered with one fancy-indexing operation and the exact area of overlap
+    between each pixel and each circular aperture is computed analytically,
+    so there is no IRAF round-trip and no text file to parse afterwards.
+
+    The result is a numpy structured array holding the same numerical columns
+    as the phot output (XCENTER, YCENTER, MSKY, RAPERT, SUM, AREA, FLUX, MAG,
+    MERR, PERROR...). The per-aperture columns have one entry per aperture
+    and undefined (INDEF) values are NaN.
+
+    find_stars does the daofind job in memory: the image is convolved with the
+    normalised gaussian kernel set by the findpars, local maxima above the
+    threshold are picked and the sharpness and roundness of all of them are
+    computed together. It returns a structured array with the .stars columns,
+    write_stars saves it in the daofind format when a file is wanted.
+
+    Coordinates follow the IRAF convention, the center of the first pixel is
+    at (1.,1.)
+
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+# error codes and names written in the CIER/SIER/PIER and matching
+# CERROR/SERROR/PERROR columns, following the apphot names
+NOERROR = 0
+OFFIMAGE = 101
+EDGEIMAGE = 102
+NOSKY = 103
+BADPIXELS = 104
+BIGSHIFT = 107
+ERRNAMES = {NOERROR: "NoError", OFFIMAGE: "OffImage", EDGEIMAGE: "EdgeImage",
+            NOSKY: "NoSky", BADPIXELS: "BadPixels", BIGSHIFT: "BigShift"}
+
+#how many stars to gather at once, this keeps the temporary arrays small
+CHUNKSIZE = 2000
+
+
+def parse_apertures(aper):
+    """
+    turn a phot aperture string like "4." , "2,4,6" or "1:9:2" into a list of floats
+    """
+    if not isinstance(aper, str):
+        try:
+            return [float(a) for a in aper]
+        except TypeError:
+            return [float(aper)]
+
+    apertures = list()
+    for item in aper.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if ":" in item:
+            #IRAF style range start:end:step, end included
+            parts = [float(p) for p in item.split(":")]
+            start, end = parts[0], parts[1]
+            step = parts[2] if len(parts) > 2 else 1.
+            apertures.extend(np.arange(start, end + step / 2., step).tolist())
+        else:
+            apertures.append(float(item))
+    return apertures
+
+
+def read_coords(coord_list):
+    """
+    read x,y positions from a coordinate file, like the .stars file from daofind
+    the first two columns are used and comment lines starting with # are skipped
+    """
+    coords = np.loadtxt(coord_list, comments="#", usecols=(0, 1))
+    coords = np.atleast_2d(coords)
+    return coords[:, 0], coords[:, 1]
+
+
+def circle_overlap(x0, y0, x1, y1, r):
+    """
+    exact area of the rectangles [x0,x1]x[y0,y1] which lies inside
+    a circle of radius r centered on the origin, all arguments broadcast
+    """
+    return (_signed_area(x1, y1, r) - _signed_area(x0, y1, r) -
+            _signed_area(x1, y0, r) + _signed_area(x0, y0, r))
+
+
+def _signed_area(x, y, r):
+    """area of the circle between the axes and the point (x,y), signed by quadrant"""
+    return np.sign(x) * np.sign(y) * _quadrant_area(np.abs(x), np.abs(y), r)
+
+
+def _quadrant_area(x, y, r):
+    """area of the circle inside 0<=u<=x, 0<=v<=y for x,y >= 0"""
+    x = np.minimum(x, r)
+    y = np.minimum(y, r)
+    ucross = np.sqrt(np.maximum(r * r - y * y, 0.))  #where the circle crosses v=y
+    u0 = np.minimum(ucross, x)
+    return y * u0 + _arc_integral(x, r) - _arc_integral(u0, r)
+
+
+def _arc_integral(u, r):
+    """integral of sqrt(r**2-t**2) from 0 to u"""
+    return 0.5 * (u * np.sqrt(np.maximum(r * r - u * u, 0.)) +
+                  r * r * np.arcsin(np.clip(u / r, -1., 1.)))
+
+
+def gather(data, x, y, half=None, offsets=None):
+    """
+    collect the pixels in a (2*half+1) square box around each position, or at
+    the given (row offsets, column offsets) from the nearest pixel
+
+    returns the pixel values, the pixel center coordinates and a mask of the pixels
+    which are actually on the image (off-image pixels have a value of NaN), all
+    with shape (nstars, npixels)
+    """
+    ny, nx = data.shape
+    if offsets is None:
+        box = np.arange(-half, half + 1)
+        dy, dx = np.meshgrid(box, box, indexing="ij")
+    else:
+        dy, dx = offsets
+    ix = np.floor(np.asarray(x) + 0.5).astype(np.intp)
+    iy = np.floor(np.asarray(y) + 0.5).astype(np.intp)
+    cols = ix[:, np.newaxis] + dx.ravel()
+    rows = iy[:, np.newaxis] + dy.ravel()
+    valid = (cols >= 1) & (cols <= nx) & (rows >= 1) & (rows <= ny)
+    values = data[np.clip(rows - 1, 0, ny - 1), np.clip(cols - 1, 0, nx - 1)]
+    values = np.where(valid, values, np.nan)
+    valid &= np.isfinite(values)
+    return values, cols, rows, valid
+
+
+def gather_mask(mask, cols, rows, valid):
+    """which of the pixels returned by gather are set (non zero) in a bad pixel mask"""
+    ny, nx = mask.shape
+    return (mask[np.clip(rows - 1, 0, ny - 1), np.clip(cols - 1, 0, nx - 1)] != 0) & valid
+
+
+def centroid(data, x, y, cbox=7., cmaxiter=10, maxshift=1.):
+    """
+    vectorized version of the apphot centroid algorithm
+
+    the marginal distributions in a cbox wide box are computed, the mean of each
+    marginal is subtracted and the positive part used as the weights for the center
+    the box is moved and the center recomputed until it stays on the same pixel
+
+    returns xcenter, ycenter and the CIER error code for each star
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    half = max(int(cbox / 2.), 1)
+    size = 2 * half + 1
+    offsets = np.arange(-half, half + 1)
+
+    xc = x.copy()
+    yc = y.copy()
+    cier = np.zeros(len(x), dtype=np.int32)
+    active = np.ones(len(x), dtype=bool)
+    for iteration in range(max(int(cmaxiter), 1)):
+        idx = np.where(active)[0]
+        if len(idx) == 0:
+            break
+        values, cols, rows, valid = gather(data, xc[idx], yc[idx], half)
+        values = np.where(valid, values, 0.).reshape(-1, size, size)
+        offimage = ~valid.any(axis=1)
+
+        mx = values.sum(axis=1)
+        my = values.sum(axis=2)
+        wx = np.maximum(mx - mx.mean(axis=1)[:, np.newaxis], 0.)
+        wy = np.maximum(my - my.mean(axis=1)[:, np.newaxis], 0.)
+        sx = wx.sum(axis=1)
+        sy = wy.sum(axis=1)
+        good = (sx > 0) & (sy > 0) & ~offimage
+        cier[idx[offimage]] = OFFIMAGE
+
+        ix = np.floor(xc[idx] + 0.5)
+        iy = np.floor(yc[idx] + 0.5)
+        newx = np.where(good, ix + (wx * offsets).sum(axis=1) / np.where(good, sx, 1.), xc[idx])
+        newy = np.where(good, iy + (wy * offsets).sum(axis=1) / np.where(good, sy, 1.), yc[idx])
+        moved = (np.floor(newx + 0.5) != ix) | (np.floor(newy + 0.5) != iy)
+        xc[idx] = newx
+        yc[idx] = newy
+        active[idx[~(moved & good)]] = False
+
+    bigshift = (np.abs(xc - x) > maxshift) | (np.abs(yc - y) > maxshift)
+    cier[(cier == NOERROR) & bigshift] = BIGSHIFT
+    return xc, yc, cier
+
+
+# the sky algorithms of fitskypars.salgorithm that sky_annulus knows
+SKY_ALGORITHMS = ("median", "mean", "mode", "centroid")
+
+
+def annulus_offsets(annulus, dannulus):
+    """
+    the pixel offsets from the nearest pixel to a star that can fall in its sky
+    annulus, wherever the star is inside that pixel
+
+    returns the row and column offsets, flat arrays
+    """
+    rout = annulus + dannulus
+    half = int(np.ceil(rout)) + 1
+    dy, dx = np.mgrid[-half:half + 1, -half:half + 1]
+    r = np.hypot(dx, dy)
+    #the star is at most sqrt(0.5) from the center of its nearest pixel
+    ring = (r >= annulus - 0.75) & (r <= rout + 0.75)
+    return dy[ring], dx[ring]
+
+
+def sky_annulus(data, x, y, annulus=8., dannulus=3., smaxiter=10, sloreject=3.,
+                shireject=3., datamin=None, datamax=None, mask=None,
+                salgorithm="median", khist=3., binsize=0.1):
+    """
+    sky in the annulus around every star with iterative sigma clipping, all the
+    stars at once
+
+    The annulus pixels of every star are gathered together using the offsets
+    from annulus_offsets, and each star's pixels are sorted once. Since the
+    clipping rejects everything below or above a level, the pixels kept are
+    always a contiguous run of the sorted ones, so an iteration only moves the
+    two ends of each run and the sums for the mean and sigma come from running
+    sums instead of going over the pixels again. The pixels set in mask are
+    left out like the ones outside datamin, datamax.
+
+    salgorithm is the estimate of the sky level, which is also the center of
+    the clipping:
+        median:   the median of the pixels
+        mean:     the mean of the pixels
+        mode:     3*median - 2*mean, or the mean when it is below the median
+        centroid: the mean of the histogram of the pixels within khist sigma of
+                  the median, in bins binsize sigma wide
+
+    returns msky, stdev, sskew, nsky, nsrej and the SIER error code for each star
+    """
+    if salgorithm not in SKY_ALGORITHMS:
+        raise ValueError("Unknown sky algorithm %s, use one of %s" % (salgorithm, SKY_ALGORITHMS))
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    offsets = annulus_offsets(annulus, dannulus)
+    results = [_sky_chunk(data, x[start:start + CHUNKSIZE], y[start:start + CHUNKSIZE],
+                          offsets, annulus, dannulus, smaxiter, sloreject, shireject,
+                          datamin, datamax, mask, salgorithm, khist, binsize)
+               for start in range(0, len(x), CHUNKSIZE)]
+    if not results:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty.astype(int), empty.astype(int), empty.astype(np.int32)
+    return tuple(np.concatenate(column) for column in zip(*results))
+
+
+def _sky_chunk(data, x, y, offsets, annulus, dannulus, smaxiter, sloreject, shireject,
+               datamin, datamax, mask, salgorithm, khist, binsize):
+    """sky_annulus for one chunk of stars"""
+    rout = annulus + dannulus
+    values, cols, rows, valid = gather(data, x, y, offsets=offsets)
+    r = np.hypot(cols - x[:, np.newaxis], rows - y[:, np.newaxis])
+    inann = valid & (r >= annulus) & (r <= rout)
+    with np.errstate(invalid="ignore"):
+        if datamin is not None:
+            inann &= values >= datamin
+        if datamax is not None:
+            inann &= values <= datamax
+    if mask is not None:
+        inann &= ~gather_mask(mask, cols, rows, valid)
+    nann = inann.sum(axis=1)
+
+    #sorted annulus pixels first in each row, measured from a level near the sky
+    #so the running sums of the powers do not lose precision
+    sky = np.where(inann, values, np.inf)
+    sky.sort(axis=1)
+    star = np.arange(len(x))
+    level = np.where(nann > 0, sky[star, np.maximum(nann - 1, 0) // 2], 0.)
+    sky -= level[:, np.newaxis]
+    inann = np.isfinite(sky)
+    finite = np.where(inann, sky, 0.)
+    sums = list()
+    power = finite
+    for order in range(3):
+        cumulative = np.zeros((sky.shape[0], sky.shape[1] + 1))
+        np.cumsum(power, axis=1, out=cumulative[:, 1:])
+        sums.append(cumulative)
+        power = power * finite
+
+    #the kept pixels are sky[lo:hi] in each row
+    lo = np.zeros(len(x), dtype=np.intp)
+    hi = nann.astype(np.intp)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for iteration in range(int(smaxiter)):
+            center, mean, sd = _sky_level(sky, sums, lo, hi, salgorithm, khist, binsize)
+            newlo = np.maximum(lo, (sky < (center - sloreject * sd)[:, np.newaxis]).sum(axis=1))
+            newhi = np.minimum(hi, (sky <= (center + shireject * sd)[:, np.newaxis]).sum(axis=1))
+            #a sigma of zero or NaN would reject everything, leave those alone
+            same = ~(sd > 0) | (newhi <= newlo)
+            newlo[same] = lo[same]
+            newhi[same] = hi[same]
+            if (newlo == lo).all() and (newhi == hi).all():
+                break
+            lo, hi = newlo, newhi
+
+        center, mean, sd = _sky_level(sky, sums, lo, hi, salgorithm, khist, binsize)
+        nsky = hi - lo
+        third = (_range_sum(sums[2], lo, hi) - 3 * mean * _range_sum(sums[1], lo, hi)) / nsky + 2 * mean**3
+        sskew = np.sign(third) * np.abs(third)**(1. / 3.)
+    msky = center + level
+    sier = np.where(nsky > 0, NOERROR, NOSKY).astype(np.int32)
+    return msky, sd, sskew, nsky, nann - nsky, sier
+
+
+def _range_sum(cumulative, lo, hi):
+    """the sums of the values lo to hi-1 of each row from their running sums"""
+    star = np.arange(len(lo))
+    return cumulative[star, hi] - cumulative[star, lo]
+
+
+def _sky_level(sky, sums, lo, hi, salgorithm, khist, binsize):
+    """the sky estimate, mean and sigma of the sorted pixels sky[lo:hi] of every row"""
+    star = np.arange(len(lo))
+    n = hi - lo
+    mean = _range_sum(sums[0], lo, hi) / n
+    sd = np.sqrt(np.maximum(_range_sum(sums[1], lo, hi) / n - mean**2, 0.))
+    last = sky.shape[1] - 1
+    median = 0.5 * (sky[star, np.clip((lo + hi - 1) // 2, 0, last)] +
+                    sky[star, np.clip((lo + hi) // 2, 0, last)])
+    median[n == 0] = np.nan
+
+    if salgorithm == "median":
+        center = median
+    elif salgorithm == "mean":
+        center = mean
+    elif salgorithm == "mode":
+        center = np.where(mean < median, mean, 3. * median - 2. * mean)
+    else:
+        #the pixels in the histogram, counted at the center of their bin
+        width = binsize * sd
+        start = median - khist * sd
+        kept = np.arange(sky.shape[1]) - lo[:, np.newaxis]
+        kept = (kept >= 0) & (kept < n[:, np.newaxis])
+        position = (sky - start[:, np.newaxis]) / width[:, np.newaxis]
+        inhist = kept & (position >= 0) & (position < 2 * khist / binsize)
+        bins = np.where(inhist, np.floor(position) + 0.5, 0.)
+        count = inhist.sum(axis=1)
+        center = np.where(count > 0, start + width * bins.sum(axis=1) / count, median)
+    return center, mean, sd
+
+
+def phot_dtype(naper):
+    """the structured array type used for the photometry results"""
+    return np.dtype([("ID", np.int32),
+                     ("XINIT", np.float64), ("YINIT", np.float64),
+                     ("XCENTER", np.float64), ("YCENTER", np.float64),
+                     ("XSHIFT", np.float64), ("YSHIFT", np.float64),
+                     ("CIER", np.int32), ("CERROR", "S9"),
+                     ("MSKY", np.float64), ("STDEV", np.float64),
+                     ("SSKEW", np.float64), ("NSKY", np.int32),
+                     ("NSREJ", np.int32), ("SIER", np.int32), ("SERROR", "S9"),
+                     ("ITIME", np.float64),
+                     ("RAPERT", np.float64, (naper,)), ("SUM", np.float64, (naper,)),
+                     ("AREA", np.float64, (naper,)), ("FLUX", np.float64, (naper,)),
+                     ("MAG", np.float64, (naper,)), ("MERR", np.float64, (naper,)),
+                     ("PIER", np.int32, (naper,)), ("PERROR", "S9", (naper,))])
+
+
+def _errnames(codes):
+    """map an array of error codes to their names"""
+    names = np.empty(np.shape(codes), dtype="S9")
+    for code, name in ERRNAMES.items():
+        names[codes == code] = name
+    return names
+
+
+def aperture_photometry(data, x, y, apertures, annulus=8., dannulus=3., zmag=25.,
+                        epadu=1., readnoise=0., itime=1., datamin=None, datamax=None,
+                        cbox=7., cmaxiter=10, maxshift=1., recenter=True,
+                        smaxiter=10, sloreject=3., shireject=3., mask=None,
+                        salgorithm="median", khist=3., binsize=0.1):
+    """
+    measure the flux of every star in several apertures at once
+
+    Parameters
+        data:       2d array, the image pixels
+        x, y:       arrays, the initial star positions (IRAF, 1-based)
+        apertures:  aperture radii in pixels, list or a phot style string
+        annulus:    float, inner radius of the sky annulus
+        dannulus:   float, width of the sky annulus
+        zmag:       float, the magnitude zeropoint
+        epadu:      float, effective gain in electrons per data unit
+        readnoise:  float, readnoise in electrons, part of the phot parameters
+                    but not of the errors, which take the sky noise from the annulus.
+                    Stars without a sky are flagged NoSky in SIER and PIER
+        itime:      float, exposure time the data are normalised to
+        datamin, datamax: good data limits, None for no limit
+        mask:       2d array, non zero for the bad pixels (e.g. the DQ array),
+                    they are not used for the sky and flag the apertures they
+                    fall in as BadPixels, like the pixels outside datamin, datamax
+        salgorithm, khist, binsize: how the sky level is estimated, see sky_annulus
+
+    the magnitude errors follow phot:
+
+        merr = 1.0857 * sqrt(flux/epadu + area*stdev**2 + area**2*stdev**2/nsky) / flux
+
+    returns a structured array, see phot_dtype()
+    """
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float64)
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    apertures = np.asarray(parse_apertures(apertures), dtype=np.float64)
+    naper = len(apertures)
+
+    result = np.zeros(len(x), dtype=phot_dtype(naper))
+    result["ID"] = np.arange(1, len(x) + 1)
+    result["XINIT"] = x
+    result["YINIT"] = y
+    result["ITIME"] = itime
+    result["RAPERT"] = apertures
+
+    for start in range(0, len(x), CHUNKSIZE):
+        chunk = slice(start, start + CHUNKSIZE)
+        _measure(data, result[chunk], apertures, annulus, dannulus, zmag, epadu,
+                 readnoise, itime, datamin, datamax, cbox, cmaxiter, maxshift,
+                 recenter, smaxiter, sloreject, shireject, mask, salgorithm, khist, binsize)
+
+    result["CERROR"] = _errnames(result["CIER"])
+    result["SERROR"] = _errnames(result["SIER"])
+    result["PERROR"] = _errnames(result["PIER"])
+    return result
+
+
+def _measure(data, out, apertures, annulus, dannulus, zmag, epadu, readnoise,
+             itime, datamin, datamax, cbox, cmaxiter, maxshift, recenter,
+             smaxiter, sloreject, shireject, mask, salgorithm, khist, binsize):
+    """fill in one chunk of the result array"""
+    x = out["XINIT"]
+    y = out["YINIT"]
+    if recenter:
+        xc, yc, cier = centroid(data, x, y, cbox=cbox, cmaxiter=cmaxiter,
+                                maxshift=maxshift)
+    else:
+        xc, yc, cier = x.copy(), y.copy(), np.zeros(len(x), dtype=np.int32)
+    out["XCENTER"] = xc
+    out["YCENTER"] = yc
+    out["XSHIFT"] = xc - x
+    out["YSHIFT"] = yc - y
+    out["CIER"] = cier
+
+    msky, stdev, sskew, nsky, nsrej, sier = sky_annulus(
+        data, xc, yc, annulus, dannulus, smaxiter=smaxiter, sloreject=sloreject,
+        shireject=shireject, datamin=datamin, datamax=datamax, mask=mask,
+        salgorithm=salgorithm, khist=khist, binsize=binsize)
+    out["MSKY"] = msky
+    out["STDEV"] = stdev
+    out["SSKEW"] = sskew
+    out["NSKY"] = nsky
+    out["NSREJ"] = nsrej
+    out["SIER"] = sier
+
+    #one gather for all apertures, large enough for the biggest one
+    values, cols, rows, valid = gather(data, xc, yc, int(np.ceil(apertures.max())) + 1)
+    px0 = cols - 0.5 - xc[:, np.newaxis]
+    py0 = rows - 0.5 - yc[:, np.newaxis]
+    bad = np.zeros(values.shape, dtype=bool)
+    with np.errstate(invalid="ignore"):
+        if datamin is not None:
+            bad |= valid & (values < datamin)
+        if datamax is not None:
+            bad |= valid & (values > datamax)
+    if mask is not None:
+        bad |= gather_mask(mask, cols, rows, valid)
+    pixels = np.where(valid, values, 0.)
+
+    skyvar = stdev**2
+    for k, r in enumerate(apertures):
+        weight = circle_overlap(px0, py0, px0 + 1., py0 + 1., r)
+        inside = weight > 0
+        total = (weight * pixels).sum(axis=1)
+        area = np.where(valid, weight, 0.).sum(axis=1)
+        flux = total - area * msky
+
+        pier = np.zeros(len(x), dtype=np.int32)
+        pier[(inside & bad).any(axis=1)] = BADPIXELS
+        pier[sier != NOERROR] = NOSKY
+        pier[(inside & ~valid).any(axis=1)] = EDGEIMAGE
+        pier[area <= 0] = OFFIMAGE
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = (flux / epadu + area * skyvar +
+                        area**2 * skyvar / np.maximum(nsky, 1))
+            mag = zmag - 2.5 * np.log10(flux) + 2.5 * np.log10(itime)
+            merr = 1.0857 * np.sqrt(variance) / flux
+            #no sky (NaN) or no flux is flagged in SIER/PIER, the comparisons need not warn
+            undefined = (flux <= 0) | (pier != NOERROR) | ~np.isfinite(mag)
+        mag[undefined] = np.nan
+        merr[undefined] = np.nan
+
+        out["SUM"][:, k] = total
+        out["AREA"][:, k] = area
+        out["FLUX"][:, k] = flux
+        out["MAG"][:, k] = mag
+        out["MERR"][:, k] = merr
+        out["PIER"][:, k] = pier
+
+
+def find_dtype():
+    """the structured array type used for the detections, the daofind columns"""
+    return np.dtype([("XCENTER", np.float64), ("YCENTER", np.float64),
+                     ("MAG", np.float64), ("SHARPNESS", np.float64),
+                     ("SROUND", np.float64), ("GROUND", np.float64),
+                     ("ID", np.int32)])
+
+
+def find_kernel(fwhm=3.5, nsigma=1.5, ratio=1., theta=0.):
+    """
+    the daofind detection kernel
+
+    an elliptical gaussian with the given fwhm along the major axis, minor/major
+    axis ratio and position angle theta (degrees counter clockwise from x),
+    truncated at nsigma and normalised to zero sum so the convolution gives the
+    amplitude of the best fitting gaussian above the local background
+
+    returns the kernel, its footprint mask, the unnormalised gaussian and the
+    relative error used to scale the detection threshold
+    """
+    xsigma = 0.42466 * fwhm
+    ysigma = xsigma * ratio
+    cost = np.cos(np.radians(theta))
+    sint = np.sin(np.radians(theta))
+    a = cost**2 / (2 * xsigma**2) + sint**2 / (2 * ysigma**2)
+    b = 0.5 * cost * sint * (1. / xsigma**2 - 1. / ysigma**2)
+    c = sint**2 / (2 * xsigma**2) + cost**2 / (2 * ysigma**2)
+
+    #half widths of the box holding the nsigma ellipse
+    nx = max(2, int(nsigma * np.sqrt((xsigma * cost)**2 + (ysigma * sint)**2)))
+    ny = max(2, int(nsigma * np.sqrt((xsigma * sint)**2 + (ysigma * cost)**2)))
+    dy, dx = np.mgrid[-ny:ny + 1, -nx:nx + 1]
+    exponent = a * dx**2 + 2 * b * dx * dy + c * dy**2
+    gauss = np.exp(-exponent)
+    mask = exponent <= 0.5 * nsigma**2
+    npix = mask.sum()
+
+    denom = (gauss[mask]**2).sum() - gauss[mask].sum()**2 / npix
+    kernel = np.where(mask, (gauss - gauss[mask].sum() / npix) / denom, 0.)
+    return kernel, mask, gauss, 1. / np.sqrt(denom)
+
+
+def estimate_sigma(data):
+    """robust estimate of the background noise from the median absolute deviation"""
+    sample = np.asarray(data)
+    if sample.size > 1000000:
+        step = int(np.sqrt(sample.size / 1000000.)) + 1
+        sample = sample[::step, ::step]
+    sample = sample[np.isfinite(sample)]
+    return 1.4826 * np.median(np.abs(sample - np.median(sample)))
+
+
+def find_stars(data, fwhm=3.5, threshold=3., sigma=0., nsigma=1.5, ratio=1., theta=0.,
+               sharplo=0.2, sharphi=1., roundlo=-1., roundhi=1.):
+    """
+    find the stars in an image like daofind, all in memory
+
+    Parameters
+        data:       2d array, the image pixels
+        fwhm:       float, the fwhm of the stars in pixels (datapars.fwhmpsf)
+        threshold:  float, detection threshold in units of sigma
+        sigma:      float, the background noise (datapars.sigma), when this is
+                    zero or less it is estimated from the image
+        nsigma, ratio, theta: the shape of the convolution kernel
+        sharplo, sharphi, roundlo, roundhi: the limits on the shape of the
+                    detections, roundness is checked for both SROUND and GROUND
+
+    returns a structured array with XCENTER, YCENTER (1-based), MAG,
+    SHARPNESS, SROUND, GROUND and ID for each detection, see find_dtype()
+    """
+    data = np.asarray(data)
+    if sigma <= 0:
+        sigma = estimate_sigma(data)
+    stars, rows, cols = detect(data, fwhm, threshold, sigma, nsigma, ratio, theta,
+                               sharplo, sharphi, roundlo, roundhi)
+    stars["ID"] = np.arange(1, len(stars) + 1)
+    return stars
+
+
+def detect(data, fwhm, threshold, sigma, nsigma, ratio, theta, sharplo, sharphi,
+           roundlo, roundhi, origin=(0, 0)):
+    """
+    the work of find_stars for a known sigma, without the IDs
+
+    origin is the (row, column) of data[0,0] when data is a section of a
+    larger image, the positions are then given on the larger image
+
+    returns the detections and the (0-based) row and column of their peak
+    pixels on the larger image, in the row by row order of the peaks
+    """
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float32)
+    bad = ~np.isfinite(data)
+    if bad.any():
+        data = np.where(bad, 0., data).astype(data.dtype)
+
+    #scipy.ndimage is imported here, not by modules which only read the results
+    from scipy import ndimage
+
+    kernel, mask, gauss, relerr = find_kernel(fwhm, nsigma, ratio, theta)
+    conv = ndimage.convolve(data, kernel.astype(data.dtype), mode="constant", cval=0.)
+    thresh = threshold * sigma * relerr
+
+    #candidates are the pixels above threshold away from the edges
+    khy, khx = (np.array(kernel.shape) - 1) // 2
+    ny, nx = data.shape
+    above = conv > thresh
+    above[:khy, :] = False
+    above[ny - khy:, :] = False
+    above[:, :khx] = False
+    above[:, nx - khx:] = False
+    rows, cols = np.nonzero(above)
+
+    #keep the local maxima in the kernel footprint, ties go to the first pixel
+    dy, dx = np.nonzero(mask)
+    dy = dy - khy
+    dx = dx - khx
+    peak = conv[rows, cols]
+    ismax = np.ones(len(rows), dtype=bool)
+    for oy, ox in zip(dy, dx):
+        if oy == 0 and ox == 0:
+            continue
+        other = conv[rows + oy, cols + ox]
+        if (oy, ox) < (0, 0):
+            ismax &= peak > other
+        else:
+            ismax &= peak >= other
+    rows = rows[ismax]
+    cols = cols[ismax]
+    peak = peak[ismax]
+
+    #cutouts of the data and the convolved image around every peak
+    oy, ox = np.mgrid[-khy:khy + 1, -khx:khx + 1]
+    crow = rows[:, np.newaxis, np.newaxis] + oy
+    ccol = cols[:, np.newaxis, np.newaxis] + ox
+    dcut = data[crow, ccol].astype(np.float64)
+    ccut = conv[crow, ccol].astype(np.float64)
+
+    #sharpness, the height of the central pixel over its neighbours compared to
+    #the height of the best fitting gaussian
+    center = dcut[:, khy, khx]
+    neighbours = mask.copy()
+    neighbours[khy, khx] = False
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sharp = (center - (dcut * neighbours).sum(axis=(1, 2)) / neighbours.sum()) / peak
+
+        #symmetry roundness from the convolved image quadrants
+        cc = ccut * mask
+        cc[:, khy, khx] = 0.
+        quad = np.zeros(mask.shape)
+        quad[(oy <= 0) & (ox > 0)] = -1.
+        quad[(oy < 0) & (ox <= 0)] = 1.
+        quad[(oy >= 0) & (ox < 0)] = -1.
+        quad[(oy > 0) & (ox >= 0)] = 1.
+        sround = 2. * (cc * quad).sum(axis=(1, 2)) / np.abs(cc).sum(axis=(1, 2))
+
+        #gaussian roundness and centers from fits to the marginal distributions
+        hx, shiftx = _marginal_fit(dcut, gauss, axis=0)
+        hy, shifty = _marginal_fit(dcut, gauss, axis=1)
+        ground = 2. * (hx - hy) / (hx + hy)
+
+        mag = -2.5 * np.log10(peak / thresh)
+
+    good = ((sharp >= sharplo) & (sharp <= sharphi) &
+            (sround >= roundlo) & (sround <= roundhi) &
+            (ground >= roundlo) & (ground <= roundhi) &
+            (hx > 0) & (hy > 0))
+    good &= (np.abs(shiftx) <= khx) & (np.abs(shifty) <= khy)
+
+    rows = rows[good] + origin[0]
+    cols = cols[good] + origin[1]
+    stars = np.zeros(len(rows), dtype=find_dtype())
+    stars["XCENTER"] = cols + 1 + shiftx[good]
+    stars["YCENTER"] = rows + 1 + shifty[good]
+    stars["MAG"] = mag[good]
+    stars["SHARPNESS"] = sharp[good]
+    stars["SROUND"] = sround[good]
+    stars["GROUND"] = ground[good]
+    return stars, rows, cols
+
+
+def _marginal_fit(cutouts, gauss, axis):
+    """
+    fit the marginal distributions of the cutouts with the gaussian marginal
+
+    a linear least squares fit of sky + h*marginal with triangular weights gives
+    the amplitude h, a first order fit of the residual gives the shift of the center
+    axis=0 gives the x marginal (summed along y), axis=1 the y marginal
+    returns the amplitudes and the shifts
+    """
+    kern = gauss.sum(axis=axis)
+    data = cutouts.sum(axis=axis + 1)
+    size = len(kern)
+    half = (size - 1) // 2
+    u = np.arange(size) - half
+    wt = (half + 1. - np.abs(u))
+    wsum = wt.sum()
+
+    ksum = (wt * kern).sum()
+    k2sum = (wt * kern**2).sum()
+    dsum = (data * wt).sum(axis=1)
+    dksum = (data * wt * kern).sum(axis=1)
+    amp = (dksum - dsum * ksum / wsum) / (k2sum - ksum**2 / wsum)
+    sky = (dsum - amp * ksum) / wsum
+
+    #d(model)/d(shift) = amp*u*kern/var for a gaussian marginal of variance var
+    var = (u**2 * kern).sum() / kern.sum()
+    deriv = u * kern / var
+    resid = data - sky[:, np.newaxis] - amp[:, np.newaxis] * kern
+    shift = (wt * resid * deriv).sum(axis=1) / (amp * (wt * deriv**2).sum())
+    return amp, shift
+
+
+def write_stars(stars, filename):
+    """
+    save the detections from find_stars in the daofind output format,
+    so they can be used as the coords file for phot
+    """
+    out = open(filename, "w")
+    out.write("#N XCENTER   YCENTER   MAG      SHARPNESS   SROUND      GROUND      ID         \\\n")
+    out.write("#U pixels    pixels    #        #           #           #           #          \\\n")
+    out.write("#F %-13.3f   %-10.3f   %-9.3f   %-12.3f     %-12.3f     %-12.3f     %-6d       \n")
+    out.write("#\n")
+    for star in stars:
+        out.write("   %-10.3f%-10.3f%-9.3f%-12.3f%-12.3f%-12.3f%-6d\n" % (
+            star["XCENTER"], star["YCENTER"], star["MAG"], star["SHARPNESS"],
+            star["SROUND"], star["GROUND"], star["ID"]))
+    out.close()
@@ -0,0 +1,143 @@
+"""
+    Immutable photometry configuration
+
+    The IRAF tasks read their parameters from process-global parameter sets
+    (datapars, centerpars, fitskypars, findpars, photpars, daopars), so two
+    photometry runs with different settings in the same process step on each
+    other. Here each parameter set is a namedtuple holding the same values,
+    using the full IRAF parameter names, and PhotConfig bundles them. The
+    config is handed explicitly to every stage of aperphot, which makes it safe
+    to run several configurations at the same time, and since it is immutable
+    and hashable it can also be used as a dictionary or cache key.
+
+    INDEF values are None, IRAF booleans are kept as "yes"/"no".
+
+    example:
+
+    config=photconfig.nicmos_config(epadu=7602.6)
+    wide=photconfig.replace(config,"photpars",apertures="2,4,8")
+    aperphot.do_phot('myimage.fits',stars,config=wide,backend="numpy")
+
+"""
+from __future__ import print_function, division
+
+from collections import namedtuple
+
+FWHM = 3.5 #fwhm of the stars in pixels
+READNOISE = 26. #NICMOS readnoise in electrons
+
+DataPars = namedtuple("DataPars", ["scale", "fwhmpsf", "emission", "sigma", "datamin",
+                                   "datamax", "noise", "ccdread", "gain", "readnoise",
+                                   "epadu", "airmass", "filter", "itime"])
+
+CenterPars = namedtuple("CenterPars", ["calgorithm", "cbox", "cthreshold", "minsnratio",
+                                       "cmaxiter", "maxshift", "clean", "rclean", "rclip",
+                                       "kclean", "mkcenter"])
+
+FitSkyPars = namedtuple("FitSkyPars", ["salgorithm", "annulus", "dannulus", "skyvalue",
+                                       "smaxiter", "sloclip", "shiclip", "snreject",
+                                       "sloreject", "shireject", "khist", "binsize"])
+
+FindPars = namedtuple("FindPars", ["threshold", "nsigma", "ratio", "theta", "sharplo",
+                                   "sharphi", "roundlo", "roundhi", "mkdetections"])
+
+PhotPars = namedtuple("PhotPars", ["weighting", "apertures", "zmag", "mkapert"])
+
+DaoPars = namedtuple("DaoPars", ["function", "varorder", "nclean", "saturated",
+                                 "matchradius", "psfrad", "fitrad", "recenter", "fitsky",
+                                 "groupsky", "sannulus", "wsannulus", "flaterr", "proferr",
+                                 "maxiter", "clipexp", "cliprange", "mergerad",
+                                 "critsnratio", "maxgroup", "text"])
+
+PhotConfig = namedtuple("PhotConfig", ["datapars", "centerpars", "fitskypars", "findpars",
+                                       "photpars", "daopars"])
+
+
+def nicmos_config(epadu=1., aper="4.", sky_annulus=8., width_sky=3., zeropoint=25.):
+    """
+    the NICMOS settings used by aperphot
+
+    Parameters
+        epadu:       float, the effective gain
+        aper:        string, the photometry aperture(s)
+        sky_annulus: float, where to start the sky annulus
+        width_sky:   float, how wide the sky annulus is
+        zeropoint:   float, the magnitude zeropoint
+    """
+    datapars = DataPars(scale=1., fwhmpsf=FWHM, emission="yes", sigma=0., datamin=-0.001,
+                        datamax=None, noise="poisson", ccdread="", gain="",
+                        readnoise=READNOISE, epadu=epadu, airmass="", filter="filter",
+                        itime=1.)
+
+    centerpars = CenterPars(calgorithm="centroid", cbox=7., cthreshold=0., minsnratio=1.,
+                            cmaxiter=10, maxshift=1., clean="no", rclean=1., rclip=2.,
+                            kclean=3., mkcenter="no")
+
+    fitskypars = FitSkyPars(salgorithm="centroid", annulus=sky_annulus, dannulus=width_sky,
+                            skyvalue=0., smaxiter=10, sloclip=0., shiclip=0., snreject=50,
+                            sloreject=3., shireject=3., khist=3., binsize=0.1)
+
+    findpars = FindPars(threshold=3.0, #3sigma detections only
+                        nsigma=1.5, #width of convolution kernal in sigma
+                        ratio=1.0, #ratio of gaussian axes
+                        theta=0.,
+                        sharplo=0.2, #lower bound on feature
+                        sharphi=1.0, #upper bound on feature
+                        roundlo=-1.0, #lower bound on roundness
+                        roundhi=1.0, #upper bound on roundness
+                        mkdetections="no")
+
+    photpars = PhotPars(weighting="constant", apertures=str(aper), zmag=zeropoint,
+                        mkapert="no")
+
+    daopars = DaoPars(function="auto", varorder=1, nclean=0, saturated="no", matchradius=3.,
+                      psfrad=15., fitrad=3.4, recenter="yes", fitsky="yes", groupsky="yes",
+                      sannulus=8., wsannulus=15., flaterr=0.75, proferr=2.5, maxiter=50,
+                      clipexp=4, cliprange=2.5, mergerad=None, critsnratio=1., maxgroup=30,
+                      text="yes")
+
+    return PhotConfig(datapars, centerpars, fitskypars, findpars, photpars, daopars)
+
+
+def replace(config, section, **changes):
+    """return a copy of config with some parameters of one section changed"""
+    return config._replace(**{section: getattr(config, section)._replace(**changes)})
+
+
+def find_kwargs(config):
+    """the nativephot.find_stars keywords for this config"""
+    findpars = config.findpars
+    return dict(fwhm=config.datapars.fwhmpsf, sigma=config.datapars.sigma,
+                threshold=findpars.threshold, nsigma=findpars.nsigma,
+                ratio=findpars.ratio, theta=findpars.theta,
+                sharplo=findpars.sharplo, sharphi=findpars.sharphi,
+                roundlo=findpars.roundlo, roundhi=findpars.roundhi)
+
+
+def phot_kwargs(config):
+    """the nativephot.aperture_photometry keywords for this config"""
+    datapars = config.datapars
+    centerpars = config.centerpars
+    fitskypars = config.fitskypars
+    return dict(apertures=config.photpars.apertures, zmag=config.photpars.zmag,
+                annulus=fitskypars.annulus, dannulus=fitskypars.dannulus,
+                smaxiter=fitskypars.smaxiter, sloreject=fitskypars.sloreject,
+                shireject=fitskypars.shireject, salgorithm=fitskypars.salgorithm,
+                khist=fitskypars.khist, binsize=fitskypars.binsize,
+                epadu=datapars.epadu, readnoise=datapars.readnoise, itime=datapars.itime,
+                datamin=datapars.datamin, datamax=datapars.datamax,
+                recenter=centerpars.calgorithm != "none", cbox=centerpars.cbox,
+                cmaxiter=centerpars.cmaxiter, maxshift=centerpars.maxshift)
+
+
+def psf_kwargs(config):
+    """the psfphot.psf_photometry keywords for this config"""
+    datapars = config.datapars
+    daopars = config.daopars
+    return dict(psfrad=daopars.psfrad, fitrad=daopars.fitrad,
+                fitsky=daopars.fitsky == "yes", recenter=daopars.recenter == "yes",
+                maxiter=daopars.maxiter, maxgroup=daopars.maxgroup,
+                mergerad=daopars.mergerad or datapars.fwhmpsf, #INDEF is the fwhm, as in allstar
+                zmag=config.photpars.zmag, epadu=datapars.epadu, readnoise=datapars.readnoise,
+                flaterr=daopars.flaterr, proferr=daopars.proferr, itime=datapars.itime,
+                datamin=datapars.datamin, datamax=datapars.datamax)
@@ -0,0 +1,483 @@
+"""
+    Grouped PSF fitting photometry, an in-process alternative to running the
+    daophot group and nstar/allstar tasks with the daopars set by
+    aperphot.set_daopars
+
+    The PSF is an image of the star profile centred on its middle pixel, like
+    data/psf.fits which seepsf made from the dr_median PSF lookup table. It is
+    normalised to unit sum and interpolated with a cubic spline to place it at
+    the sub-pixel star positions, so the fitted fluxes are the total counts of
+    the stars out to psfrad.
+
+    Stars closer than psfrad+fitrad to each other, directly or through other
+    stars, are fitted together as a group, found with a kd-tree of the star
+    positions. Groups larger than maxgroup are split again with a smaller
+    radius, as allstar does. The pixels within fitrad of the stars of a group
+    are fitted with the sum of the shifted PSFs plus the sky: each star only
+    touches the pixels within psfrad of it, so the design matrix is sparse
+    and every iteration is one sparse linear least squares solve for the
+    fluxes, the position corrections when recenter is on, and the group sky
+    when fitsky is on. The groups are independent and are shared out to a
+    pool of worker processes.
+
+    subtract_stars removes the fitted stars from the image, write_residual
+    saves the result, the subtracted image the daophot substar task makes.
+
+    Coordinates follow the IRAF convention, the center of the first pixel is
+    at (1.,1.)
+
+    example:
+
+    phot=aperphot.do_phot('myimage.fits',stars,backend="numpy")
+    fit=psfphot.psf_photometry('myimage.fits',phot["XCENTER"],phot["YCENTER"],
+                               '../data/psf.fits',sky=phot["MSKY"],
+                               **photconfig.psf_kwargs(config))
+    psfphot.write_residual('myimage.fits1.sub.1.fits',
+                           psfphot.subtract_stars('myimage.fits',fit,'../data/psf.fits'))
+
+"""
+from __future__ import print_function, division
+
+import numpy as np
+from scipy import ndimage, sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import lsqr
+from scipy.spatial import cKDTree
+
+import pyfits
+
+import nativephot
+import fitsimage
+import mosaic
+
+# error codes of the fit, in addition to the nativephot ones
+SINGULAR = 201
+FAINT = 202
+MERGED = 203
+ERRNAMES = dict(nativephot.ERRNAMES)
+ERRNAMES.update({SINGULAR: "Singular", FAINT: "TooFaint", MERGED: "Merged"})
+
+GROUPSTARS = 2000 #stars handed to a worker at a time
+SHIFTSTEP = 0.01 #pixels, step of the numerical PSF derivatives
+MAXSHIFT = 1. #largest position correction in one iteration
+
+
+def read_psf(psf, ext=0):
+    """
+    the PSF image normalised to unit sum, from a FITS file or an array
+
+    the PSF has to be a 2d image with an odd size, centered on its middle
+    pixel. A daophot PSF lookup table (like data/dr_median.psf.1.fits)
+    has to be turned into an image with seepsf first
+    """
+    if not isinstance(psf, np.ndarray):
+        psf = fitsimage.getdata(psf, ext)
+    psf = np.array(psf, dtype=np.float64)
+    if psf.ndim != 2 or psf.shape[0] % 2 == 0 or psf.shape[1] % 2 == 0:
+        raise ValueError("The PSF must be a 2d image with an odd size, not %s, "
+                         "use seepsf to make one from a PSF lookup table" % (psf.shape,))
+    return psf / psf.sum()
+
+
+def psf_spline(psf):
+    """the cubic spline coefficients of a normalised PSF image, see psf_value"""
+    return ndimage.spline_filter(psf, order=3)
+
+
+def psf_value(spline, dx, dy, psfrad):
+    """
+    the PSF at offsets dx, dy in pixels from the star center, zero beyond
+    psfrad and off the PSF image
+    """
+    cy = (spline.shape[0] - 1) / 2.
+    cx = (spline.shape[1] - 1) / 2.
+    value = ndimage.map_coordinates(spline, [dy + cy, dx + cx], order=3, prefilter=False,
+                                    mode="constant", cval=0.)
+    value[dx * dx + dy * dy > psfrad * psfrad] = 0.
+    return value
+
+
+def _components(x, y, radius):
+    """labels of the groups of positions linked by separations below radius"""
+    pairs = cKDTree(np.column_stack((x, y))).query_pairs(radius, output_type="ndarray")
+    links = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                              shape=(len(x), len(x)))
+    return csgraph.connected_components(links, directed=False)[1]
+
+
+def merge_stars(x, y, mergerad):
+    """
+    which stars are kept when the ones closer than mergerad are merged,
+    of two stars too close the one listed first is kept
+    """
+    keep = np.ones(len(x), dtype=bool)
+    if not len(x):
+        return keep
+    pairs = cKDTree(np.column_stack((x, y))).query_pairs(mergerad, output_type="ndarray")
+    for first, second in pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]:
+        if keep[first]:
+            keep[second] = False
+    return keep
+
+
+def group_stars(x, y, radius, maxgroup=None):
+    """
+    number the groups of stars which have to be fitted together
+
+    stars closer than radius to each other, directly or through other stars,
+    share a group. Groups of more than maxgroup stars are split up by grouping
+    them again with a smaller radius, the stars of a group are in no other
+    group's fitting region only when they are not split
+
+    returns an array of group numbers starting at 1, in the order of the stars
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    groups = np.zeros(len(x), dtype=np.int32)
+    if not len(x):
+        return groups
+    pending = [(np.arange(len(x)), radius)]
+    ngroup = 0
+    while pending:
+        index, radius = pending.pop()
+        labels = _components(x[index], y[index], radius)
+        order = np.argsort(labels, kind="mergesort")
+        bounds = np.nonzero(np.diff(labels[order]))[0] + 1
+        for members in np.split(index[order], bounds):
+            if maxgroup and len(members) > maxgroup:
+                if radius > SHIFTSTEP:
+                    pending.append((members, radius * 0.8))
+                    continue
+                #stars on top of each other, cut them into maxgroup pieces
+                for start in range(0, len(members), maxgroup):
+                    ngroup += 1
+                    groups[members[start:start + maxgroup]] = ngroup
+                continue
+            ngroup += 1
+            groups[members] = ngroup
+    return groups
+
+
+def psf_dtype():
+    """the structured array type used for the PSF photometry results, the allstar columns"""
+    return np.dtype([("ID", np.int32), ("GROUP", np.int32),
+                     ("XINIT", np.float64), ("YINIT", np.float64),
+                     ("XCENTER", np.float64), ("YCENTER", np.float64),
+                     ("MSKY", np.float64), ("FLUX", np.float64),
+                     ("MAG", np.float64), ("MERR", np.float64),
+                     ("NITER", np.int32), ("CHI", np.float64),
+                     ("PIER", np.int32), ("PERROR", "S9")])
+
+
+def psf_photometry(image, x, y, psf, sky=None, psfrad=None, fitrad=3., fitsky=True,
+                   recenter=True, maxiter=50, maxgroup=30, mergerad=None, zmag=25.,
+                   epadu=1., readnoise=0., flaterr=0.75, proferr=2.5, itime=1.,
+                   datamin=None, datamax=None, workers=None, ext=("SCI", 1), mask=None):
+    """
+    fit the PSF to every star, the overlapping ones together
+
+    Parameters
+        image:     string, the FITS file, or a 2d array
+        x, y:      arrays, the initial star positions (IRAF, 1-based)
+        psf:       the PSF image, a FITS file name or a 2d array, see read_psf
+        sky:       array, the initial sky of each star, e.g. the MSKY of the
+                   aperture photometry, 0 if None
+        psfrad:    float, radius of the PSF model, the PSF image size if None
+        fitrad:    float, the pixels within fitrad of a star are fitted
+        fitsky:    bool, fit the sky of each group, else keep the given sky
+        recenter:  bool, fit the positions, else only the fluxes
+        maxiter:   int, the largest number of fit iterations
+        maxgroup:  int, the largest number of stars fitted together
+        mergerad:  float, of the stars closer than this to each other only the
+                   first is fitted, the others are flagged Merged, None to
+                   fit them all
+        zmag:      float, the magnitude zeropoint
+        epadu:     float, effective gain in electrons per data unit
+        readnoise: float, readnoise in electrons
+        flaterr:   float, flat field error in percent of the data
+        proferr:   float, PSF profile error in percent of the star counts
+        itime:     float, exposure time the data are normalised to
+        datamin, datamax: good data limits, None for no limit
+        workers:   int, number of processes, all the cores if None, 1 runs
+                   in this process
+        ext:       the extension of the FITS file to use
+        mask:      the bad pixel mask, an extension of the same file like
+                   ("DQ",1) or an array, the pixels set in it are not fitted
+
+    the pixels are weighted with the inverse of their variance as in nstar,
+
+        (readnoise/epadu)**2 + data/epadu + (flaterr/100*data)**2 + (proferr/100*(data-sky))**2
+
+    and the flux errors come from the fit covariance scaled by the reduced
+    chi square of the group
+
+    returns a structured array, see psf_dtype(), in the order of the input positions
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    if sky is None:
+        sky = np.zeros(len(x))
+    sky = np.broadcast_to(np.asarray(sky, dtype=np.float64), x.shape)
+    psf = read_psf(psf)
+    if psfrad is None:
+        psfrad = (min(psf.shape) - 1) / 2.
+    psfrad = min(psfrad, (min(psf.shape) - 1) / 2.)
+
+    result = np.zeros(len(x), dtype=psf_dtype())
+    result["ID"] = np.arange(1, len(x) + 1)
+    result["XINIT"] = x
+    result["YINIT"] = y
+    result["XCENTER"] = x
+    result["YCENTER"] = y
+    result["MSKY"] = sky
+    result["FLUX"] = np.nan
+    keep = np.ones(len(x), dtype=bool)
+    if mergerad:
+        keep = merge_stars(x, y, mergerad)
+        result["PIER"][~keep] = MERGED
+    fitted = np.nonzero(keep)[0]
+    groups = group_stars(x[fitted], y[fitted], psfrad + fitrad, maxgroup)
+    result["GROUP"][fitted] = groups
+
+    #whole groups go to the workers, several small ones at a time
+    order = fitted[np.argsort(groups, kind="mergesort")]
+    bounds = np.nonzero(np.diff(result["GROUP"][order]))[0] + 1
+    kwargs = dict(spline=psf_spline(psf), psfrad=psfrad, fitrad=fitrad, fitsky=fitsky,
+                  recenter=recenter, maxiter=maxiter, epadu=epadu, readnoise=readnoise,
+                  flaterr=flaterr, proferr=proferr, datamin=datamin, datamax=datamax)
+    tasks = list()
+    batch = list()
+    nbatch = 0
+    for members in np.split(order, bounds):
+        if not len(members):
+            continue
+        batch.append(members)
+        nbatch += len(members)
+        if nbatch >= GROUPSTARS:
+            tasks.append((batch, x, y, sky, kwargs))
+            batch = list()
+            nbatch = 0
+    if batch:
+        tasks.append((batch, x, y, sky, kwargs))
+
+    for index, fit in mosaic._map(_fit_groups, tasks, image, ext, workers, mask):
+        for name in fit.dtype.names:
+            result[name][index] = fit[name]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mag = zmag - 2.5 * np.log10(result["FLUX"]) + 2.5 * np.log10(itime)
+        merr = 1.0857 * result["MERR"] / result["FLUX"]
+        result["PIER"][(result["FLUX"] <= 0) & (result["PIER"] == nativephot.NOERROR)] = FAINT
+    undefined = (result["PIER"] != nativephot.NOERROR) | ~np.isfinite(mag)
+    mag[undefined] = np.nan
+    merr[undefined] = np.nan
+    result["MAG"] = mag
+    result["MERR"] = merr
+    result["PERROR"] = _errnames(result["PIER"])
+    return result
+
+
+def _errnames(codes):
+    """map an array of error codes to their names"""
+    names = np.empty(np.shape(codes), dtype="S9")
+    for code, name in ERRNAMES.items():
+        names[codes == code] = name
+    return names
+
+
+def _fit_groups(args):
+    """fit the groups of one task in a worker, the flux error is in MERR until the end"""
+    batch, x, y, sky, kwargs = args
+    index = np.concatenate(batch)
+    fit = np.zeros(len(index), dtype=[("XCENTER", np.float64), ("YCENTER", np.float64),
+                                      ("MSKY", np.float64), ("FLUX", np.float64),
+                                      ("MERR", np.float64), ("NITER", np.int32),
+                                      ("CHI", np.float64), ("PIER", np.int32)])
+    start = 0
+    for members in batch:
+        out = fit[start:start + len(members)]
+        out["XCENTER"], out["YCENTER"], out["MSKY"], out["FLUX"], out["MERR"], \
+            out["NITER"], out["CHI"], out["PIER"] = \
+            fit_group(mosaic._IMAGE, x[members], y[members], sky[members].mean(),
+                      mask=mosaic._MASK, **kwargs)
+        start += len(members)
+    return index, fit
+
+
+def _fit_pixels(data, x, y, fitrad, datamin, datamax, mask):
+    """the usable pixels within fitrad of any of the stars, values, columns and rows"""
+    values, cols, rows, valid = nativephot.gather(data, x, y, int(np.ceil(fitrad)))
+    valid &= ((cols - x[:, np.newaxis])**2 + (rows - y[:, np.newaxis])**2 <= fitrad * fitrad)
+    with np.errstate(invalid="ignore"):
+        if datamin is not None:
+            valid &= values >= datamin
+        if datamax is not None:
+            valid &= values <= datamax
+    if mask is not None:
+        valid &= ~nativephot.gather_mask(mask, cols, rows, valid)
+    first = np.unique(rows[valid] * (data.shape[1] + 2) + cols[valid], return_index=True)[1]
+    return values[valid][first], cols[valid][first], rows[valid][first]
+
+
+def _design(spline, x, y, flux, cols, rows, weight, psfrad, derivatives, fitsky):
+    """
+    the model of the stars on the pixels and the sparse, weighted matrix of
+    its derivatives: the flux columns, the x and y ones if asked for, then
+    the sky one. The flux, position and sky columns differ by orders of
+    magnitude, they are scaled to unit length so lsqr converges, the
+    scale is returned too
+    """
+    nstar = len(x)
+    dx = cols[:, np.newaxis] - x
+    dy = rows[:, np.newaxis] - y
+    pix, star = np.nonzero(dx * dx + dy * dy <= psfrad * psfrad)
+    dx = dx[pix, star]
+    dy = dy[pix, star]
+    value = psf_value(spline, dx, dy, psfrad)
+    model = np.bincount(pix, weights=value * flux[star], minlength=len(cols))
+    entries = [value]
+    columns = [star]
+    if derivatives:
+        #the model moves the opposite way to the offsets
+        step = SHIFTSTEP
+        entries.append(flux[star] * (psf_value(spline, dx + step, dy, psfrad) -
+                                     psf_value(spline, dx - step, dy, psfrad)) / (-2 * step))
+        entries.append(flux[star] * (psf_value(spline, dx, dy + step, psfrad) -
+                                     psf_value(spline, dx, dy - step, psfrad)) / (-2 * step))
+        columns.extend([star + nstar, star + 2 * nstar])
+    entries = np.concatenate(entries) * np.tile(weight[pix], len(columns))
+    matrows = np.tile(pix, len(columns))
+    columns = np.concatenate(columns)
+    ncol = nstar * (3 if derivatives else 1)
+    if fitsky:
+        entries = np.concatenate([entries, weight])
+        matrows = np.concatenate([matrows, np.arange(len(cols))])
+        columns = np.concatenate([columns, np.full(len(cols), ncol, dtype=columns.dtype)])
+        ncol += 1
+    scale = np.sqrt(np.bincount(columns, weights=entries**2, minlength=ncol))
+    scale[scale == 0] = 1.
+    matrix = sparse.csr_matrix((entries / scale[columns], (matrows, columns)),
+                               shape=(len(cols), ncol))
+    return model, matrix, scale, pix, star
+
+
+def fit_group(data, x, y, sky, spline, psfrad, fitrad, fitsky=True, recenter=True,
+              maxiter=50, epadu=1., readnoise=0., flaterr=0.75, proferr=2.5, datamin=None,
+              datamax=None, mask=None):
+    """
+    fit one group of stars together
+
+    Parameters
+        data:    2d array, the image pixels
+        x, y:    arrays, the initial positions of the stars of the group
+        sky:     float, the initial sky of the group
+        spline:  the spline coefficients of the PSF, see psf_spline
+        the other parameters are the ones of psf_photometry
+
+    the first iteration fits the fluxes (and sky) at the initial positions,
+    which is the whole fit without recenter. With recenter the position
+    corrections are fitted as well, linearised about the current positions,
+    until they are below a thousandth of a pixel or maxiter is reached
+
+    returns x, y, sky, flux, the flux error, the number of iterations,
+    the chi of each star and the error codes
+    """
+    nstar = len(x)
+    x = np.array(x, dtype=np.float64)
+    y = np.array(y, dtype=np.float64)
+    flux = np.zeros(nstar)
+    ferr = np.full(nstar, np.nan)
+    chi = np.full(nstar, np.nan)
+    pier = np.zeros(nstar, dtype=np.int32)
+    niter = 0
+
+    values, cols, rows = _fit_pixels(data, x, y, fitrad, datamin, datamax, mask)
+    nfree = nstar * (3 if recenter else 1) + (1 if fitsky else 0)
+    if len(values) <= nfree:
+        pier[:] = nativephot.OFFIMAGE
+        return x, y, np.full(nstar, sky), flux, ferr, niter, chi, pier
+
+    counts = np.maximum(values, 0.)
+    variance = ((readnoise / epadu)**2 + counts / epadu + (0.01 * flaterr * counts)**2 +
+                (0.01 * proferr * np.maximum(values - sky, 0.))**2)
+    weight = 1. / np.sqrt(np.maximum(variance, 1e-20))
+    while niter < maxiter:
+        niter += 1
+        derivatives = recenter and niter > 1
+        model, matrix, scale, pix, star = _design(spline, x, y,
+                                                  flux if derivatives else np.ones(nstar),
+                                                  cols, rows, weight, psfrad, derivatives, fitsky)
+        if not derivatives:
+            #linear in the fluxes, solve for them directly
+            model = 0.
+        residual = weight * (values - sky - model)
+        solution = lsqr(matrix, residual, atol=1e-10, btol=1e-10,
+                        iter_lim=10 * matrix.shape[1], calc_var=True)
+        step, istop = solution[0] / scale, solution[1]
+        var = solution[-1] / scale**2
+        if istop in (3, 6, 7):
+            pier[:] = SINGULAR
+            return x, y, np.full(nstar, sky), flux, ferr, niter, chi, pier
+
+        if derivatives:
+            flux += step[:nstar]
+            shift = np.clip(step[nstar:3 * nstar], -MAXSHIFT, MAXSHIFT)
+            x += shift[:nstar]
+            y += shift[nstar:]
+        else:
+            flux = step[:nstar].copy()
+        if fitsky:
+            sky += step[-1]
+        if not recenter or (derivatives and np.abs(shift).max() < 1e-3):
+            break
+
+    #the chi of each star from the pixels within its fitting radius
+    model, matrix, scale, pix, star = _design(spline, x, y, flux, cols, rows, weight, psfrad,
+                                              False, False)
+    residual = weight * (values - sky - model)
+    dof = max(len(values) - nfree, 1)
+    ferr = np.sqrt(var[:nstar] * max(np.sum(residual**2) / dof, 1.))
+    near = (cols[pix] - x[star])**2 + (rows[pix] - y[star])**2 <= fitrad * fitrad
+    with np.errstate(invalid="ignore", divide="ignore"):
+        chi = np.sqrt(np.bincount(star[near], weights=residual[pix[near]]**2, minlength=nstar) /
+                      np.bincount(star[near], minlength=nstar))
+    return x, y, np.full(nstar, sky), flux, ferr, niter, chi, pier
+
+
+def subtract_stars(image, result, psf, psfrad=None, ext=("SCI", 1)):
+    """
+    the image with the fitted stars taken out, like the daophot substar task
+
+    Parameters
+        image:  string, the FITS file, or a 2d array
+        result: the psf_photometry results, the stars with an error are left in
+        psf:    the PSF image, a FITS file name or a 2d array
+        psfrad: float, the radius out to which the stars are subtracted, the
+                PSF image size if None
+        ext:    the extension of the FITS file to use
+
+    returns the residual image as a new float32 array
+    """
+    residual = np.array(mosaic.open_image(image, ext), dtype=np.float32)
+    psf = read_psf(psf)
+    half = (min(psf.shape) - 1) // 2
+    if psfrad is None:
+        psfrad = half
+    spline = psf_spline(psf)
+    ny, nx = residual.shape
+    good = result["PIER"] == nativephot.NOERROR
+    stars = result[good]
+    for start in range(0, len(stars), nativephot.CHUNKSIZE):
+        chunk = stars[start:start + nativephot.CHUNKSIZE]
+        cols, rows = nativephot.gather(residual, chunk["XCENTER"], chunk["YCENTER"], half)[1:3]
+        model = chunk["FLUX"][:, np.newaxis] * \
+            psf_value(spline, cols - chunk["XCENTER"][:, np.newaxis],
+                      rows - chunk["YCENTER"][:, np.newaxis], psfrad)
+        inside = (cols >= 1) & (cols <= nx) & (rows >= 1) & (rows <= ny)
+        np.subtract.at(residual, (rows[inside] - 1, cols[inside] - 1), model[inside])
+    return residual
+
+
+def write_residual(filename, residual, header=None):
+    """save the subtracted image, replacing the file if it is there"""
+    pyfits.writeto(filename, residual, header=header, clobber=True)
@@ -0,0 +1,214 @@
+"""
+    Content addressed cache of the photometry stage outputs
+
+    Each stage output is stored under a key made from everything it depends
+    on: a digest of the input pixels, of the parameter sets the stage reads,
+    of its other inputs (the star list for phot) and of the code that computed
+    it, the source of the stage function and of the functions it calls.
+    Re-running on an unchanged image with unchanged parameters finds the key
+    and skips the stage, while changing for example only the photpars
+    apertures gives a new key for the phot stage and leaves the find stage
+    cached.
+
+    The entries are files named by their key in the cache directory: .npy files
+    for the arrays of the numpy backend and copies of the .stars/.phot text
+    files written by the IRAF tasks. Since the key is the content, entries
+    never go stale, old ones can be deleted at any time.
+
+    example:
+
+    aperphot.RUN_CACHE=runcache.StageCache('phot_cache')
+    aperphot.run('myimage.fits',backend="numpy")   #computed
+    aperphot.run('myimage.fits',backend="numpy")   #read back from the cache
+
+"""
+from __future__ import print_function, division
+
+import os
+import types
+import shutil
+import hashlib
+import inspect
+import tempfile
+import threading
+
+import numpy as np
+
+import fitsimage
+
+#rows hashed at a time, to keep the memory down for large images
+CHUNKROWS = 256
+
+#pixel digests by (path, ext, mtime, size), the files are not hashed twice
+_PIXELS = dict()
+#source digests by function, the code of a function object does not change
+_SOURCES = dict()
+_LOCK = threading.Lock()
+
+
+def pixel_digest(image, ext):
+    """digest of the shape, type and values of the pixels of an image extension"""
+    path = os.path.abspath(image)
+    info = os.stat(path)
+    stamp = (path, ext, info.st_mtime, info.st_size)
+    with _LOCK:
+        if stamp in _PIXELS:
+            return _PIXELS[stamp]
+
+    data = fitsimage.getdata(image, ext)
+    digest = hashlib.sha1(("%s %s" % (data.shape, data.dtype.str)).encode())
+    for start in range(0, data.shape[0], CHUNKROWS):
+        digest.update(np.ascontiguousarray(data[start:start + CHUNKROWS]).tobytes())
+    with _LOCK:
+        _PIXELS[stamp] = digest.hexdigest()
+    return _PIXELS[stamp]
+
+
+def config_digest(config, sections):
+    """digest of some parameter sets of a photconfig.PhotConfig"""
+    text = repr([(section, tuple(getattr(config, section))) for section in sections])
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def array_digest(*arrays):
+    """digest of the values of some arrays, e.g. the star positions"""
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(("%s %s" % (array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def file_digest(filename):
+    """digest of the contents of a file"""
+    digest = hashlib.sha1()
+    infile = open(filename, "rb")
+    for block in iter(lambda: infile.read(1 << 20), b""):
+        digest.update(block)
+    infile.close()
+    return digest.hexdigest()
+
+
+def _names(code):
+    """the global and attribute names used by a code object and the functions inside it"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _names(const)
+    return names
+
+
+def _constant(value):
+    """a repr of a simple constant which is the same in every process, None for other values"""
+    if isinstance(value, (bool, int, float, str, type(None))):
+        return repr(value)
+    if isinstance(value, (tuple, list, frozenset)):
+        items = [_constant(item) for item in value]
+        return None if None in items else repr(items)
+    if isinstance(value, dict):
+        items = sorted((_constant(key), _constant(item)) for key, item in value.items())
+        return None if None in [part for pair in items for part in pair] else repr(items)
+    return None
+
+
+def function_digest(functions, modules):
+    """
+    digest of the source of some functions and of everything of the modules
+    they use: the functions they call, found through their global names and the
+    attributes they look up on the modules, and the upper case constants. Only
+    functions defined in the modules are followed, so an edit elsewhere in a
+    module leaves the digest of these functions alone
+    """
+    modules = dict((module.__name__, module) for module in modules)
+    parts = set()
+    todo = list(functions)
+    seen = set()
+    while todo:
+        function = todo.pop()
+        if function in seen:
+            continue
+        seen.add(function)
+        with _LOCK:
+            if function not in _SOURCES:
+                _SOURCES[function] = hashlib.sha1(inspect.getsource(function).encode()).hexdigest()
+            parts.add(_SOURCES[function])
+        names = _names(function.__code__)
+        namespaces = [(function.__module__, function.__globals__)]
+        namespaces += [(module.__name__, vars(module)) for module in modules.values()
+                       if module.__name__ in names]
+        for modname, namespace in namespaces:
+            for name in names:
+                if name not in namespace:
+                    continue
+                value = namespace[name]
+                if isinstance(value, types.FunctionType):
+                    if value.__module__ in modules:
+                        todo.append(value)
+                elif name.isupper() and not name.startswith("_"):
+                    constant = _constant(value)
+                    if constant is not None:
+                        parts.add("%s.%s=%s" % (modname, name, constant))
+    return hashlib.sha1(" ".join(sorted(parts)).encode()).hexdigest()
+
+
+class StageCache(object):
+    """
+    the stage outputs in a directory, named by their keys
+
+    hits and misses count the lookups, for reporting
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, stage, *parts):
+        """the key of a stage output from the digests of everything it depends on"""
+        return stage + "-" + hashlib.sha1(" ".join((stage,) + parts).encode()).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _count(self, found):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def load_array(self, key):
+        """the array stored under key, or None"""
+        path = self._path(key, ".npy")
+        if not self._count(os.access(path, os.F_OK)):
+            return None
+        return np.load(path)
+
+    def save_array(self, key, array):
+        """store an array under key"""
+        self._store(key, ".npy", lambda name: np.save(name, array))
+
+    def load_file(self, key, output):
+        """copy the file stored under key to output, False if there is none"""
+        path = self._path(key, ".txt")
+        if not self._count(os.access(path, os.F_OK)):
+            return False
+        shutil.copyfile(path, output)
+        return True
+
+    def save_file(self, key, output):
+        """store a copy of the output file under key"""
+        self._store(key, ".txt", lambda name: shutil.copyfile(output, name))
+
+    def _store(self, key, suffix, write):
+        """write to a temporary name and rename, readers never see half a file"""
+        fd, tmpname = tempfile.mkstemp(suffix=suffix, dir=self.directory)
+        os.close(fd)
+        try:
+            write(tmpname)
+            os.rename(tmpname, self._path(key, suffix))
+        except:
+            os.remove(tmpname)
+            raise
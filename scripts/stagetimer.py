@@ -0,0 +1,249 @@
+"""
+    Timing and resource figures for the stages of the photometry pipeline
+
+    A StageTimer measures each stage it is asked to time: the wall clock and
+    cpu time, the peak resident memory of the process and the bytes it read
+    and wrote. Every stage gives one event, a dict which is kept in memory and
+    written as one line of JSON to the events file, so the worker processes of
+    a batch can all append to the same file and the events can be added up per
+    stage afterwards. One stage can also be run under cProfile, its statistics
+    are saved next to the events for pstats or snakeviz.
+
+    The pipeline only times its stages when aperphot.INSTRUMENT is set, when it
+    is None the stages run with a shared do-nothing context.
+
+    example:
+
+    aperphot.INSTRUMENT=stagetimer.StageTimer('timing.jsonl',profile="do_phot")
+    aperphot.run('myimage.fits',backend="numpy")
+    stagetimer.print_summary(stagetimer.summarize(stagetimer.read_events('timing.jsonl')))
+
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#the counters of /proc/self/io for the bytes read and written, all reads and
+#writes through the system calls including the ones served from the page cache
+IOFIELDS = ("rchar", "wchar")
+
+#ru_maxrss is in kilobytes on linux and in bytes on mac os
+RSSUNIT = 1 if sys.platform == "darwin" else 1024
+
+
+class _NotTimed(object):
+    """the context for a stage when the timing is off, it does nothing"""
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOT_TIMED = _NotTimed()
+
+
+def peak_rss():
+    """the peak resident memory of this process so far in bytes, None if unknown"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSSUNIT
+
+
+def io_bytes():
+    """the bytes read and written by this process so far, (None, None) if unknown"""
+    try:
+        infile = open("/proc/self/io", "r")
+    except (IOError, OSError):
+        return None, None
+    counters = dict()
+    for line in infile:
+        name, _, value = line.partition(":")
+        counters[name.strip()] = int(value)
+    infile.close()
+    return tuple(counters.get(name) for name in IOFIELDS)
+
+
+def cpu_time():
+    """the user and system time used by this process so far"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class _Stage(object):
+    """the context which times one stage of one image for a StageTimer"""
+    def __init__(self, timer, name, image, info):
+        self.timer = timer
+        self.name = name
+        self.image = image
+        self.info = info
+        self.profiler = None
+
+    def __enter__(self):
+        self.rss = peak_rss()
+        self.io = io_bytes()
+        self.start = time.time()
+        self.cpu = cpu_time()
+        if self.name in self.timer.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+        cpu = cpu_time() - self.cpu
+        wall = time.time() - self.start
+        rss = peak_rss()
+        io = io_bytes()
+
+        event = dict(event="stage", stage=self.name, image=self.image, pid=os.getpid(),
+                     start=self.start, wall=wall, cpu=cpu, status="ok")
+        if rss is not None:
+            event["peak_rss"] = rss
+            event["rss_growth"] = rss - self.rss
+        if io[0] is not None:
+            event["read_bytes"] = io[0] - self.io[0]
+            event["write_bytes"] = io[1] - self.io[1]
+        if exc_type is not None:
+            event["status"] = "failed"
+            event["error"] = "%s: %s" % (exc_type.__name__, exc)
+        if self.profiler is not None:
+            event["profile"] = self.timer.save_profile(self.profiler, self.name, self.image)
+        event.update(self.info)
+        self.timer.record(event)
+        return False
+
+
+class StageTimer(object):
+    """
+    times the stages of the pipeline and keeps their events
+
+    Parameters
+        filename:   string, the JSON lines file to append the events to, None
+                    to only keep them in memory
+        profile:    string or list of strings, the stage(s) to run under cProfile
+        profiledir: string, the directory for the profile statistics, default is
+                    the directory of the events file
+
+    the profile of a stage is saved as <image>.<stage>.<pid>.prof so repeated
+    stages in a batch do not overwrite each other
+    """
+    def __init__(self, filename=None, profile=None, profiledir=None):
+        self.filename = filename
+        if isinstance(profile, str):
+            profile = [profile]
+        self.profile = frozenset(profile or ())
+        if profiledir is None:
+            profiledir = os.path.dirname(filename) if filename else "."
+        self.profiledir = profiledir or "."
+        self.events = list()
+        self._lock = threading.Lock()
+
+    def stage(self, name, image=None, **info):
+        """
+        the context to time one stage with, extra keywords are added to its event
+
+        with timer.stage("find_objects",image):
+            ...
+        """
+        return _Stage(self, name, image, info)
+
+    def record(self, event):
+        """keep an event and append it to the events file as one line of JSON"""
+        with self._lock:
+            self.events.append(event)
+            if self.filename:
+                #one write of a short line in append mode, the lines of the
+                #worker processes do not get mixed up
+                outfile = open(self.filename, "a")
+                outfile.write(json.dumps(event, sort_keys=True) + "\n")
+                outfile.close()
+
+    def merge(self, events):
+        """add the events of a worker process, which has written them to the file already"""
+        with self._lock:
+            self.events.extend(events)
+
+    def mark(self):
+        """the number of events so far, events[mark:] are the ones recorded since"""
+        return len(self.events)
+
+    def save_profile(self, profiler, name, image):
+        """save the statistics of a profiled stage, returns the file name"""
+        label = os.path.basename(image) if image else "run"
+        label = "".join(c if c.isalnum() or c in "._-" else "_" for c in label)
+        filename = os.path.join(self.profiledir, "%s.%s.%i.prof" % (label, name, os.getpid()))
+        profiler.dump_stats(filename)
+        return filename
+
+
+def read_events(filename):
+    """the events in a JSON lines file, lines which are not complete are skipped"""
+    events = list()
+    infile = open(filename, "r")
+    for line in infile:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue
+    infile.close()
+    return events
+
+
+def summarize(events):
+    """
+    add up the events per stage
+
+    returns a list of dicts in the order the stages first appear, with the stage
+    name, the number of times it ran (COUNT), how often it failed, the total and
+    largest wall time, the total cpu time, the largest peak memory and the total
+    bytes read and written
+    """
+    stages = dict()
+    order = list()
+    for event in events:
+        if event.get("event") != "stage":
+            continue
+        name = event["stage"]
+        if name not in stages:
+            order.append(name)
+            stages[name] = dict(stage=name, count=0, failed=0, wall=0., maxwall=0., cpu=0.,
+                                peak_rss=None, read_bytes=None, write_bytes=None)
+        total = stages[name]
+        total["count"] += 1
+        total["failed"] += event.get("status") != "ok"
+        total["wall"] += event["wall"]
+        total["maxwall"] = max(total["maxwall"], event["wall"])
+        total["cpu"] += event["cpu"]
+        if event.get("peak_rss") is not None:
+            total["peak_rss"] = max(total["peak_rss"] or 0, event["peak_rss"])
+        for field in ("read_bytes", "write_bytes"):
+            if event.get(field) is not None:
+                total[field] = (total[field] or 0) + event[field]
+    return [stages[name] for name in order]
+
+
+def _megabytes(value):
+    return "-" if value is None else "%.1f" % (value / 2.**20)
+
+
+def print_summary(summary):
+    """print the per stage totals of summarize() as a table"""
+    print("%-16s %6s %6s %10s %10s %10s %10s %10s %10s" % ("stage", "count", "failed", "wall[s]",
+          "max[s]", "cpu[s]", "rss[MB]", "read[MB]", "write[MB]"))
+    for total in summary:
+        print("%-16s %6i %6i %10.3f %10.3f %10.3f %10s %10s %10s" % (total["stage"], total["count"],
+              total["failed"], total["wall"], total["maxwall"], total["cpu"],
+              _megabytes(total["peak_rss"]), _megabytes(total["read_bytes"]),
+              _megabytes(total["write_bytes"])))
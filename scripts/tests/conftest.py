@@ -0,0 +1,5 @@
+"""the scripts are flat modules, not a package, make them importable for the tests"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
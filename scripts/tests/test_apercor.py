@@ -0,0 +1,50 @@
+import numpy as np
+from scipy.special import erf
+
+import apercor
+
+
+def gaussian_image(fwhm, size=41, x=21., y=21.):
+    """a unit flux gaussian star integrated over the pixels, IRAF coordinates"""
+    sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+    edges = np.arange(size + 1) + 0.5
+    px = 0.5 * np.diff(erf((edges - x) / (np.sqrt(2.) * sigma)))
+    py = 0.5 * np.diff(erf((edges - y) / (np.sqrt(2.) * sigma)))
+    return np.outer(py, px), sigma
+
+
+def test_curve_of_growth_matches_analytic_gaussian():
+    radii = np.array([1., 2., 3.])
+    for x, y in ((21., 21.), (21.3, 20.8)):
+        data, sigma = gaussian_image(3.5, x=x, y=y)
+        r, flux, fwhm = apercor.curve_of_growth(data, x, y, radii=radii, recenter=False)
+        expected = 1. - np.exp(-radii**2 / (2. * sigma**2))
+        assert np.allclose(flux, expected, rtol=0.01, atol=0)
+
+
+def test_curve_of_growth_of_flat_image_is_the_area():
+    radii = np.array([0.5, 1., 2., 3., 5., 8.])
+    r, flux, fwhm = apercor.curve_of_growth(np.ones((41, 41)), 21.3, 20.8, radii=radii,
+                                            recenter=False)
+    assert np.allclose(flux, np.pi * radii**2)
+
+
+def test_aperture_correction_rejects_a_blended_star():
+    rng = np.random.RandomState(5)
+    x = 30. + 40. * np.arange(4) + rng.uniform(-0.5, 0.5, 4)
+    x, y = [a.ravel() for a in np.meshgrid(x, x + rng.uniform(-0.5, 0.5))]
+    data = np.zeros((180, 180))
+    for xi, yi in zip(x, y):
+        data += 1000. * gaussian_image(3., size=180, x=xi, y=yi)[0]
+    #a faint companion 7 pixels from one star, inside its large aperture only
+    data += 300. * gaussian_image(3., size=180, x=x[5] + 7., y=y[5])[0]
+    mag = np.full(len(x), 20.)
+
+    corr, scatter, used, radii, curve = apercor.aperture_correction(
+        data, x, y, mag, small=4., large=10., annulus=12., isolation=5.)
+    sigma = 3. / (2. * np.sqrt(2. * np.log(2.)))
+    fraction = (1. - np.exp(-4.**2 / (2. * sigma**2))) / (1. - np.exp(-10.**2 / (2. * sigma**2)))
+    assert used == len(x) - 1
+    assert abs(corr - 2.5 * np.log10(fraction)) < 0.01
+    assert scatter < 0.01
+    assert np.allclose(curve[radii == 10.], 1.)
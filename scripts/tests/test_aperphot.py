@@ -0,0 +1,184 @@
+import os
+import types
+
+import numpy as np
+
+import aperphot
+
+
+def test_expand_images_keeps_missing_inputs(tmpdir):
+    image = tmpdir.join("a_cal.fits")
+    image.write("")
+    missing = str(tmpdir.join("missing_cal.fits"))
+
+    names = aperphot.expand_images([str(tmpdir.join("*_cal.fits")), missing])
+    assert names == [str(image), missing]
+
+
+def test_run_batch_reports_missing_image(tmpdir):
+    missing = str(tmpdir.join("missing_cal.fits"))
+    summary = str(tmpdir.join("summary.txt"))
+
+    table = aperphot.run_batch([missing], backend="numpy", workers=1, summary=summary)
+    assert len(table) == 1
+    assert table["IMAGE"][0] == missing
+    assert table["STATUS"][0] == "failed"
+    assert "Unable to access" in table["ERROR"][0]
+    assert missing in open(summary).read()
+
+
+def _edit(monkeypatch, module, name):
+    """stand in for an edit of a function of a module: the same behaviour from other source"""
+    original = getattr(module, name)
+
+    def edited(*args, **kwargs):
+        return original(*args, **kwargs)
+    monkeypatch.setattr(module, name, types.FunctionType(edited.__code__, vars(module), name,
+                                                         None, edited.__closure__))
+
+
+def test_stage_keys_depend_on_the_code_the_stage_runs(tmpdir, monkeypatch):
+    import benchmark
+    import nativephot
+    import photconfig
+    import runcache
+
+    image = str(tmpdir.join("field_cal.fits"))
+    benchmark.write_image(image, benchmark.synthetic_image(64, 5)[0])
+    monkeypatch.setattr(aperphot, "RUN_CACHE", runcache.StageCache(str(tmpdir.join("cache"))))
+    config = photconfig.nicmos_config()
+
+    def keys():
+        return [aperphot._stage_key(stage, image, 1, backend, config, ("datapars",))
+                for stage in ("find", "phot") for backend in aperphot.BACKENDS]
+
+    before = keys()
+    _edit(monkeypatch, photconfig, "find_kwargs")
+    after = keys()
+    #find for both backends, phot does not use the find parameters
+    assert [a != b for a, b in zip(before, after)] == [True, True, False, False]
+
+    before = after
+    _edit(monkeypatch, nativephot, "aperture_photometry")
+    after = keys()
+    #only the numpy phot stage runs it
+    assert [a != b for a, b in zip(before, after)] == [False, False, False, True]
+
+
+def test_an_unrelated_edit_keeps_the_cached_stages(tmpdir, monkeypatch):
+    import benchmark
+    import nativephot
+    import runcache
+
+    image = str(tmpdir.join("field_cal.fits"))
+    benchmark.write_image(image, benchmark.synthetic_image(64, 5)[0])
+    cache = runcache.StageCache(str(tmpdir.join("cache")))
+    monkeypatch.setattr(aperphot, "RUN_CACHE", cache)
+
+    stars = aperphot.find_objects(image, backend="numpy")
+    aperphot.do_phot(image, stars, backend="numpy")
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    _edit(monkeypatch, aperphot, "plotphot")
+    _edit(monkeypatch, nativephot, "centroid")
+    stars = aperphot.find_objects(image, backend="numpy")
+    #the finder does not center, the photometry does
+    aperphot.do_phot(image, stars, backend="numpy")
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def _two_chips(filename, photfnu2=None):
+    """a NICMOS style file with two SCI extensions of different fields"""
+    import benchmark
+    import pyfits
+
+    benchmark.write_image(filename, benchmark.synthetic_image(96, 8, seed=1)[0])
+    hdulist = pyfits.open(filename)
+    sci = pyfits.ImageHDU(benchmark.synthetic_image(96, 12, seed=2)[0])
+    sci.header["EXTNAME"] = "SCI"
+    sci.header["EXTVER"] = 2
+    if photfnu2 is not None:
+        sci.header["PHOTFNU"] = photfnu2
+    hdulist.append(sci)
+    hdulist.writeto(filename, clobber=True)
+    hdulist.close()
+
+
+def test_calibration_names_the_missing_keyword(tmpdir):
+    import benchmark
+    import fitsimage
+    import pyfits
+
+    image = str(tmpdir.join("nogain_cal.fits"))
+    benchmark.write_image(image, benchmark.synthetic_image(32, 1)[0])
+    pyfits.delval(image, "ADCGAIN", ext=0)
+    fitsimage.close(image)
+    try:
+        aperphot.calibration(image, ("SCI", 1))
+    except KeyError as error:
+        assert "ADCGAIN" in str(error) and image in str(error)
+    else:
+        raise AssertionError("calibration did not raise for a missing ADCGAIN")
+    finally:
+        fitsimage.close(image)
+
+
+def test_calibration_prefers_the_extension_keywords(tmpdir):
+    import fitsimage
+
+    image = str(tmpdir.join("chips_flt.fits"))
+    _two_chips(image, photfnu2=2 * 1.49585e-06)
+    zpt1, epadu1 = aperphot.calibration(image, ("SCI", 1))
+    zpt2, epadu2 = aperphot.calibration(image, ("SCI", 2))
+    fitsimage.close(image)
+    assert abs((zpt1 - zpt2) - 2.5 * np.log10(2.)) < 1e-6
+    assert epadu1 == epadu2
+
+
+def test_merge_extensions_widens_the_columns():
+    first = np.array([(1., 2)], dtype=[("X", np.float32), ("N", np.int16)])
+    second = np.array([(3., 4), (5., 6)], dtype=[("X", np.float64), ("N", np.int32)])
+    catalog = aperphot.merge_extensions([(1, first), (3, second)])
+    assert catalog.dtype.names == ("EXTVER", "X", "N")
+    assert catalog.dtype["X"] == np.float64 and catalog.dtype["N"] == np.int32
+    assert list(catalog["EXTVER"]) == [1, 3, 3]
+    assert list(catalog["X"]) == [1., 3., 5.]
+
+
+def test_run_extensions_measures_every_chip_in_order(tmpdir):
+    import fitsimage
+
+    image = str(tmpdir.join("chips_flt.fits"))
+    _two_chips(image)
+    serial = aperphot.run_extensions(image, workers=1)
+    fitsimage.close()
+    pooled = aperphot.run_extensions(image, workers=2)
+    fitsimage.close()
+
+    assert set(serial["EXTVER"]) == set([1, 2])
+    #the rows of each chip come together, in the order of the extensions
+    assert (np.diff(serial["EXTVER"]) >= 0).all()
+    for extver in (1, 2):
+        chip = serial[serial["EXTVER"] == extver]
+        assert len(chip) == len(aperphot.find_objects(image, backend="numpy", extver=extver,
+                                                      save=False))
+    assert serial.dtype == pooled.dtype
+    for name in serial.dtype.names:
+        assert np.array_equal(serial[name], pooled[name]) or \
+            np.allclose(serial[name], pooled[name], equal_nan=True)
+
+
+def test_run_batch_keeps_the_input_order(tmpdir):
+    import benchmark
+
+    names = []
+    for seed in range(3):
+        name = str(tmpdir.join("field%i_cal.fits" % seed))
+        benchmark.write_image(name, benchmark.synthetic_image(64, 4 + seed, seed=seed)[0])
+        names.append(name)
+    serial = aperphot.run_batch(names, backend="numpy", workers=1)
+    pooled = aperphot.run_batch(names[::-1], backend="numpy", workers=2)
+    assert list(serial["IMAGE"]) == names
+    assert list(pooled["IMAGE"]) == names[::-1]
+    assert (serial["STATUS"] == "ok").all() and (pooled["STATUS"] == "ok").all()
+    assert list(serial["NSTARS"]) == list(pooled["NSTARS"][::-1])
@@ -0,0 +1,156 @@
+"""the concurrent, cached and streaming queries against a local stand-in cone search server"""
+import time
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import numpy as np
+import pytest
+
+import conesearch
+
+VOTABLE = """<?xml version="1.0" encoding="utf-8"?>
+<VOTABLE version="1.2" xmlns="http://www.ivoa.net/xml/VOTable/v1.2">
+ <RESOURCE type="results">
+  <INFO name="QUERY_STATUS" value="OK"/>
+  <TABLE>
+   <FIELD ID="ID" name="ID" datatype="int"/>
+   <FIELD ID="RA" name="RA" datatype="double" ucd="pos.eq.ra;meta.main" unit="deg"/>
+   <FIELD ID="DEC" name="DEC" datatype="double" ucd="pos.eq.dec;meta.main" unit="deg"/>
+   <DATA>
+    <TABLEDATA>
+{rows}
+    </TABLEDATA>
+   </DATA>
+  </TABLE>
+ </RESOURCE>
+</VOTABLE>
+"""
+
+
+def votable(ra, dec, nrows=3):
+    rows = "\n".join("<TR><TD>{0}</TD><TD>{1!r}</TD><TD>{2!r}</TD></TR>".format(
+        i, ra + 0.001 * i, dec - 0.001 * i) for i in range(nrows))
+    return VOTABLE.format(rows=rows)
+
+
+class ConeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """answers cone searches with a few rows around RA, DEC, failing the first `failures` requests"""
+    daemon_threads = True
+
+    def __init__(self, failures=0, delay=0.):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), ConeHandler)
+        self.failures = failures
+        self.delay = delay
+        self.requests = []
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/cone?".format(self.server_address[1])
+
+
+class ConeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.threads.add(threading.current_thread())
+            fail = len(server.requests) <= server.failures
+        time.sleep(server.delay)
+        if fail:
+            body = "busy"
+            self.send_response(503)
+        else:
+            query = dict(urlparse.parse_qsl(urlparse.urlsplit(self.path).query))
+            body = votable(float(query["RA"]), float(query["DEC"]))
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(**kwargs):
+        server = ConeServer(**kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_requests_retry_transient_errors(server):
+    cone = server(failures=1)
+    results = list(conesearch.vo_service_requests(
+        [(cone.url, dict(RA=10., DEC=20., SR=0.1))], workers=1, retries=2, backoff=0.))
+    assert len(results) == 1
+    index, tab = results[0]
+    assert index == 0
+    assert not isinstance(tab, Exception)
+    assert list(tab.array["ID"]) == [0, 1, 2]
+    assert len(cone.requests) == 2
+
+
+def test_requests_give_up_after_retries(server):
+    cone = server(failures=10)
+    index, result = next(conesearch.vo_service_requests(
+        [(cone.url, dict(RA=10., DEC=20., SR=0.1))], workers=1, retries=1, backoff=0.))
+    assert isinstance(result, conesearch.VOSError)
+    assert len(cone.requests) == 2
+
+
+def test_requests_are_cached(server, tmpdir):
+    cone = server()
+    cache = conesearch.ResponseCache(str(tmpdir.join("vo_cache")))
+    queries = [(cone.url, dict(RA=ra, DEC=20., SR=0.1)) for ra in (10., 11., 12.)]
+
+    first = dict(conesearch.vo_service_requests(queries, workers=3, cache=cache))
+    assert len(cone.requests) == 3
+    second = dict(conesearch.vo_service_requests(queries, workers=3, cache=cache))
+    assert len(cone.requests) == 3
+    assert cache.stats() == {"hits": 3, "misses": 3}
+    for index in range(3):
+        assert np.all(first[index].array["RA"] == second[index].array["RA"])
+
+
+def test_closing_early_waits_for_running_queries(server):
+    cone = server(delay=0.2)
+    pool = conesearch.ConnectionPool()
+    queries = [(cone.url, dict(RA=ra, DEC=20., SR=0.1)) for ra in range(8)]
+    before = set(threading.enumerate())
+
+    results = conesearch.vo_service_requests(queries, workers=4, pool=pool)
+    next(results)
+    results.close()
+    #only the threads of the server answering the kept-alive connections are left
+    running = set(threading.enumerate()) - before
+    with cone.lock:
+        assert running <= cone.threads
+    assert len(cone.requests) < len(queries)
+    pool.close()
+
+
+def test_stream_decodes_rows(server):
+    cone = server()
+    array = conesearch.vo_service_stream(cone.url, columns=["RA", "DEC"], chunksize=2,
+                                         RA=10., DEC=20., SR=0.1)
+    assert array.dtype.names == ("RA", "DEC")
+    assert np.allclose(array["RA"], [10., 10.001, 10.002])
+    assert np.allclose(array["DEC"], [20., 19.999, 19.998])
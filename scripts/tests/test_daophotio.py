@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+
+import aperphot
+import benchmark
+import daophotio
+
+
+def test_numpy_catalog_and_phot_cache_do_not_collide(tmpdir):
+    image = str(tmpdir.join("field_cal.fits"))
+    data, x, y, flux = benchmark.synthetic_image(128, 20)
+    benchmark.write_image(image, data)
+
+    #the numpy backend saves its catalog as image.phot.npy
+    result, events = aperphot._run_one((image, "4.", 8., 3., False, "numpy", None))
+    assert result[1] == "ok"
+    assert result[3] == image + ".phot.npy"
+    catalog = np.load(image + ".phot.npy")
+
+    #the text file of the iraf backend with the same stem, written afterwards
+    benchmark.write_phot(image + ".phot", 10, apertures=(2., 4.))
+    for repeat in range(2):
+        table = daophotio.read_daophot(image + ".phot")
+        assert len(table) == 10
+        assert "PERROR" in table.dtype.names
+        assert "IMAGE" in table.dtype.names
+    assert os.access(daophotio.cache_name(image + ".phot"), os.F_OK)
+    assert np.load(image + ".phot.npy").dtype == catalog.dtype
+
+
+def test_cache_with_other_columns_is_read_again(tmpdir):
+    phot = str(tmpdir.join("stars.phot"))
+    benchmark.write_phot(phot, 5)
+    np.save(daophotio.cache_name(phot), np.zeros(3, dtype=[("XCENTER", float)]))
+
+    table = daophotio.read_daophot(phot)
+    assert len(table) == 5
+    assert "PERROR" in table.dtype.names
+
+
+def test_phot_keywords_are_written_with_their_values(tmpdir):
+    phot = str(tmpdir.join("stars.phot"))
+    benchmark.write_phot(phot, 2, apertures=(2., 4.))
+    keywords, groups = daophotio.read_header(phot)
+    assert keywords["IRAF"] == "NOAO/IRAFV2.16"
+    assert keywords["TASK"] == "phot"
+    assert keywords["APERTURES"] == "2,4"
+    assert open(phot).readline().rstrip() == \
+        "#K IRAF       = NOAO/IRAFV2.16          version    %-23s"
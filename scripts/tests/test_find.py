@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import aperphot
+import benchmark
+import nativephot
+
+
+def injected_field(size=128, nstars=25, seed=3):
+    """a field of well separated gaussian stars on a noisy sky"""
+    data, x, y, flux = benchmark.synthetic_image(size, nstars, seed=seed)
+    #keep the stars away from the edges and from each other
+    tree = cKDTree(np.column_stack((x, y)))
+    distance, index = tree.query(np.column_stack((x, y)), k=2)
+    isolated = (distance[:, 1] > 8.) & (x > 8) & (x < size - 8) & (y > 8) & (y < size - 8)
+    bright = flux > 1000.
+    return data, x, y, isolated & bright
+
+
+def test_find_stars_recovers_the_injected_stars():
+    data, x, y, measurable = injected_field()
+    sigma = np.sqrt(benchmark.SKY / benchmark.GAIN + (benchmark.READNOISE / benchmark.GAIN)**2)
+    stars = nativephot.find_stars(data, fwhm=benchmark.FWHM, threshold=4., sigma=sigma)
+
+    distance, index = cKDTree(np.column_stack((stars["XCENTER"], stars["YCENTER"]))).query(
+        np.column_stack((x[measurable], y[measurable])))
+    assert measurable.sum() >= 5
+    assert (distance < 0.5).all()
+    assert list(stars["ID"]) == list(range(1, len(stars) + 1))
+
+
+def test_find_stars_on_a_flat_image_finds_nothing():
+    rng = np.random.RandomState(1)
+    stars = nativephot.find_stars(rng.normal(100., 2., (64, 64)), threshold=5., sigma=2.)
+    assert len(stars) == 0
+
+
+def test_numpy_find_without_save_keeps_an_earlier_stars_file(tmpdir):
+    image = str(tmpdir.join("field_cal.fits"))
+    data, x, y, measurable = injected_field()
+    benchmark.write_image(image, data)
+    tmpdir.join("field_cal.fits.stars").write("earlier output\n")
+
+    stars = aperphot.find_objects(image, backend="numpy")
+    assert len(stars) > 0
+    assert tmpdir.join("field_cal.fits.stars").read() == "earlier output\n"
+
+    aperphot.find_objects(image, backend="numpy", save=True)
+    assert tmpdir.join("field_cal.fits.stars").read() != "earlier output\n"
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+import aperphot
+import benchmark
+import fitsimage
+
+
+def _images(tmpdir, count, size=16):
+    names = []
+    for i in range(count):
+        name = str(tmpdir.join("image%i_cal.fits" % i))
+        benchmark.write_image(name, np.full((size, size), i, dtype=np.float32))
+        names.append(name)
+    return names
+
+
+def test_an_image_is_opened_once(tmpdir):
+    name = _images(tmpdir, 1)[0]
+    try:
+        image = fitsimage.open_image(name)
+        assert fitsimage.open_image(os.path.relpath(name)) is image
+        assert fitsimage.getdata(name, ("SCI", 1)) is fitsimage.getdata(name, ("SCI", 1))
+        assert fitsimage.getheader(name) is image.header(0)
+        assert not fitsimage.getdata(name, ("SCI", 1)).flags.writeable
+    finally:
+        fitsimage.close()
+
+
+def test_a_changed_file_is_opened_again(tmpdir):
+    name = _images(tmpdir, 1)[0]
+    try:
+        image = fitsimage.open_image(name)
+        assert fitsimage.getdata(name, ("SCI", 1))[0, 0] == 0.
+        benchmark.write_image(name, np.ones((24, 24), dtype=np.float32))
+        assert fitsimage.open_image(name) is not image
+        assert image.hdulist._file.closed
+        assert fitsimage.getdata(name, ("SCI", 1)).shape == (24, 24)
+    finally:
+        fitsimage.close()
+
+
+def test_the_least_recently_used_image_is_closed(tmpdir, monkeypatch):
+    monkeypatch.setattr(fitsimage, "MAXIMAGES", 2)
+    first, second, third = _images(tmpdir, 3)
+    try:
+        oldest = fitsimage.open_image(first)
+        newer = fitsimage.open_image(second)
+        fitsimage.open_image(first)
+        fitsimage.open_image(third)
+        assert list(fitsimage._IMAGES) == [os.path.abspath(first), os.path.abspath(third)]
+        assert newer.hdulist._file.closed
+        assert not oldest.hdulist._file.closed
+        assert fitsimage.getdata(second, ("SCI", 1))[0, 0] == 1.
+        assert oldest.hdulist._file.closed
+    finally:
+        fitsimage.close()
+
+
+def test_reset_forgets_the_open_images(tmpdir):
+    name = _images(tmpdir, 1)[0]
+    image = fitsimage.open_image(name)
+    fitsimage.reset()
+    try:
+        assert len(fitsimage._IMAGES) == 0
+        assert fitsimage.open_image(name) is not image
+    finally:
+        fitsimage.close()
+        image.close()
+
+
+def test_run_batch_closes_each_image(tmpdir):
+    names = []
+    for seed in range(2):
+        name = str(tmpdir.join("field%i_cal.fits" % seed))
+        benchmark.write_image(name, benchmark.synthetic_image(64, 4, seed=seed)[0])
+        names.append(name)
+    table = aperphot.run_batch(names, backend="numpy", workers=1)
+    assert (table["STATUS"] == "ok").all()
+    assert len(fitsimage._IMAGES) == 0
@@ -0,0 +1,148 @@
+import numpy as np
+
+import match
+
+
+def test_filtermags_returns_the_kept_pairs_and_leaves_the_input():
+    good = [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)]
+    inmags = np.arange(5) + 20.5
+    outmags = inmags.copy()
+    outmags[0] = 100.
+
+    keep, pairs = match.filtermags(good, inmags, outmags, 0.5)
+    assert list(keep) == [False, True, True, True, True]
+    assert pairs.tolist() == [[1, 1], [2, 2], [3, 3], [4, 4]]
+    assert good == [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)]
+
+
+def test_filtermags_widens_the_threshold_with_the_errors():
+    pairs = np.array([[0, 0], [1, 1]])
+    keep, kept = match.filtermags(pairs, [20., 20.], [20.7, 21.5], 0.5,
+                                  merr1=[0.1, 0.1], nsigma=3.)
+    assert list(keep) == [True, False]
+
+
+def _epochs(nsource=300, ncat=4, jitter=0.05, extra=5, seed=11):
+    """catalogs of one field, each missing some sources and with a few of its own"""
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(0., 1000., nsource)
+    y = rng.uniform(0., 1000., nsource)
+    listsx, listsy, sources = [], [], []
+    for k in range(ncat):
+        found = np.nonzero(rng.uniform(size=nsource) > 0.2)[0]
+        rng.shuffle(found)
+        listsx.append(np.concatenate([x[found] + rng.normal(0., jitter, len(found)),
+                                      rng.uniform(0., 1000., extra)]))
+        listsy.append(np.concatenate([y[found] + rng.normal(0., jitter, len(found)),
+                                      rng.uniform(0., 1000., extra)]))
+        sources.append(np.concatenate([found, -1 - np.arange(extra) - k * extra]))
+    return listsx, listsy, sources
+
+
+def test_match_epochs_groups_every_source_once():
+    listsx, listsy, sources = _epochs()
+    table = match.match_epochs(listsx, listsy, 0.5)
+
+    #the true source of every detection, one per catalog in each row
+    true = np.array([[sources[k][i] if i >= 0 else -1000 for k, i in enumerate(row)]
+                     for row in table["INDEX"]])
+    for row, found in zip(true, table["INDEX"]):
+        ids = set(row[found >= 0])
+        assert len(ids) == 1
+    detected = [set(source) for source in sources]
+    expected = {}
+    for source in set.union(*detected):
+        expected[source] = sum(source in found for found in detected)
+    assert len(table) == len(expected)
+    ids = [row[found >= 0][0] for row, found in zip(true, table["INDEX"])]
+    assert sorted(ids) == sorted(expected)
+    assert [table["NCAT"][k] for k in np.argsort(ids)] == [expected[i] for i in sorted(expected)]
+    assert (table["NCAT"] == (table["INDEX"] >= 0).sum(axis=1)).all()
+    #numbered in order of the first detection
+    first = [np.nonzero(found >= 0)[0][0] for found in table["INDEX"]]
+    assert first == sorted(first)
+
+
+def test_match_epochs_keeps_one_detection_per_catalog():
+    #two stars of the first catalog within the threshold of one in the second
+    table = match.match_epochs([[10., 10.4], [10.1]], [[5., 5.], [5.]], 0.5)
+    assert len(table) == 2
+    assert sorted(table["NCAT"]) == [1, 2]
+    pair = table[table["NCAT"] == 2][0]
+    assert list(pair["INDEX"]) == [0, 0]
+
+
+def test_match_epochs_on_the_sky_across_ra_zero():
+    ra = [[359.9999, 10.], [0.00005, 10.0001], [359.99995]]
+    dec = [[-30., 20.], [-30.00002, 20.], [-30.00001]]
+    table = match.match_epochs(ra, dec, 1. / 3600., sky=True)
+    assert len(table) == 2
+    wrap = table[table["NCAT"] == 3][0]
+    assert wrap["RA"] > 359.9999 or wrap["RA"] < 0.0001
+    assert abs(wrap["DEC"] + 30.00001) < 1e-5
+    assert list(table["NCAT"]) == [3, 2]
+
+
+def test_match_transform_recovers_rotation_scale_and_shift():
+    rng = np.random.RandomState(21)
+    x1 = rng.uniform(0., 1000., 400)
+    y1 = rng.uniform(0., 1000., 400)
+    mags1 = rng.uniform(16., 24., 400)
+    truth = match.Transform(xshift=-152.3, yshift=87.9, rotation=33., scale=1.07)
+    x2, y2 = match.transform_positions(truth, x1, y1)
+    #the second list in another order, with noise, missing stars and stars of its own
+    order = rng.permutation(400)[:360]
+    x2 = np.concatenate([x2[order] + rng.normal(0., 0.05, 360), rng.uniform(-200., 1100., 30)])
+    y2 = np.concatenate([y2[order] + rng.normal(0., 0.05, 360), rng.uniform(-200., 1100., 30)])
+    mags2 = np.concatenate([mags1[order] + rng.normal(0., 0.05, 360), rng.uniform(16., 24., 30)])
+
+    transform, matches, nomatch = match.match_transform(x1, y1, x2, y2, 0.5, mags1=mags1,
+                                                        mags2=mags2, asarray=True)
+    assert abs(transform.xshift - truth.xshift) < 0.05
+    assert abs(transform.yshift - truth.yshift) < 0.05
+    assert abs(transform.rotation - truth.rotation) < 1e-3
+    assert abs(transform.scale - truth.scale) < 1e-4
+    assert len(matches) >= 355
+    assert (order[matches[:, 1]] == matches[:, 0]).all()
+    assert len(nomatch) == 400 - len(matches)
+
+
+def test_match_transform_without_common_stars_fails():
+    rng = np.random.RandomState(4)
+    try:
+        match.match_transform(rng.uniform(0., 100., 30), rng.uniform(0., 100., 30),
+                              rng.uniform(0., 100., 30), rng.uniform(0., 100., 30), 0.01,
+                              tolerance=1e-4)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("no transform should be found between unrelated lists")
+
+
+def test_match_sky_across_ra_zero():
+    ra1 = [359.99990, 0.00100, 180.]
+    dec1 = [12., 12., 0.]
+    ra2 = [0.00005, 359.99900, 180.001]
+    dec2 = [12., 12., 0.]
+    matches, nomatch, dist = match.match_sky(ra1, dec1, ra2, dec2, 1. / 3600., distances=True)
+    assert matches == [(0, 0)]
+    assert nomatch == [1, 2]
+    expected = 0.00015 * np.cos(np.radians(12.))
+    assert abs(dist[0] - expected) < 1e-9
+
+
+def test_match_sky_at_the_pole():
+    #one arcsecond from the pole every RA is close to every other
+    dec = 90. - 1. / 3600.
+    ra1 = [0., 100.]
+    ra2 = [180., 100.5]
+    matches, nomatch, dist = match.match_sky(ra1, [dec, dec], ra2, [dec, dec], 1.5 / 3600.,
+                                            distances=True)
+    assert matches == [(1, 1)]
+    assert nomatch == [0]
+    assert abs(dist[0] * 3600. - 2. * np.sin(np.radians(0.25))) < 1e-6
+    #through the pole the two are 2 arcseconds apart
+    matches, nomatch, dist = match.match_sky([0.], [dec], [180.], [dec], 2.5 / 3600.,
+                                            distances=True)
+    assert matches == [(0, 0)]
+    assert abs(dist[0] * 3600. - 2.) < 1e-6
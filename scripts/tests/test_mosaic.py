@@ -0,0 +1,51 @@
+import numpy as np
+
+import benchmark
+import mosaic
+import nativephot
+
+
+def _sorted(stars):
+    return stars[np.lexsort((stars["XCENTER"], stars["YCENTER"]))]
+
+
+def _assert_same(a, b):
+    assert a.dtype == b.dtype
+    for name in a.dtype.names:
+        if a.dtype[name].base.kind == "f":
+            np.testing.assert_array_equal(a[name], b[name])
+        else:
+            assert (a[name] == b[name]).all(), name
+
+
+def test_tiled_find_is_the_whole_image_find():
+    data, x, y, flux = benchmark.synthetic_image(200, 80)
+    whole = nativephot.find_stars(data)
+    assert len(whole) > 40
+    for workers in (1, 2):
+        tiled = mosaic.find_stars_tiled(data, tilesize=64, workers=workers)
+        _assert_same(_sorted(tiled), _sorted(whole))
+
+
+def test_tiled_photometry_is_the_whole_image_photometry():
+    data, x, y, flux = benchmark.synthetic_image(200, 80)
+    mask = np.zeros(data.shape, dtype=np.int16)
+    mask[100:104, 30:170] = 1
+    #stars on the tile edges and on the image edge too
+    x = np.concatenate([x, [64.5, 128.4, 1.2, 199.6]])
+    y = np.concatenate([y, [64.5, 60.3, 100., 3.]])
+    kwargs = dict(annulus=8., dannulus=3., epadu=benchmark.GAIN, readnoise=benchmark.READNOISE,
+                  datamin=-100.)
+    whole = nativephot.aperture_photometry(data, x, y, "2,4", mask=mask, **kwargs)
+    for workers in (1, 2):
+        tiled = mosaic.photometry_tiled(data, x, y, "2,4", tilesize=64, workers=workers,
+                                        mask=mask, **kwargs)
+        _assert_same(tiled, whole)
+
+
+def test_tile_cores_cover_the_image_once():
+    count = np.zeros((130, 70), dtype=int)
+    for (row0, row1, col0, col1), outer in mosaic.tile_grid(count.shape, 32, halo=5):
+        count[row0:row1, col0:col1] += 1
+        assert outer[0] == max(row0 - 5, 0) and outer[1] == min(row1 + 5, 130)
+    assert (count == 1).all()
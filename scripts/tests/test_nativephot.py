@@ -0,0 +1,146 @@
+import warnings
+
+import numpy as np
+from scipy.special import erf
+
+import nativephot
+
+
+def gaussian_star(flux, x, y, fwhm, shape=(64, 64), sky=0.):
+    """a gaussian star integrated over the pixels, at IRAF (1-based) x, y"""
+    sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+    ey = np.arange(shape[0] + 1) + 0.5
+    ex = np.arange(shape[1] + 1) + 0.5
+    py = 0.5 * np.diff(erf((ey - y) / (np.sqrt(2.) * sigma)))
+    px = 0.5 * np.diff(erf((ex - x) / (np.sqrt(2.) * sigma)))
+    return flux * np.outer(py, px) + sky, sigma
+
+
+def test_circle_overlap_of_the_pixel_grid_is_the_circle_area():
+    y, x = np.mgrid[-10:10, -10:10] + 0.3
+    for r in (0.4, 1., 2.5, 7.):
+        area = nativephot.circle_overlap(x, y, x + 1., y + 1., r).sum()
+        assert np.allclose(area, np.pi * r**2)
+
+
+def test_aperture_area_and_flux_of_a_flat_image_include_partial_pixels():
+    data = np.full((64, 64), 3.)
+    result = nativephot.aperture_photometry(data, [32.3], [31.8], "1.5,2,4.5", annulus=8.,
+                                            dannulus=3., recenter=False)
+    radii = np.array([1.5, 2., 4.5])
+    assert np.allclose(result["AREA"][0], np.pi * radii**2)
+    assert np.allclose(result["SUM"][0], 3. * np.pi * radii**2)
+    assert np.allclose(result["MSKY"], 3.)
+    assert np.allclose(result["FLUX"][0], 0., atol=1e-9)
+
+
+def test_aperture_flux_of_a_gaussian_star():
+    data, sigma = gaussian_star(1e4, 32.2, 31.7, 3., sky=50.)
+    #phot takes the light as flat across the pixels the aperture cuts, which
+    #is close to exact from about one and a half fwhm out
+    radii = np.array([4., 6.])
+    result = nativephot.aperture_photometry(data, [32.2], [31.7], radii, annulus=12., dannulus=4.,
+                                            zmag=25., epadu=1., recenter=False)
+    assert np.allclose(result["MSKY"], 50., atol=1e-3)
+    expected = 1e4 * (1. - np.exp(-radii**2 / (2. * sigma**2)))
+    assert np.allclose(result["FLUX"][0], expected, rtol=0.005)
+    assert np.allclose(result["MAG"][0], 25. - 2.5 * np.log10(expected), atol=0.005)
+    assert (result["PERROR"] == "NoError").all()
+
+
+def test_recentering_finds_the_star():
+    data, sigma = gaussian_star(1e4, 32.2, 31.7, 3., sky=50.)
+    result = nativephot.aperture_photometry(data, [32.], [32.], "4", annulus=12., dannulus=4.)
+    assert np.allclose(result["XCENTER"], 32.2, atol=0.1)
+    assert np.allclose(result["YCENTER"], 31.7, atol=0.1)
+    assert result["CERROR"][0] == "NoError"
+
+
+def test_sky_level_and_noise_of_a_noisy_background():
+    rng = np.random.RandomState(42)
+    data = rng.normal(100., 5., (128, 128))
+    x = np.array([30., 64., 98.])
+    msky, stdev, sskew, nsky, nsrej, sier = nativephot.sky_annulus(
+        data, x, x, annulus=10., dannulus=10.)
+    assert np.allclose(msky, 100., atol=0.5)
+    assert np.allclose(stdev, 5., rtol=0.05)
+    assert (sier == nativephot.NOERROR).all()
+    assert (nsky > 0.9 * np.pi * (20.**2 - 10.**2)).all()
+
+
+def test_stars_without_sky_are_flagged():
+    data = np.full((64, 64), 10.)
+    mask = np.ones(data.shape, dtype=bool)
+    mask[28:37, 28:37] = False
+    result = nativephot.aperture_photometry(data, [32.], [32.], "2", mask=mask, recenter=False)
+    assert result["SERROR"][0] == "NoSky"
+    assert result["PERROR"][0, 0] == "NoSky"
+    assert np.isnan(result["MAG"][0, 0])
+
+
+def test_star_at_the_edge_is_flagged_without_warnings():
+    data = np.full((40, 40), 100., dtype=np.float32)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        out = nativephot.aperture_photometry(data, [2.], [20.], apertures=[4.], annulus=6.,
+                                             dannulus=3., datamin=-100., datamax=1e5,
+                                             recenter=False)
+    assert out["PIER"][0, 0] == nativephot.EDGEIMAGE
+
+
+def _clipped_sky(data, x, y, annulus, dannulus, smaxiter=10, sloreject=3., shireject=3.,
+                 salgorithm="median"):
+    """the sky of one star with a plain clipping loop over its annulus pixels"""
+    rows, cols = np.mgrid[1:data.shape[0] + 1, 1:data.shape[1] + 1]
+    r = np.hypot(cols - x, rows - y)
+    values = data[(r >= annulus) & (r <= annulus + dannulus)]
+    kept = np.ones(len(values), dtype=bool)
+
+    def level(sample):
+        median, mean = np.median(sample), sample.mean()
+        if salgorithm == "mode":
+            return mean if mean < median else 3. * median - 2. * mean
+        return mean if salgorithm == "mean" else median
+
+    for iteration in range(smaxiter):
+        sample = values[kept]
+        center, sd = level(sample), sample.std()
+        keep = kept & (values >= center - sloreject * sd) & (values <= center + shireject * sd)
+        if sd <= 0 or not keep.any() or (keep == kept).all():
+            break
+        kept = keep
+    sample = values[kept]
+    skew = np.cbrt(((sample - sample.mean())**3).mean())
+    return level(sample), sample.std(), skew, len(sample), len(values) - len(sample)
+
+
+def test_sky_matches_a_plain_clipping_loop(monkeypatch):
+    rng = np.random.RandomState(7)
+    data = rng.normal(100., 5., (96, 96))
+    #cosmic rays and a faint neighbour for the clipping to reject
+    hits = rng.randint(0, 96, (2, 150))
+    data[hits[0], hits[1]] += rng.uniform(50., 500., 150)
+    data += gaussian_star(3e3, 40., 52., 3., shape=data.shape)[0]
+    x = np.array([30.3, 48.7, 66.1])
+    y = np.array([44.9, 50.2, 61.5])
+    #several chunks as well as one
+    monkeypatch.setattr(nativephot, "CHUNKSIZE", 2)
+    for salgorithm in ("median", "mean", "mode"):
+        msky, stdev, sskew, nsky, nsrej, sier = nativephot.sky_annulus(
+            data, x, y, annulus=8., dannulus=6., salgorithm=salgorithm)
+        for k in range(len(x)):
+            expected = _clipped_sky(data, x[k], y[k], 8., 6., salgorithm=salgorithm)
+            assert np.allclose((msky[k], stdev[k], sskew[k]), expected[:3], rtol=1e-6), salgorithm
+            assert (nsky[k], nsrej[k]) == expected[3:], salgorithm
+            assert nsrej[k] > 0
+
+
+def test_sky_algorithms_on_a_known_background():
+    rng = np.random.RandomState(3)
+    data = rng.normal(250., 8., (160, 160))
+    x = np.array([40., 80., 120.])
+    for salgorithm in nativephot.SKY_ALGORITHMS:
+        msky, stdev, sskew, nsky, nsrej, sier = nativephot.sky_annulus(
+            data, x, x, annulus=10., dannulus=15., salgorithm=salgorithm)
+        assert np.allclose(msky, 250., atol=0.5), salgorithm
+        assert np.allclose(stdev, 8., rtol=0.05), salgorithm
@@ -0,0 +1,80 @@
+import inspect
+
+import aperphot
+import nativephot
+import photconfig
+import psfphot
+
+
+class _Pset(object):
+    """stands in for an iraf parameter set, keeps what is assigned"""
+
+
+class _Iraf(object):
+    def __init__(self):
+        self.datapars = _Pset()
+        self.centerpars = _Pset()
+        self.fitskypars = _Pset()
+        self.photpars = _Pset()
+        self.daophot = _Pset()
+        self.daophot.findpars = _Pset()
+        self.daophot.daopars = _Pset()
+        self.daophot.phot = _Pset()
+
+
+def _arguments(function):
+    return set(inspect.getargspec(function).args)
+
+
+def test_kwargs_are_arguments_of_the_backends():
+    config = photconfig.nicmos_config()
+    assert set(photconfig.find_kwargs(config)) <= _arguments(nativephot.find_stars)
+    assert set(photconfig.phot_kwargs(config)) <= _arguments(nativephot.aperture_photometry)
+    assert set(photconfig.psf_kwargs(config)) <= _arguments(psfphot.psf_photometry)
+
+
+def test_kwargs_follow_the_config():
+    config = photconfig.nicmos_config(epadu=7.5, aper="2,4", sky_annulus=10., width_sky=5.,
+                                      zeropoint=22.)
+    config = photconfig.replace(config, "findpars", threshold=5.)
+    config = photconfig.replace(config, "centerpars", calgorithm="none")
+    config = photconfig.replace(config, "daopars", fitsky="no")
+
+    find = photconfig.find_kwargs(config)
+    assert find["threshold"] == 5. and find["fwhm"] == photconfig.FWHM
+    phot = photconfig.phot_kwargs(config)
+    assert phot["apertures"] == "2,4" and phot["zmag"] == 22. and phot["epadu"] == 7.5
+    assert phot["annulus"] == 10. and phot["dannulus"] == 5.
+    assert phot["recenter"] is False
+    psf = photconfig.psf_kwargs(config)
+    assert psf["fitsky"] is False and psf["recenter"] is True
+    #an INDEF merge radius is the fwhm
+    assert psf["mergerad"] == photconfig.FWHM
+
+
+def test_replace_leaves_the_original_alone():
+    config = photconfig.nicmos_config()
+    wide = photconfig.replace(config, "photpars", apertures="2,4,8")
+    assert config.photpars.apertures == "4."
+    assert wide.photpars.apertures == "2,4,8"
+    assert wide.datapars is config.datapars
+    assert hash(wide) != hash(config)
+
+
+def test_set_iraf_pars_copies_every_parameter(monkeypatch):
+    iraf = _Iraf()
+    monkeypatch.setattr(aperphot, "iraf", iraf)
+    monkeypatch.setattr(aperphot, "load_iraf", lambda: None)
+    config = photconfig.nicmos_config(epadu=3.)
+    aperphot.set_iraf_pars(config)
+
+    assert iraf.datapars.epadu == 3.
+    assert iraf.datapars.datamax == "INDEF"
+    assert iraf.daophot.findpars.threshold == config.findpars.threshold
+    assert iraf.daophot.daopars.mergerad == "INDEF"
+    for section, pset in (("centerpars", iraf.centerpars), ("fitskypars", iraf.fitskypars),
+                          ("photpars", iraf.photpars)):
+        pars = getattr(config, section)
+        for name, value in zip(pars._fields, pars):
+            assert getattr(pset, name) == ("INDEF" if value is None else value)
+    assert iraf.daophot.phot.interactive == "no"
@@ -0,0 +1,63 @@
+import numpy as np
+
+import benchmark
+import psfphot
+
+
+def _gaussian_psf(fwhm=benchmark.FWHM, half=10):
+    sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+    dy, dx = np.mgrid[-half:half + 1, -half:half + 1]
+    return np.exp(-(dx**2 + dy**2) / (2 * sigma**2))
+
+
+def _stars(psf, x, y, flux, shape=(64, 64), sky=20.):
+    """an image of the PSF model itself at the star positions"""
+    spline = psfphot.psf_spline(psfphot.read_psf(psf))
+    rows, cols = np.mgrid[1:shape[0] + 1, 1:shape[1] + 1]
+    data = np.full(shape, sky)
+    for xs, ys, fs in zip(x, y, flux):
+        data += fs * psfphot.psf_value(spline, cols - xs, rows - ys, 10.)
+    return data
+
+
+def test_an_isolated_star_is_recovered():
+    psf = _gaussian_psf()
+    data = _stars(psf, [30.3], [33.6], [5e4])
+    #started half a pixel off with a wrong sky
+    fit = psfphot.psf_photometry(data, [30.7], [33.2], psf, sky=[15.], fitrad=4., workers=1)
+    assert fit["PERROR"][0] == "NoError"
+    assert abs(fit["FLUX"][0] / 5e4 - 1.) < 1e-3
+    assert abs(fit["XCENTER"][0] - 30.3) < 0.01 and abs(fit["YCENTER"][0] - 33.6) < 0.01
+    assert abs(fit["MSKY"][0] - 20.) < 0.05
+
+
+def test_a_blended_pair_is_fitted_together():
+    psf = _gaussian_psf()
+    x, y, flux = [30.2, 33.1], [31.8, 33.3], [4e4, 1.5e4]
+    data = _stars(psf, x, y, flux)
+    fit = psfphot.psf_photometry(data, [30., 33.4], [32., 33.], psf, sky=20., fitrad=3.,
+                                 workers=1)
+    assert fit["GROUP"][0] == fit["GROUP"][1]
+    assert (fit["PERROR"] == "NoError").all()
+    assert np.allclose(fit["FLUX"], flux, rtol=2e-3)
+    assert np.allclose(fit["XCENTER"], x, atol=0.01)
+    assert np.allclose(fit["YCENTER"], y, atol=0.01)
+
+
+def test_a_noisy_field_is_recovered():
+    psf = _gaussian_psf()
+    data, x, y, flux = benchmark.synthetic_image(128, 60, psf=psf)
+    #all the stars from positions off by up to 0.3 pixels, in two worker processes
+    rng = np.random.RandomState(5)
+    fit = psfphot.psf_photometry(data, x + rng.uniform(-0.3, 0.3, len(x)),
+                                 y + rng.uniform(-0.3, 0.3, len(y)), psf, sky=benchmark.SKY,
+                                 fitrad=3., epadu=benchmark.GAIN,
+                                 readnoise=benchmark.READNOISE, workers=2)
+    inside = (x > 3) & (x < 126) & (y > 3) & (y < 126)
+    bright = inside & (fit["PIER"] == 0) & (flux > 1000.)
+    assert bright.sum() >= 15
+    assert np.median(np.abs(fit["FLUX"][bright] / flux[bright] - 1.)) < 0.02
+    assert np.median(np.hypot(fit["XCENTER"] - x, fit["YCENTER"] - y)[bright]) < 0.05
+    #the flux errors from MERR describe the scatter
+    sigma = fit["MERR"] * fit["FLUX"] / 1.0857
+    assert 0.4 < np.median(np.abs(fit["FLUX"] - flux)[bright] / sigma[bright]) < 1.2